@@ -0,0 +1,128 @@
+import argparse
+
+import errno
+
+import resource
+
+import selectors
+from selectors import DefaultSelector
+
+import socket as sckt
+from socket import socket
+
+import time
+
+from src.protocol import handshake
+from src.protocol import shared
+from src.protocol.codec import BINARY
+
+from .load import percentile
+from .workers import NO_LIMITS, start_server
+
+def storm(port: int, clients: int, timeout: float) -> dict[str, float]:
+    """
+    Open `clients` connections at once, each sending its handshake hello as
+    soon as it is connected, and time how long each waits for the server's
+    welcome, which is only sent once the server has accepted it.
+    """
+    hello = shared.frame(handshake.hello((BINARY.version,), (), 0))
+    started: dict[socket, int] = {}
+    waits: list[int] = []
+    failed = 0
+
+    with DefaultSelector() as sel:
+        begin = time.perf_counter()
+        for _ in range(clients):
+            sock = socket(sckt.AF_INET, sckt.SOCK_STREAM)
+            sock.setblocking(False)
+            started[sock] = time.perf_counter_ns()
+            result = sock.connect_ex(('127.0.0.1', port))
+            if result not in (0, errno.EINPROGRESS):
+                failed += 1
+                sock.close()
+                continue
+            _ = sel.register(sock, selectors.EVENT_WRITE)
+        connect_time = time.perf_counter() - begin
+
+        deadline = begin + timeout
+        pending = len(sel.get_map())
+        while pending and time.perf_counter() < deadline:
+            for key, mask in sel.select(timeout=0.5):
+                sock = key.fileobj
+                if mask & selectors.EVENT_WRITE:
+                    # Connected, or failed to
+                    if sock.getsockopt(sckt.SOL_SOCKET, sckt.SO_ERROR) == 0:
+                        try:
+                            sock.sendall(hello)
+                            _ = sel.modify(sock, selectors.EVENT_READ)
+                            continue
+                        except OSError:
+                            pass
+                else:
+                    try:
+                        if sock.recv(4096):
+                            waits.append(time.perf_counter_ns() - started[sock])
+                            sel.unregister(sock)
+                            pending -= 1
+                            continue
+                    except OSError:
+                        pass
+
+                # Refused, reset or closed by the server
+                failed += 1
+                sel.unregister(sock)
+                pending -= 1
+
+        total = time.perf_counter() - begin
+        for sock in started:
+            sock.close()
+
+    waits.sort()
+    return {
+        'connect_s': connect_time,
+        'accepted': len(waits),
+        'failed': failed,
+        'timed_out': pending,
+        'all_accepted_s': waits[-1] / 1e9 if waits and len(waits) == clients else total,
+        'p50_ms': percentile(waits, 0.5),
+        'p99_ms': percentile(waits, 0.99),
+        'max_ms': percentile(waits, 1.0),
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time-to-accept when thousands of clients connect at the same moment')
+    _ = parser.add_argument('-c', '--clients', help='Connections opened at once', type=int, default=10000)
+    _ = parser.add_argument('-b', '--backlogs', help='Comma-separated --backlog values to compare', default='5,128,4096')
+    _ = parser.add_argument('-e', '--engine', help='Server engine', choices=('threaded', 'asyncio'), default='threaded')
+    _ = parser.add_argument('--timeout', help='Seconds to wait for every welcome', type=float, default=60.0)
+    _ = parser.add_argument('--server-args', help='Extra arguments for the server, e.g. --accept-rate 2000/500', default='')
+    _ = parser.add_argument('-p', '--port', help='First port to use; each run takes the next one', type=int, default=24100)
+    args = parser.parse_args()
+
+    # Both this process and the server (which inherits the limit) need a
+    # descriptor per connection
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if hard < args.clients + 100:
+        parser.error(f"The open file limit ({hard}) is too low for {args.clients} clients")
+
+    print(f"{args.clients} simultaneous connections, {args.engine} engine")
+    print(f"{'backlog':>8} {'accepted':>9} {'failed':>7} {'timeout':>8} {'connect s':>10} {'all in s':>9} "
+          f"{'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+
+    for i, backlog in enumerate(int(b) for b in args.backlogs.split(',')):
+        port = args.port + i
+        server = start_server(port, [
+            '-e', args.engine, '--backlog', str(backlog), '--handshake-timeout', str(args.timeout),
+            '--ping-interval', '0', *NO_LIMITS, *args.server_args.split(),
+        ])
+        try:
+            result = storm(port, args.clients, args.timeout)
+        finally:
+            server.terminate()
+            _ = server.wait()
+
+        print(f"{backlog:>8} {result['accepted']:>9} {result['failed']:>7} {result['timed_out']:>8} "
+              f"{result['connect_s']:>10.2f} {result['all_accepted_s']:>9.2f} {result['p50_ms']:>9.1f} "
+              f"{result['p99_ms']:>9.1f} {result['max_ms']:>9.1f}")
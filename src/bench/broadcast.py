@@ -0,0 +1,67 @@
+import argparse
+
+import socket as sckt
+from socket import socket
+
+import time
+
+from src.protocol import events
+from src.protocol import shared
+
+def make_pairs(n: int) -> list[tuple[socket, socket]]:
+    """
+    Create `n` connected socket pairs. The first socket of each pair plays the
+    part of a server-side client connection; the second one is drained between
+    rounds so the kernel buffers never fill up.
+    """
+    pairs = []
+    for _ in range(n):
+        a, b = sckt.socketpair()
+        b.setblocking(False)
+        pairs.append((a, b))
+    return pairs
+
+def drain(pairs: list[tuple[socket, socket]]):
+    for _, b in pairs:
+        try:
+            while b.recv(65536):
+                pass
+        except BlockingIOError:
+            pass
+
+def per_target(event: events.EventObject, targets: list[socket]):
+    # The previous behaviour: serialize and frame once per recipient.
+    for conn in targets:
+        shared.send(event, conn)
+
+def time_round(fn, event, pairs, rounds: int) -> float:
+    targets = [a for a, _ in pairs]
+    total = 0.0
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn(event, targets)
+        total += time.perf_counter() - start
+        drain(pairs)
+    return total / rounds
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare per-target sends against encode-once broadcast')
+    _ = parser.add_argument('-s', '--sizes', help='Comma-separated channel sizes', default='1,10,100,1000,5000')
+    _ = parser.add_argument('-r', '--rounds', help='Broadcasts per channel size', type=int, default=20)
+    _ = parser.add_argument('-m', '--message-size', help='Length of the chat message in bytes', type=int, default=100)
+    args = parser.parse_args()
+
+    event = events.EventReceiveMessage("User 1", "x" * args.message_size, "General")
+
+    print(f"{'members':>8} {'per-target (ms)':>16} {'broadcast (ms)':>15} {'speedup':>8}")
+    for size in (int(s) for s in args.sizes.split(',')):
+        pairs = make_pairs(size)
+        try:
+            naive = time_round(per_target, event, pairs, args.rounds)
+            shared_frame = time_round(shared.broadcast, event, pairs, args.rounds)
+        finally:
+            for a, b in pairs:
+                a.close()
+                b.close()
+
+        print(f"{size:>8} {naive * 1000:>16.3f} {shared_frame * 1000:>15.3f} {naive / shared_frame:>7.2f}x")
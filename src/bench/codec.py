@@ -0,0 +1,53 @@
+import argparse
+
+import timeit
+
+from src.protocol import commands
+from src.protocol import events
+from src.protocol import shared
+from src.protocol.codec import BINARY
+
+def samples(message_size: int) -> list[shared.ProtocolObject]:
+    """
+    One representative instance of every message type.
+    """
+    text = "x" * message_size
+    return [
+        commands.CmdList(),
+        commands.CmdNick("alice"),
+        commands.CmdJoin("General"),
+        commands.CmdLeave("General"),
+        commands.CmdSendMessage(text, "General"),
+        events.EventReceiveMessage("alice", text, "General"),
+        events.EventList(1234, ("General", "Meta", "Misc")),
+        events.EventNick("User 1", "alice"),
+        events.EventJoin("alice", "General"),
+        events.EventLeave("alice", "General"),
+        events.EventError("Channel 'Foo' not found"),
+    ]
+
+def ns_per_op(fn, number: int) -> float:
+    # Best of three, to reduce noise from the rest of the machine
+    return min(timeit.repeat(fn, number=number, repeat=3)) / number * 1e9
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the binary codec against pickle')
+    _ = parser.add_argument('-n', '--number', help='Operations per timing run', type=int, default=20000)
+    _ = parser.add_argument('-m', '--message-size', help='Length of chat message text in bytes', type=int, default=100)
+    args = parser.parse_args()
+
+    codecs: tuple[shared.Codec, ...] = (shared.PICKLE, BINARY)
+
+    header = f"{'message':<20}"
+    for codec in codecs:
+        header += f" {codec.name + ' B':>10} {codec.name + ' enc ns':>14} {codec.name + ' dec ns':>14}"
+    print(header)
+
+    for obj in samples(args.message_size):
+        row = f"{type(obj).__name__:<20}"
+        for codec in codecs:
+            payload = codec.dumps(obj)
+            encode_ns = ns_per_op(lambda: codec.dumps(obj), args.number)
+            decode_ns = ns_per_op(lambda: codec.loads(payload), args.number)
+            row += f" {len(payload):>10} {encode_ns:>14.0f} {decode_ns:>14.0f}"
+        print(row)
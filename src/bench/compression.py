@@ -0,0 +1,74 @@
+import argparse
+
+import random
+
+from src.protocol import events
+from src.protocol import shared
+from src.protocol.codec import BINARY
+from src.protocol.compression import ZlibCompressor
+
+from .codec import ns_per_op
+
+def log_text(size: int, seed: int = 0) -> str:
+    """
+    Text resembling a pasted log: repetitive structure, varying numbers.
+    """
+    rng = random.Random(seed)
+    levels = ("INFO", "DEBUG", "WARNING", "ERROR")
+    modules = ("server.main", "server.core", "protocol.shared", "client.main")
+    lines: list[str] = []
+    length = 0
+    while length < size:
+        line = (
+            f"2024-03-{rng.randint(1, 28):02} {rng.randint(0, 23):02}:{rng.randint(0, 59):02}:"
+            f"{rng.randint(0, 59):02}.{rng.randint(0, 999):03} {rng.choice(levels):<7} "
+            f"[{rng.choice(modules)}] request {rng.randint(1, 10 ** 6)} took {rng.random() * 100:.2f} ms\n"
+        )
+        lines.append(line)
+        length += len(line)
+    return ''.join(lines)[:size]
+
+def random_text(size: int, seed: int = 0) -> str:
+    """
+    Text that barely compresses, such as a pasted key or base64 blob.
+    """
+    rng = random.Random(seed)
+    alphabet = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+    return ''.join(rng.choice(alphabet) for _ in range(size))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bandwidth saved against CPU spent by frame compression')
+    _ = parser.add_argument('-s', '--sizes', help='Comma-separated message sizes in bytes', default='256,1024,4096,16384,65536,262144')
+    _ = parser.add_argument('-l', '--levels', help='Comma-separated zlib levels', default='1,6,9')
+    _ = parser.add_argument('-f', '--fanout', help='Channel members each broadcast goes to', type=int, default=100)
+    _ = parser.add_argument('-n', '--number', help='Operations per timing run (scaled down for large messages)', type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"Broadcast to {args.fanout} members: the server compresses once, every member decompresses once.")
+    print(f"{'text':<7} {'size':>8} {'level':>5} {'frame B':>9} {'ratio':>6} {'comp us':>9} "
+          f"{'decomp us':>10} {'comp MB/s':>10} {'saved KB':>9} {'us/KB saved':>12}")
+
+    for kind, make_text in (('log', log_text), ('random', random_text)):
+        for size in (int(s) for s in args.sizes.split(',')):
+            message = events.EventReceiveMessage("alice", make_text(size), "General")
+            payload = BINARY.dumps(message)
+            number = max(10, args.number * 1024 // max(size, 1024))
+
+            for level in (int(l) for l in args.levels.split(',')):
+                compressor = ZlibCompressor(level)
+                frame = shared.frame(payload, compressor, threshold=0)
+                compressed = frame[4:]
+                was_compressed = len(frame) - 4 < len(payload)
+
+                compress_ns = ns_per_op(lambda: compressor.compress(payload), number)
+                if was_compressed:
+                    decompress_ns = ns_per_op(lambda: compressor.decompress(compressed, 1 << 24), number)
+                else:
+                    # Sent as is; receivers have nothing to do
+                    decompress_ns = 0.0
+
+                saved = (len(payload) - (len(frame) - 4)) * args.fanout
+                cost_per_kb = compress_ns / 1000 / (saved / 1024) if saved > 0 else float('inf')
+                print(f"{kind:<7} {size:>8} {level:>5} {len(frame):>9} {len(payload) / (len(frame) - 4):>6.2f} "
+                      f"{compress_ns / 1000:>9.1f} {decompress_ns / 1000:>10.1f} "
+                      f"{len(payload) / compress_ns * 1000:>10.1f} {saved / 1024:>9.1f} {cost_per_kb:>12.3f}")
@@ -0,0 +1,23 @@
+import argparse
+
+from .workers import NO_LIMITS, run_round, start_server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the threaded and asyncio server engines')
+    _ = parser.add_argument('-c', '--clients', help='Number of clients', type=int, default=30)
+    _ = parser.add_argument('-n', '--messages', help='Messages sent by each client', type=int, default=200)
+    _ = parser.add_argument('-m', '--message-size', help='Length of chat message text in bytes', type=int, default=100)
+    _ = parser.add_argument('-w', '--workers', help='Worker threads for the threaded engine', type=int, default=3)
+    _ = parser.add_argument('-p', '--port', help='Port for the benchmark server', type=int, default=23999)
+    args = parser.parse_args()
+
+    print(f"{'engine':>10} {'commands/s':>12} {'deliveries/s':>14}")
+    for engine in ('threaded', 'asyncio'):
+        server = start_server(args.port, ['-e', engine, '-w', str(args.workers), '--high-water', str(1 << 30), *NO_LIMITS])
+        try:
+            elapsed, sent, delivered = run_round(args.port, args.clients, args.messages, args.message_size)
+        finally:
+            server.terminate()
+            _ = server.wait()
+
+        print(f"{engine:>10} {sent / elapsed:>12.0f} {delivered / elapsed:>14.0f}")
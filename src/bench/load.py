@@ -0,0 +1,337 @@
+import argparse
+
+import asyncio
+
+import json
+import random
+import resource
+import shlex
+import sys
+import time
+
+from src.protocol import commands
+from src.protocol import events
+from src.protocol import handshake
+from src.protocol import shared
+from src.protocol.codec import BINARY
+from src.protocol.compression import ZLIB
+
+from .workers import start_server
+
+OPERATIONS = ('send', 'join', 'nick', 'list')
+
+class LoadClient(asyncio.BufferedProtocol):
+    """
+    One simulated user. Frames are read with the same `FrameDecoder` the
+    server uses, so thousands of these fit on one event loop.
+    """
+
+    def __init__(self, index: int, stats: 'LoadStats', compressions: tuple[int, ...] = ()):
+        self.index: int = index
+        self.compressions: tuple[int, ...] = compressions
+        self.stats: LoadStats = stats
+        self.decoder: shared.FrameDecoder = shared.FrameDecoder(4096)
+        self.transport: asyncio.Transport | None = None
+        self.channels: list[str] = []
+        self.renames: int = 0
+
+        # Latency of every message this client received, in nanoseconds
+        self.latencies: list[int] = []
+
+        self.welcome: asyncio.Future[shared.Codec] = asyncio.get_running_loop().create_future()
+        self.closed: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.write(shared.frame(handshake.hello((BINARY.version,), self.compressions)))
+
+    def get_buffer(self, sizehint):
+        return self.decoder.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        stats = self.stats
+        for payload in self.decoder.advance(nbytes):
+            if not self.welcome.done():
+                codec, self.decoder.compressor, _ = handshake.parse_welcome(payload)
+                self.welcome.set_result(codec)
+                continue
+            stats.receive(self, BINARY.loads(payload))
+
+    def connection_lost(self, exc):
+        if not self.welcome.done():
+            self.welcome.set_exception(exc or ConnectionResetError("Connection closed during handshake."))
+        if not self.closed.done():
+            self.closed.set_result(None)
+            self.stats.disconnects += 1
+
+    def send(self, msg: commands.CommandObject):
+        if not self.transport.is_closing():
+            self.transport.write(shared.encode(msg, BINARY, self.decoder.compressor))
+
+class LoadStats:
+    """
+    Everything measured during a run. Message latency is the time from the
+    sender writing a message to a member reading it; the send time travels in
+    the message text.
+    """
+
+    def __init__(self):
+        self.measuring: bool = False
+        self.sent: dict[str, int] = dict.fromkeys(OPERATIONS, 0)
+        self.expected: int = 0
+        self.deliveries: int = 0
+        self.errors: int = 0
+        self.disconnects: int = 0
+        self.last_delivery: float = 0.0
+
+    def receive(self, client: LoadClient, event: events.EventObject):
+        match event:
+            case events.EventReceiveMessage(message=message):
+                if not self.measuring:
+                    return
+                now = time.monotonic_ns()
+                client.latencies.append(now - int(message.partition(':')[0], 16))
+                self.deliveries += 1
+                self.last_delivery = now / 1e9
+
+            case events.EventHistory(count=count) if self.measuring:
+                # The server writes a join's history replay in one piece, right
+                # before this event, so the last `count` messages were old
+                # ones rather than deliveries.
+                count = min(count, len(client.latencies))
+                if count:
+                    del client.latencies[-count:]
+                    self.deliveries -= count
+
+            case events.EventError():
+                self.errors += 1
+
+def percentile(ordered: list[int], fraction: float) -> float:
+    """
+    Nearest-rank percentile of a sorted list of nanosecond latencies, in
+    milliseconds.
+    """
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return ordered[index] / 1e6
+
+def parse_mix(mix: str) -> dict[str, float]:
+    """
+    Parse a command mix such as 'send=90,join=4,nick=3,list=3' into weights.
+    """
+    weights: dict[str, float] = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown operation '{name}' in mix; expected one of {', '.join(OPERATIONS)}")
+        weights[name] = float(weight)
+    return weights
+
+def assign_channels(clients: int, channels: list[str], fanout: int) -> list[list[str]]:
+    """
+    Give every channel `fanout` members, taking clients round-robin, and
+    return the channels of each client. With a small fan-out some clients are
+    in no channel; with a large one clients are in several.
+    """
+    membership: list[list[str]] = [[] for _ in range(clients)]
+    position = 0
+    for channel in channels:
+        for _ in range(min(fanout, clients)):
+            membership[position % clients].append(channel)
+            position += 1
+    return membership
+
+async def open_client(host: str, port: int, index: int, stats: LoadStats, limit: asyncio.Semaphore,
+                      compressions: tuple[int, ...]) -> LoadClient:
+    # Connecting in small groups keeps the server's accept backlog from
+    # overflowing, which would stall connects for a SYN retry.
+    async with limit:
+        loop = asyncio.get_running_loop()
+        _, client = await loop.create_connection(lambda: LoadClient(index, stats, compressions), host, port)
+        codec = await client.welcome
+        if codec is not BINARY:
+            raise RuntimeError("Server did not accept the binary codec")
+        return client
+
+async def generate(clients: list[LoadClient], weights: dict[str, float], rate: float, message_size: int,
+                   members: dict[str, int], stats: LoadStats, duration: float):
+    """
+    Issue commands as one Poisson process at `rate` per second, each from a
+    random client, for `duration` seconds. The schedule is fixed in advance
+    of the server's responses: if the loop falls behind, the late commands
+    go out at once instead of being skipped, so a slow server shows up as
+    latency rather than as a lower request rate.
+
+    Joins re-join a channel the client is already in, so channel sizes stay
+    fixed while the server still does all the work of a join.
+    """
+    # Only channel members send and join
+    senders = [client for client in clients if client.channels]
+    if not senders:
+        weights = {name: weight for name, weight in weights.items() if name not in ('send', 'join')}
+    names = list(weights)
+    cumulative = list(weights.values())
+    if not names or sum(cumulative) <= 0:
+        return
+
+    rng = random.Random(0)
+    padding = 'x' * message_size
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    deadline = start + duration
+    next_at = start
+
+    while True:
+        next_at += rng.expovariate(rate)
+        if next_at >= deadline:
+            return
+        # Yield even when late, so responses keep being read
+        await asyncio.sleep(max(0.0, next_at - loop.time()))
+
+        operation = rng.choices(names, cumulative)[0]
+        match operation:
+            case 'send':
+                client = rng.choice(senders)
+                channel = rng.choice(client.channels)
+                # The scheduled time, not the actual one, so time spent
+                # waiting to send counts too. loop.time() is time.monotonic().
+                stamp = f"{int(next_at * 1e9):x}:"
+                client.send(commands.CmdSendMessage(stamp + padding[len(stamp):], channel))
+                stats.expected += members[channel]
+
+            case 'join':
+                client = rng.choice(senders)
+                client.send(commands.CmdJoin(rng.choice(client.channels)))
+
+            case 'nick':
+                client = rng.choice(clients)
+                client.renames += 1
+                client.send(commands.CmdNick(f"load{client.index}-{client.renames}"))
+
+            case 'list':
+                client = rng.choice(clients)
+                client.send(commands.CmdList())
+
+        stats.sent[operation] += 1
+
+async def run_load(args) -> dict:
+    stats = LoadStats()
+    channel_names = [name for name in args.channels.split(',') if name]
+    fanout = args.fanout if args.fanout is not None else max(1, args.clients // len(channel_names))
+    membership = assign_channels(args.clients, channel_names, fanout)
+    members = {name: sum(name in joined for joined in membership) for name in channel_names}
+    weights = parse_mix(args.mix)
+
+    limit = asyncio.Semaphore(args.connect_concurrency)
+    connect_start = time.perf_counter()
+    clients = await asyncio.gather(*(
+        open_client(args.host, args.port, i, stats, limit, (ZLIB.id,) if args.compress else ())
+        for i in range(args.clients)
+    ))
+    connect_time = time.perf_counter() - connect_start
+
+    for client, joined in zip(clients, membership):
+        client.channels = joined
+        for channel in joined:
+            client.send(commands.CmdJoin(channel))
+    # Let the joins (and their history replays) settle before measuring
+    await asyncio.sleep(args.settle)
+
+    loop = asyncio.get_running_loop()
+    stats.measuring = True
+    start = time.monotonic()
+    await generate(clients, weights, args.rate, args.message_size, members, stats, args.duration)
+    sending_time = time.monotonic() - start
+
+    # Wait for messages still in flight
+    drain_deadline = loop.time() + args.drain
+    while stats.deliveries < stats.expected and loop.time() < drain_deadline:
+        await asyncio.sleep(0.05)
+    stats.measuring = False
+    elapsed = max(sending_time, stats.last_delivery - start) if stats.last_delivery else sending_time
+
+    for client in clients:
+        client.transport.close()
+
+    latencies = sorted(latency for client in clients for latency in client.latencies)
+    messages = stats.sent['send']
+    return {
+        'clients': args.clients,
+        'channels': members,
+        'message_size': args.message_size,
+        'compress': args.compress,
+        'mix': weights,
+        'target_rate': args.rate,
+        'duration': round(sending_time, 3),
+        'connect_seconds': round(connect_time, 3),
+        'commands': stats.sent,
+        'commands_per_sec': round(sum(stats.sent.values()) / sending_time, 1),
+        'messages_per_sec': round(messages / sending_time, 1),
+        'deliveries': stats.deliveries,
+        'deliveries_expected': stats.expected,
+        'deliveries_per_sec': round(stats.deliveries / elapsed, 1) if elapsed > 0 else 0.0,
+        'latency_ms': {
+            'p50': round(percentile(latencies, 0.50), 3),
+            'p99': round(percentile(latencies, 0.99), 3),
+            'p99.9': round(percentile(latencies, 0.999), 3),
+            'max': round(latencies[-1] / 1e6, 3) if latencies else 0.0,
+        },
+        'errors': stats.errors,
+        'disconnects': stats.disconnects,
+    }
+
+def raise_file_limit(needed: int):
+    """
+    Every client needs a descriptor here and, for a local server, another
+    one in the server process, which inherits this limit.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        target = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+        if target < needed:
+            print(f"Warning: only {target} file descriptors available, {needed} wanted", file=sys.stderr)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate chat traffic against a server and report throughput and latency as JSON')
+    _ = parser.add_argument('-c', '--clients', help='Number of concurrent connections', type=int, default=1000)
+    _ = parser.add_argument('-t', '--duration', help='Seconds to generate traffic for', type=float, default=10.0)
+    _ = parser.add_argument('-r', '--rate', help='Commands per second, across all clients', type=float, default=1000.0)
+    _ = parser.add_argument('--mix', help='Relative weights of each command', default='send=90,join=4,nick=3,list=3')
+    _ = parser.add_argument('--channels', help='Comma-separated channels to use', default='General,Meta,Misc')
+    _ = parser.add_argument('-f', '--fanout', help='Members per channel (default: clients spread evenly over the channels)', type=int)
+    _ = parser.add_argument('-m', '--message-size', help='Length of chat message text in bytes', type=int, default=100)
+    _ = parser.add_argument('--compress', help='Offer zlib compression in the handshake', action='store_true')
+    _ = parser.add_argument('--host', help='Server to connect to', default='127.0.0.1')
+    _ = parser.add_argument('-p', '--port', help='Server port', type=int, default=23999)
+    _ = parser.add_argument('--external', help='Use a server that is already running instead of starting one', action='store_true')
+    _ = parser.add_argument('--server-args', help='Extra arguments for the local server', default=f'--high-water {1 << 26} --rate-limit off --channel-rate-limit 0 --queue-limit 0')
+    _ = parser.add_argument('--connect-concurrency', help='Connections opened at the same time', type=int, default=16)
+    _ = parser.add_argument('--settle', help='Seconds to wait after joining before measuring', type=float, default=1.0)
+    _ = parser.add_argument('--drain', help='Seconds to wait for in-flight messages after sending stops', type=float, default=5.0)
+    _ = parser.add_argument('-o', '--output', help='Write the JSON report to this file instead of stdout')
+    args = parser.parse_args()
+
+    if args.message_size < 20:
+        parser.error("--message-size must be at least 20 bytes to carry the send time")
+
+    raise_file_limit(2 * args.clients + 64)
+
+    server = None
+    if not args.external:
+        server = start_server(args.port, shlex.split(args.server_args))
+    try:
+        report = asyncio.run(run_load(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            _ = server.wait()
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            _ = f.write(text + '\n')
+    else:
+        print(text)
@@ -0,0 +1,80 @@
+import argparse
+
+import gc
+
+import tracemalloc
+
+from src.protocol import handshake
+from src.protocol import shared
+from src.protocol.codec import BINARY
+from src.server.connection import Connection
+
+from .registry import NullCore
+
+def traced() -> int:
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0]
+
+def connect(core: NullCore, clients: int) -> list[Connection]:
+    """
+    Register `clients` connections the way the threaded engine does, each
+    completing the handshake with a frame read through its decoder. The
+    sockets are stand-in integers; nothing is sent.
+    """
+    hello = shared.frame(handshake.hello((BINARY.version,), (), handshake.HEARTBEAT | handshake.ACKS))
+    conns: list[Connection] = []
+    for i in range(clients):
+        conn = Connection(1_000_000 + i, ('127.0.0.1', 10000 + i % 50000), "", core.read_buffer)
+        core._register(conn)
+        buffer = conn.decoder.get_buffer()
+        buffer[:len(hello)] = hello
+        for payload in conn.decoder.advance(len(hello)):
+            _ = core._decode(conn, payload)
+        conns.append(conn)
+    return conns
+
+def join(core: NullCore, conns: list[Connection], channels: int, per_user: int):
+    """
+    Add every connection to `per_user` channels, as CmdJoin does. The
+    broadcast each join makes is left out, as it would rebuild the channel's
+    member snapshot every time; each snapshot is built once at the end.
+    """
+    for i, conn in enumerate(conns):
+        for j in range(per_user):
+            channel = core._join_channel(conn, f"chan-{(i + j * 7919) % channels}")
+            if channel.name not in conn.channels:
+                conn.channels += (channel.name,)
+    for channel in core.channels.values():
+        _ = channel.members
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the memory each idle connection and channel membership takes')
+    _ = parser.add_argument('-c', '--clients', help='Idle connections', type=int, default=100_000)
+    _ = parser.add_argument('--channels', help='Channels the clients join', type=int, default=1000)
+    _ = parser.add_argument('--per-user', help='Channels each client joins', type=int, default=3)
+    _ = parser.add_argument('--top', help='Also list the allocation sites using the most memory', type=int, default=0)
+    args = parser.parse_args()
+
+    core = NullCore(0, 1 << 20, 'disconnect', False, ping_interval=0)
+
+    tracemalloc.start()
+    empty = traced()
+    before = tracemalloc.take_snapshot() if args.top else None
+
+    conns = connect(core, args.clients)
+    connected = traced()
+
+    join(core, conns, args.channels, args.per_user)
+    joined = traced()
+
+    per_connection = (connected - empty) / args.clients
+    per_membership = (joined - connected) / (args.clients * args.per_user)
+    print(f"{args.clients} idle connections: {(connected - empty) / 1e6:.1f} MB, {per_connection:.0f} bytes each")
+    print(f"{args.clients * args.per_user} memberships in {args.channels} channels: "
+          f"{(joined - connected) / 1e6:.1f} MB, {per_membership:.0f} bytes each")
+
+    if before is not None:
+        print(f"\nTop {args.top} allocation sites:")
+        for stat in tracemalloc.take_snapshot().compare_to(before, 'lineno')[:args.top]:
+            print(f"  {stat.size_diff / args.clients:>8.1f} B/conn  {stat.traceback[0]}")
+    tracemalloc.stop()
@@ -0,0 +1,244 @@
+import argparse
+
+import json
+
+import platform
+
+import socket
+
+import sys
+
+import time
+
+import tracemalloc
+
+from src.protocol import commands
+from src.protocol import events
+from src.protocol import shared
+from src.protocol.codec import BINARY, MESSAGE_TYPES
+
+# Most bytes in flight on a socket pair at once. Nothing reads while frames
+# are being sent, so more than the socket buffer holds would block forever.
+PIPE_BYTES = 128 << 10
+
+# Frames sent before any is received, in the pipelined measurements
+MAX_BATCH = 64
+
+# Measurements compared against the baseline, and whether they are times
+# (noisy, compared with a threshold) or exact counts
+METRICS = {
+    'roundtrip_ns': 'time',
+    'send_ns': 'time',
+    'receive_ns': 'time',
+    'recv_n_ns': 'time',
+    'alloc_bytes': 'alloc',
+    'wire_bytes': 'exact',
+}
+
+def text(size: int) -> str:
+    return "x" * size
+
+def names(size: int) -> tuple[str, ...]:
+    # Channel names of about 12 characters, adding up to `size`
+    return tuple(f"channel-{i:04}" for i in range(max(1, size // 13)))
+
+# One instance of every message type with about `size` bytes of content, or
+# None for types without variable-length content, which are measured once.
+SAMPLES = {
+    commands.CmdList: None,
+    commands.CmdPong: None,
+    commands.CmdNick: lambda size: commands.CmdNick(text(size)),
+    commands.CmdJoin: lambda size: commands.CmdJoin(text(size)),
+    commands.CmdLeave: lambda size: commands.CmdLeave(text(size)),
+    commands.CmdSendMessage: lambda size: commands.CmdSendMessage(text(size), "General"),
+    commands.CmdHistory: lambda size: commands.CmdHistory(text(size), 1234, 50),
+    commands.CmdStats: lambda size: commands.CmdStats(text(size)),
+    commands.CmdListChannels: lambda size: commands.CmdListChannels(text(size // 2), text(size // 2), 100),
+    commands.CmdProfile: lambda size: commands.CmdProfile(text(size), 10, True),
+    events.EventReceiveMessage: lambda size: events.EventReceiveMessage("alice", text(size), "General"),
+    events.EventList: lambda size: events.EventList(1234, names(size)),
+    events.EventNick: lambda size: events.EventNick("User 1", text(size)),
+    events.EventJoin: lambda size: events.EventJoin(text(size), "General"),
+    events.EventLeave: lambda size: events.EventLeave(text(size), "General"),
+    events.EventError: lambda size: events.EventError(text(size)),
+    events.EventHistory: lambda size: events.EventHistory(text(size), 50, 1234),
+    events.EventStats: lambda size: events.EventStats(text(size)),
+    events.EventPing: None,
+    events.EventChannelList: lambda size: events.EventChannelList(names(size), tuple(range(len(names(size)))), text(12)),
+    events.EventAck: lambda size: events.EventAck(123456, text(size)),
+    events.EventProfile: lambda size: events.EventProfile((text(size // 2), text(size // 2))),
+    events.EventPresenceDelta: lambda size: events.EventPresenceDelta("General", names(size // 2), names(size // 4),
+                                                                      names(size // 8), names(size // 8)),
+}
+
+def samples(sizes: list[int]) -> list[tuple[int, shared.ProtocolObject]]:
+    """
+    (size, message) for every registered message type and size.
+    """
+    missing = [message_type.__name__ for message_type in MESSAGE_TYPES.values() if message_type not in SAMPLES]
+    if missing:
+        raise ValueError(f"No benchmark sample for {', '.join(missing)}")
+
+    result: list[tuple[int, shared.ProtocolObject]] = []
+    for message_type in MESSAGE_TYPES.values():
+        make = SAMPLES[message_type]
+        if make is None:
+            result.append((0, message_type()))
+        else:
+            result.extend((size, make(size)) for size in sizes)
+    return result
+
+def best_ns(run, ops: int) -> float:
+    # Best of three, to reduce noise from the rest of the machine. `run`
+    # returns the nanoseconds it spent on the timed part.
+    return min(run() for _ in range(3)) / ops
+
+def measure(obj: shared.ProtocolObject, codec: shared.Codec, number: int, a: socket.socket, b: socket.socket) -> dict:
+    frame = shared.encode(obj, codec)
+    if len(frame) > PIPE_BYTES:
+        raise ValueError(f"{type(obj).__name__} frame of {len(frame)} bytes is larger than the socket buffer")
+
+    send = shared.send
+    receive = shared.receive
+    recv_n = shared._recv_n
+    clock = time.perf_counter_ns
+
+    # One frame at a time: send, then receive it
+    def roundtrip() -> int:
+        start = clock()
+        for _ in range(number):
+            send(obj, a, codec)
+            _ = receive(b, codec)
+        return clock() - start
+
+    # A batch of frames, then all of them read back, timed separately. For
+    # _recv_n, the frames are written as they are and read back whole.
+    batch = max(1, min(MAX_BATCH, PIPE_BYTES // len(frame)))
+    rounds = max(1, number // batch)
+    ops = rounds * batch
+    wire = frame * batch
+
+    def pipelined() -> tuple[int, int]:
+        sending = receiving = 0
+        for _ in range(rounds):
+            start = clock()
+            for _ in range(batch):
+                send(obj, a, codec)
+            middle = clock()
+            for _ in range(batch):
+                _ = receive(b, codec)
+            sending += middle - start
+            receiving += clock() - middle
+        return sending, receiving
+
+    def raw() -> int:
+        elapsed = 0
+        for _ in range(rounds):
+            a.sendall(wire)
+            start = clock()
+            for _ in range(batch):
+                _ = recv_n(b, len(frame))
+            elapsed += clock() - start
+        return elapsed
+
+    timings = [pipelined() for _ in range(3)]
+
+    # Bytes allocated at the peak of one round trip, tracked separately since
+    # tracing slows everything down
+    send(obj, a, codec)
+    _ = receive(b, codec)
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline, _ = tracemalloc.get_traced_memory()
+    send(obj, a, codec)
+    _ = receive(b, codec)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'message': type(obj).__name__,
+        'wire_bytes': len(frame),
+        'roundtrip_ns': best_ns(roundtrip, number),
+        'send_ns': min(sending for sending, _ in timings) / ops,
+        'receive_ns': min(receiving for _, receiving in timings) / ops,
+        'recv_n_ns': best_ns(raw, ops),
+        'alloc_bytes': peak - baseline,
+    }
+
+def compare(results: list[dict], baseline: dict, time_threshold: float, alloc_threshold: float) -> list[str]:
+    """
+    Every measurement that got worse than the baseline by more than its
+    threshold, as lines of text. Wire sizes must match exactly.
+    """
+    old = {(entry['message'], entry['size']): entry for entry in baseline['results']}
+    regressions: list[str] = []
+    for entry in results:
+        before = old.get((entry['message'], entry['size']))
+        if before is None:
+            continue
+
+        for metric, kind in METRICS.items():
+            was, now = before[metric], entry[metric]
+            if kind == 'exact':
+                worse = now != was
+            else:
+                threshold = time_threshold if kind == 'time' else alloc_threshold
+                # Allocations of a few bytes vary with interpreter internals
+                worse = now > was * (1 + threshold) and (kind == 'time' or now - was > 64)
+            if worse:
+                change = f"{(now - was) / was:+.0%}" if was else "new"
+                regressions.append(f"{entry['message']:<20} {entry['size']:>6} {metric:<13} {was:>12.0f} -> {now:>12.0f} ({change})")
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time framing and serialization of every message type over a socket pair')
+    _ = parser.add_argument('-s', '--sizes', help='Comma-separated content sizes in bytes', default='16,256,4096,65536')
+    _ = parser.add_argument('-n', '--number', help='Operations per timing run (scaled down for large messages)', type=int, default=2000)
+    _ = parser.add_argument('--codec', help='Wire format to measure', choices=('binary', 'pickle'), default='binary')
+    _ = parser.add_argument('-o', '--output', help='Write the results as JSON to this file, e.g. to use as a baseline later')
+    _ = parser.add_argument('-b', '--baseline', help='Compare against results saved with -o; exits with status 1 on a regression')
+    _ = parser.add_argument('--time-threshold', help='Fraction by which a time may exceed the baseline', type=float, default=0.25)
+    _ = parser.add_argument('--alloc-threshold', help='Fraction by which allocated bytes may exceed the baseline', type=float, default=0.10)
+    args = parser.parse_args()
+
+    codec = BINARY if args.codec == 'binary' else shared.PICKLE
+    sizes = [int(s) for s in args.sizes.split(',')]
+
+    a, b = socket.socketpair()
+    for sock in (a, b):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 2 * PIPE_BYTES)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 2 * PIPE_BYTES)
+
+    print(f"{'message':<20} {'size':>6} {'wire B':>8} {'rtt ns':>9} {'send ns':>9} {'recv ns':>9} "
+          f"{'recv_n ns':>9} {'alloc B':>8}")
+    results: list[dict] = []
+    for size, obj in samples(sizes):
+        number = max(50, args.number * 1024 // max(size, 1024))
+        entry = measure(obj, codec, number, a, b)
+        entry['size'] = size
+        results.append(entry)
+        print(f"{entry['message']:<20} {size:>6} {entry['wire_bytes']:>8} {entry['roundtrip_ns']:>9.0f} "
+              f"{entry['send_ns']:>9.0f} {entry['receive_ns']:>9.0f} {entry['recv_n_ns']:>9.0f} {entry['alloc_bytes']:>8}")
+
+    report = {
+        'codec': codec.name,
+        'python': sys.version.split()[0],
+        'machine': platform.platform(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('codec') != codec.name:
+            parser.error(f"Baseline is for the {baseline.get('codec')} codec")
+
+        regressions = compare(results, baseline, args.time_threshold, args.alloc_threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regressions against {args.baseline}:")
+            print('\n'.join(regressions))
+            sys.exit(1)
+        print(f"\nNo regressions against {args.baseline}")
@@ -0,0 +1,108 @@
+import argparse
+
+import time
+
+from src.server.connection import BaseConnection
+from src.server.core import ChatCore
+
+class NullCore(ChatCore):
+    """
+    A server core that discards everything it would send.
+    """
+    __slots__ = ()
+
+    def _deliver(self, conn, frame):
+        pass
+
+def fake_session(key: int) -> BaseConnection:
+    # Simulated users have no socket or buffers; only the fields the registry
+    # and channels look at
+    conn = BaseConnection.__new__(BaseConnection)
+    conn.sock = key
+    conn.address = None
+    conn.codec = None
+    conn.channels = ()
+    conn.closed = False
+    return conn
+
+def populate(core: ChatCore, users: int, channels: int, per_user: int) -> list[BaseConnection]:
+    sessions = []
+    for i in range(users):
+        conn = fake_session(i)
+        _ = core.sessions.add(conn, core.username_generator)
+        for j in range(per_user):
+            name = f"chan-{(i + j * 7919) % channels}"
+            channel = core._join_channel(conn, name)
+            if channel.name not in conn.channels:
+                conn.channels += (channel.name,)
+        sessions.append(conn)
+    return sessions
+
+def ns_per_op(fn, ops: int) -> float:
+    start = time.perf_counter_ns()
+    fn(ops)
+    return (time.perf_counter_ns() - start) / ops
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmark the session registry and channel bookkeeping')
+    _ = parser.add_argument('-u', '--users', help='Comma-separated user counts', default='10000,100000,1000000')
+    _ = parser.add_argument('-c', '--channel-size', help='Average members per channel', type=int, default=100)
+    _ = parser.add_argument('-j', '--joined', help='Channels each user is in', type=int, default=3)
+    _ = parser.add_argument('-n', '--ops', help='Operations per measurement', type=int, default=10000)
+    args = parser.parse_args()
+
+    print(f"{'users':>9} {'rename ns':>10} {'scan rename ns':>15} {'join+leave ns':>14} {'create+remove ns':>17} {'cleanup ns':>11} {'scan cleanup ns':>16}")
+    for users in (int(u) for u in args.users.split(',')):
+        core = NullCore(0, 1 << 20, 'disconnect', False)
+        channel_count = max(1, users * args.joined // args.channel_size)
+        sessions = populate(core, users, channel_count, args.joined)
+        ops = min(args.ops, users)
+
+        def rename(n):
+            for i in range(n):
+                _ = core.sessions.rename(sessions[i], f"renamed {i}")
+
+        def scan_rename(n):
+            # What CmdNick used to do: look at every user's name
+            for i in range(n):
+                new_nick = f"scanned {i}"
+                _ = any(conn.nick == new_nick for conn in core.sessions.by_sock.values())
+
+        def join_leave(n):
+            for i in range(n):
+                name = f"chan-{i % channel_count}"
+                _ = core._join_channel(sessions[-1 - i], name)
+                _ = core._leave_channel(sessions[-1 - i], name)
+
+        def create_remove(n):
+            # The only member joins and leaves, so the channel is created and
+            # removed again each time
+            for i in range(n):
+                name = f"new-{i}"
+                _ = core._join_channel(sessions[-1 - i], name)
+                _ = core._leave_channel(sessions[-1 - i], name)
+
+        def scan_cleanup(n):
+            # What disconnecting used to do: check every channel
+            for i in range(n):
+                conn = sessions[i]
+                for channel in core.channels.values():
+                    if conn in channel.member_set:
+                        pass
+
+        def cleanup(n):
+            for i in range(n):
+                core._cleanup(sessions[i])
+
+        # The scans are linear, so time fewer of them on big registries
+        scan_ops = max(1, min(ops, 10_000_000 // users))
+
+        row = (
+            ns_per_op(rename, ops),
+            ns_per_op(scan_rename, scan_ops),
+            ns_per_op(join_leave, ops),
+            ns_per_op(create_remove, ops),
+            ns_per_op(cleanup, ops),
+            ns_per_op(scan_cleanup, max(1, min(ops, 10_000_000 // channel_count))),
+        )
+        print(f"{users:>9} {row[0]:>10.0f} {row[1]:>15.0f} {row[2]:>14.0f} {row[3]:>17.0f} {row[4]:>11.0f} {row[5]:>16.0f}")
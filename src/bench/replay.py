@@ -0,0 +1,320 @@
+import argparse
+
+import asyncio
+
+from collections.abc import Iterator
+
+import heapq
+
+import json
+import shlex
+import time
+
+from src.protocol import commands
+from src.protocol import events
+from src.protocol import handshake
+from src.protocol import shared
+from src.protocol.codec import BINARY
+from src.server import capture
+
+from .load import percentile, raise_file_limit
+from .workers import start_server
+
+# Commands that need the admin token of the server they were captured on
+SKIPPED = (commands.CmdStats, commands.CmdProfile)
+
+# Records sent between reads when replaying as fast as possible
+BATCH = 64
+
+class ReplayClient(asyncio.BufferedProtocol):
+    """
+    One captured connection. It negotiates acks, so a command's latency is
+    the time from when it was due to its `EventAck`. Commands due before the
+    connection is made are sent as soon as it is. When the capture says the
+    connection closed, it stays open until every command it sent has been
+    acked, so the server's answers are still measured.
+    """
+
+    def __init__(self, stats: 'ReplayStats'):
+        self.stats: ReplayStats = stats
+        self.decoder: shared.FrameDecoder = shared.FrameDecoder(4096)
+        self.transport: asyncio.Transport | None = None
+        self.welcomed: bool = False
+
+        # Frames waiting for the connection to be made
+        self.held: list[bytes] = []
+
+        # Whether the capture has closed the connection, so it closes once
+        # the last ack arrives, and whether it is closed or closing
+        self.finished: bool = False
+        self.closing: bool = False
+
+        # Commands waiting for their ack, by number: (type, when it was due
+        # in nanoseconds). Acks may come out of order, as the server refuses
+        # some commands (over a rate limit, or while shedding load) before
+        # those still queued are handled.
+        self.seq: int = 0
+        self.unacked: dict[int, tuple[type, int]] = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.write(shared.frame(handshake.hello((BINARY.version,), (), handshake.ACKS)))
+        transport.write(b''.join(self.held))
+        self.held = []
+        if self.closing or (self.finished and not self.unacked):
+            transport.close()
+
+    def get_buffer(self, sizehint):
+        return self.decoder.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        stats = self.stats
+        for payload in self.decoder.advance(nbytes):
+            if not self.welcomed:
+                _ = handshake.parse_welcome(payload)
+                self.welcomed = True
+                continue
+            stats.receive(self, BINARY.loads(payload))
+
+    def connection_lost(self, exc):
+        if not self.closing:
+            self.stats.disconnects += 1
+        self.closing = True
+
+    def send(self, msg: commands.CommandObject, due: int):
+        if self.closing or self.finished:
+            return
+        self.seq += 1
+        self.unacked[self.seq] = (type(msg), due)
+        frame = shared.encode(msg, BINARY)
+        if self.transport is None:
+            self.held.append(frame)
+        else:
+            self.transport.write(frame)
+
+    # The capture closed the connection. Nothing more is sent on it.
+    def finish(self):
+        self.finished = True
+        if not self.unacked:
+            self.close()
+
+    def close(self):
+        self.closing = True
+        if self.transport is not None:
+            self.transport.close()
+
+class ReplayStats:
+    """
+    Everything measured during a replay: the latency of every command by
+    type, and what the clients received.
+    """
+
+    def __init__(self):
+        self.sent: dict[str, int] = {}
+        self.skipped: int = 0
+        self.latencies: dict[str, list[int]] = {}
+        self.deliveries: int = 0
+        self.errors: int = 0
+        self.connections: int = 0
+        self.connect_failures: int = 0
+        self.disconnects: int = 0
+        self.last_ack: float = 0.0
+
+    def receive(self, client: ReplayClient, event: events.EventObject):
+        match event:
+            case events.EventAck(seq=seq, error=error):
+                now = time.monotonic_ns()
+                command = client.unacked.pop(seq, None)
+                if command is not None:
+                    kind, due = command
+                    self.latencies.setdefault(kind.__name__, []).append(now - due)
+                self.last_ack = now / 1e9
+                if error:
+                    self.errors += 1
+                if client.finished and not client.unacked:
+                    client.close()
+
+            case events.EventReceiveMessage():
+                self.deliveries += 1
+
+def merged(paths: list[str]) -> Iterator[tuple[float, tuple[int, int], int, commands.CommandObject | None]]:
+    """
+    The records of one or more traces, such as those of the processes of a
+    cluster, in time order, as (seconds since the first capture started,
+    connection, kind, command). Connections are numbered per trace, so they
+    are identified by trace and number.
+    """
+    starts: list[float] = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            started, _ = capture.read_header(f)
+        starts.append(started)
+    first = min(starts)
+
+    def stream(index: int, path: str):
+        offset = starts[index] - first
+        for kind, ident, micros, msg in capture.records(path):
+            yield offset + micros / 1e6, (index, ident), kind, msg
+
+    return heapq.merge(*(stream(i, path) for i, path in enumerate(paths)), key=lambda record: record[0])
+
+def peak_connections(paths: list[str]) -> int:
+    """
+    Most connections open at once in any one trace, summed over the traces.
+    """
+    total = 0
+    for path in paths:
+        open_now = peak = 0
+        for kind, _, _, _ in capture.records(path, decode=False):
+            if kind == capture.CONNECT:
+                open_now += 1
+                peak = max(peak, open_now)
+            elif kind == capture.DISCONNECT:
+                open_now -= 1
+        total += peak
+    return total
+
+async def open_client(host: str, port: int, client: ReplayClient, stats: ReplayStats):
+    try:
+        _ = await asyncio.get_running_loop().create_connection(lambda: client, host, port)
+    except OSError:
+        stats.connect_failures += 1
+        client.closing = True
+
+async def replay(paths: list[str], host: str, port: int, speed: float, drain: float) -> dict:
+    """
+    Play the traces back against a server: open and close connections and
+    send every command when the capture says, `speed` times faster, or as
+    fast as possible with a speed of 0. Like the load generator, the
+    schedule doesn't wait for the server, so a slow server shows up as
+    latency. Commands are timed from when they were due, or from when they
+    were sent at full speed.
+    """
+    loop = asyncio.get_running_loop()
+    stats = ReplayStats()
+    clients: dict[tuple[int, int], ReplayClient] = {}
+    everyone: list[ReplayClient] = []
+    tasks: set[asyncio.Task] = set()
+    lag = 0.0
+    trace_seconds = 0.0
+
+    start = loop.time()
+    for count, (at, key, kind, msg) in enumerate(merged(paths)):
+        trace_seconds = at
+        if speed > 0:
+            due = start + at / speed
+            delay = due - loop.time()
+            lag = max(lag, -delay)
+            # Yield even when late, so responses keep being read
+            await asyncio.sleep(max(0.0, delay))
+            # loop.time() is time.monotonic()
+            stamp = int(due * 1e9)
+        else:
+            if count % BATCH == 0:
+                # Let responses be read
+                await asyncio.sleep(0)
+            stamp = time.monotonic_ns()
+
+        match kind:
+            case capture.CONNECT:
+                client = clients[key] = ReplayClient(stats)
+                everyone.append(client)
+                stats.connections += 1
+                task = loop.create_task(open_client(host, port, client, stats))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+            case capture.COMMAND:
+                client = clients.get(key)
+                if client is None or type(msg) in SKIPPED:
+                    stats.skipped += 1
+                    continue
+                client.send(msg, stamp)
+                name = type(msg).__name__
+                stats.sent[name] = stats.sent.get(name, 0) + 1
+
+            case capture.DISCONNECT:
+                client = clients.pop(key, None)
+                if client is not None:
+                    client.finish()
+    sending_time = loop.time() - start
+
+    # Wait for the acks still in flight, including those of connections the
+    # capture has closed
+    deadline = loop.time() + drain
+    while loop.time() < deadline and any(client.unacked and not client.closing for client in everyone):
+        await asyncio.sleep(0.05)
+    elapsed = max(sending_time, stats.last_ack - start) if stats.last_ack else sending_time
+
+    for client in everyone:
+        client.close()
+    for task in list(tasks):
+        _ = task.cancel()
+
+    def summary(latencies: list[int]) -> dict[str, float]:
+        latencies.sort()
+        return {
+            'p50': round(percentile(latencies, 0.50), 3),
+            'p90': round(percentile(latencies, 0.90), 3),
+            'p99': round(percentile(latencies, 0.99), 3),
+            'p99.9': round(percentile(latencies, 0.999), 3),
+            'max': round(latencies[-1] / 1e6, 3) if latencies else 0.0,
+        }
+
+    sent = sum(stats.sent.values())
+    return {
+        'traces': paths,
+        'speed': speed if speed > 0 else 'max',
+        'trace_seconds': round(trace_seconds, 3),
+        'replay_seconds': round(sending_time, 3),
+        'max_lag_ms': round(lag * 1e3, 3),
+        'connections': stats.connections,
+        'connect_failures': stats.connect_failures,
+        'disconnects': stats.disconnects,
+        'commands': stats.sent,
+        'skipped': stats.skipped,
+        'commands_per_sec': round(sent / elapsed, 1) if elapsed > 0 else 0.0,
+        'deliveries': stats.deliveries,
+        'deliveries_per_sec': round(stats.deliveries / elapsed, 1) if elapsed > 0 else 0.0,
+        'latency_ms': summary([latency for latencies in stats.latencies.values() for latency in latencies]),
+        'latency_ms_by_command': {name: summary(latencies) for name, latencies in sorted(stats.latencies.items())},
+        'errors': stats.errors,
+        'unanswered': sum(len(client.unacked) for client in everyone),
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay captured traffic (--capture of the server) and report throughput and latency as JSON')
+    _ = parser.add_argument('traces', help='Trace files, merged by time (e.g. one per process of a cluster)', nargs='+')
+    _ = parser.add_argument('-s', '--speed', help='Replay this many times faster than captured; 0 for as fast as possible', type=float, default=1.0)
+    _ = parser.add_argument('--host', help='Server to connect to', default='127.0.0.1')
+    _ = parser.add_argument('-p', '--port', help='Server port', type=int, default=23999)
+    _ = parser.add_argument('--external', help='Use a server that is already running instead of starting one', action='store_true')
+    _ = parser.add_argument('--server-args', help='Extra arguments for the local server, e.g. the options being compared', default='')
+    _ = parser.add_argument('--drain', help='Seconds to wait for outstanding acks after the trace ends', type=float, default=5.0)
+    _ = parser.add_argument('-o', '--output', help='Write the JSON report to this file instead of stdout')
+    args = parser.parse_args()
+
+    if args.speed < 0:
+        parser.error("--speed must not be negative")
+
+    try:
+        raise_file_limit(2 * peak_connections(args.traces) + 64)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    server = None
+    if not args.external:
+        server = start_server(args.port, shlex.split(args.server_args))
+    try:
+        report = asyncio.run(replay(args.traces, args.host, args.port, args.speed, args.drain))
+    finally:
+        if server is not None:
+            server.terminate()
+            _ = server.wait()
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            _ = f.write(text + '\n')
+    else:
+        print(text)
@@ -0,0 +1,151 @@
+import argparse
+
+import selectors
+from selectors import DefaultSelector
+
+import socket as sckt
+from socket import socket
+
+import subprocess
+import sys
+import time
+
+from src.protocol import commands
+from src.protocol import handshake
+from src.protocol import shared
+from src.protocol.codec import BINARY
+
+CHANNELS = ("General", "Meta", "Misc")
+
+# Benchmarks send as fast as they can, which the default limits would refuse
+NO_LIMITS = ['--rate-limit', 'off', '--channel-rate-limit', '0', '--queue-limit', '0']
+
+def start_server(port: int, extra_args: list[str]) -> subprocess.Popen:
+    """
+    Start `src.server.main` in a separate process and wait until it accepts
+    connections, so the benchmark's own work does not share its GIL.
+    """
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'src.server.main', '-p', str(port), *extra_args],
+        stdout=subprocess.DEVNULL,
+    )
+
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            sckt.create_connection(('127.0.0.1', port)).close()
+            return server
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline or server.poll() is not None:
+                server.kill()
+                raise RuntimeError("Server did not start")
+            time.sleep(0.05)
+
+def connect(port: int) -> socket:
+    sock = sckt.create_connection(('127.0.0.1', port))
+    codec, _, _ = handshake.negotiate(sock, (BINARY.version,), ())
+    assert codec is BINARY
+    return sock
+
+def drain(socks: list[socket], quiet: float = 0.3):
+    """
+    Read and discard until no socket has received anything for `quiet`
+    seconds.
+    """
+    for sock in socks:
+        sock.setblocking(False)
+
+    with DefaultSelector() as sel:
+        for sock in socks:
+            _ = sel.register(sock, selectors.EVENT_READ)
+        while True:
+            ready = sel.select(timeout=quiet)
+            if not ready:
+                break
+            for key, _ in ready:
+                try:
+                    _ = key.fileobj.recv(1 << 16)
+                except BlockingIOError:
+                    pass
+
+def run_round(port: int, clients: int, messages: int, message_size: int) -> tuple[float, int, int]:
+    """
+    Connect `clients` clients spread over the channels, have each of them send
+    `messages` messages, and wait until every member has received every
+    message in its channel. Returns (seconds, commands, deliveries).
+    """
+    socks = [connect(port) for _ in range(clients)]
+    members = [0] * len(CHANNELS)
+    for i, sock in enumerate(socks):
+        shared.send(commands.CmdJoin(CHANNELS[i % len(CHANNELS)]), sock, BINARY)
+        members[i % len(CHANNELS)] += 1
+    drain(socks)
+
+    text = "x" * message_size
+    outgoing: dict[socket, memoryview] = {}
+    expected: dict[socket, int] = {}
+    decoders: dict[socket, shared.FrameDecoder] = {}
+    for i, sock in enumerate(socks):
+        channel = i % len(CHANNELS)
+        frame = shared.encode(commands.CmdSendMessage(text, CHANNELS[channel]), BINARY)
+        outgoing[sock] = memoryview(frame * messages)
+        expected[sock] = members[channel] * messages
+        decoders[sock] = shared.FrameDecoder()
+
+    deliveries = sum(expected.values())
+    start = time.perf_counter()
+
+    with DefaultSelector() as sel:
+        for sock in socks:
+            _ = sel.register(sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+
+        remaining = len(socks)
+        while remaining:
+            for key, mask in sel.select():
+                sock = key.fileobj
+                if mask & selectors.EVENT_WRITE:
+                    buf = outgoing[sock]
+                    try:
+                        sent = sock.send(buf)
+                    except BlockingIOError:
+                        sent = 0
+                    outgoing[sock] = buf = buf[sent:]
+                    if not buf:
+                        _ = sel.modify(sock, selectors.EVENT_READ)
+
+                if mask & selectors.EVENT_READ:
+                    try:
+                        frames = decoders[sock].feed(sock)
+                    except BlockingIOError:
+                        continue
+                    if frames is None:
+                        raise ConnectionResetError("Server closed a benchmark connection")
+
+                    expected[sock] -= len(frames)
+                    if expected[sock] == 0:
+                        remaining -= 1
+
+    elapsed = time.perf_counter() - start
+    for sock in socks:
+        sock.close()
+    return elapsed, clients * messages, deliveries
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure server throughput as the number of worker threads grows')
+    _ = parser.add_argument('-w', '--workers', help='Comma-separated worker counts to try', default='1,2,3,4,8')
+    _ = parser.add_argument('-c', '--clients', help='Number of clients', type=int, default=30)
+    _ = parser.add_argument('-n', '--messages', help='Messages sent by each client', type=int, default=200)
+    _ = parser.add_argument('-m', '--message-size', help='Length of chat message text in bytes', type=int, default=100)
+    _ = parser.add_argument('-p', '--port', help='Port for the benchmark server', type=int, default=23999)
+    args = parser.parse_args()
+
+    print(f"{'workers':>8} {'commands/s':>12} {'deliveries/s':>14}")
+    for workers in (int(w) for w in args.workers.split(',')):
+        server = start_server(args.port, ['-w', str(workers), '--high-water', str(1 << 30), *NO_LIMITS])
+        try:
+            elapsed, sent, delivered = run_round(args.port, args.clients, args.messages, args.message_size)
+        finally:
+            server.terminate()
+            _ = server.wait()
+
+        print(f"{workers:>8} {sent / elapsed:>12.0f} {delivered / elapsed:>14.0f}")
@@ -0,0 +1,374 @@
+import asyncio
+
+import random
+
+from src.protocol import commands
+from src.protocol import events
+from src.protocol import handshake
+from src.protocol import shared
+from src.protocol.codec import BINARY
+from src.protocol.compression import ZLIB, Compressor
+
+class CommandError(Exception):
+    """
+    The server refused a command. The message is the server's reason.
+    """
+
+# Events that answer a command and only go to the client that sent it. They
+# are returned by the command instead of being yielded by the client.
+RESULTS: dict[type[commands.CommandObject], type[events.EventObject]] = {
+    commands.CmdList: events.EventList,
+    commands.CmdListChannels: events.EventChannelList,
+    commands.CmdHistory: events.EventHistory,
+    commands.CmdStats: events.EventStats,
+    commands.CmdProfile: events.EventProfile,
+}
+
+class _Protocol(asyncio.BufferedProtocol):
+    """
+    One connection of an `AsyncChatClient`. Forwards everything to it.
+    """
+    __slots__ = ('client', 'decoder', 'transport')
+
+    def __init__(self, client: 'AsyncChatClient'):
+        self.client: AsyncChatClient = client
+        self.decoder: shared.FrameDecoder = shared.FrameDecoder()
+        self.transport: asyncio.Transport | None = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        return self.decoder.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        try:
+            frames = self.decoder.advance(nbytes)
+        except ValueError:
+            # Oversized or corrupt frame; connection_lost follows
+            self.transport.abort()
+            return
+        self.client._receive(self, frames)
+
+    def eof_received(self):
+        return False
+
+    def connection_lost(self, exc):
+        self.client._lost(self)
+
+class AsyncChatClient:
+    """
+    Chat client for programs rather than people, such as bots and bridges.
+
+    Commands are coroutines that return once the server has handled them, and
+    raise `CommandError` if it refused. They don't wait for each other: start
+    many at once (with `asyncio.gather` or tasks) and they share the
+    connection, up to `max_pending` in flight. Everything else the server
+    sends, such as messages in joined channels, is yielded by iterating over
+    the client:
+
+        async with AsyncChatClient('localhost', 12345, nickname='bot') as client:
+            await client.join('General')
+            async for event in client:
+                ...
+
+    If the connection drops, the client reconnects with exponential backoff,
+    then takes back its nickname and rejoins its channels. Commands in flight
+    when it dropped raise ConnectionError; new ones wait for the reconnect.
+
+    With `presence`, servers that batch presence changes send them as
+    `EventPresenceDelta` instead of `EventJoin`, `EventLeave` and `EventNick`.
+
+    Needs a server that supports acks (see `handshake.ACKS`).
+    """
+
+    def __init__(self, host: str, port: int, nickname: str | None = None, reconnect: bool = True,
+                 min_backoff: float = 0.5, max_backoff: float = 30.0, max_pending: int = 1000,
+                 max_events: int = 10000, compression: bool = True, presence: bool = False):
+        self.host: str = host
+        self.port: int = port
+
+        # The nickname and channels to restore after reconnecting. Updated as
+        # commands succeed.
+        self.nickname: str | None = nickname
+        self.channels: set[str] = set()
+
+        # Delay before reconnecting: a random part of a window that starts at
+        # min_backoff and doubles after every failed attempt, up to
+        # max_backoff
+        self.reconnect: bool = reconnect
+        self.min_backoff: float = min_backoff
+        self.max_backoff: float = max_backoff
+        self.reconnects: int = 0
+
+        # Agreed on in the handshake
+        self.compression: bool = compression
+        self.presence: bool = presence
+        self.codec: shared.Codec = BINARY
+        self.compressor: Compressor | None = None
+
+        self.protocol: _Protocol | None = None
+        self.connected: asyncio.Event = asyncio.Event()
+        self.closed: bool = False
+        self.welcome: asyncio.Future | None = None
+        self.reconnect_task: asyncio.Task | None = None
+
+        # Commands sent on the current connection and not acked yet, by number,
+        # as [command, future, result]. The server runs a client's commands in
+        # order, so the oldest is the one any result belongs to.
+        self.seq: int = 0
+        self.pending: dict[int, list] = {}
+        self.slots: asyncio.Semaphore = asyncio.Semaphore(max_pending)
+
+        # Frames written together at the end of the event loop iteration
+        self.outgoing: list[bytes] = []
+        self.flush_scheduled: bool = False
+
+        # Events waiting to be iterated over. When full, the oldest are
+        # dropped, so a client that never iterates doesn't grow forever. None
+        # marks the end.
+        self.events: asyncio.Queue[events.EventObject | None] = asyncio.Queue()
+        self.max_events: int = max_events
+        self.dropped_events: int = 0
+
+    async def __aenter__(self) -> 'AsyncChatClient':
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> events.EventObject:
+        event = await self.events.get()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+    async def connect(self, timeout: float = 10.0):
+        """
+        Connect and complete the handshake, then take the nickname and rejoin
+        the channels, if there are any.
+        """
+        loop = asyncio.get_running_loop()
+        self.welcome = loop.create_future()
+        transport, _ = await asyncio.wait_for(
+            loop.create_connection(lambda: _Protocol(self), self.host, self.port), timeout
+        )
+
+        compressions = (ZLIB.id,) if self.compression else ()
+        features = handshake.ACKS | handshake.HEARTBEAT | (handshake.PRESENCE if self.presence else 0)
+        transport.write(shared.frame(handshake.hello((BINARY.version,), compressions, features)))
+        try:
+            await asyncio.wait_for(self.welcome, timeout)
+        except BaseException:
+            transport.abort()
+            raise
+
+        self.connected.set()
+        if self.nickname is not None:
+            self._restore(commands.CmdNick(self.nickname))
+        for channel in self.channels:
+            self._restore(commands.CmdJoin(channel))
+
+    async def close(self):
+        """
+        Disconnect for good. Iteration ends once the remaining events are
+        consumed.
+        """
+        self.closed = True
+        if self.reconnect_task is not None:
+            _ = self.reconnect_task.cancel()
+
+        protocol = self.protocol
+        if protocol is not None:
+            self._flush()
+            protocol.transport.close()
+            self._lost(protocol)
+        else:
+            self._push(None)
+
+    # Commands. Each waits for a free slot and a connection, sends, and waits
+    # for the server to finish with it.
+
+    async def nick(self, nickname: str):
+        _ = await self.request(commands.CmdNick(nickname))
+
+    async def join(self, channel: str):
+        _ = await self.request(commands.CmdJoin(channel))
+
+    async def leave(self, channel: str):
+        _ = await self.request(commands.CmdLeave(channel))
+
+    async def send(self, channel: str, message: str):
+        _ = await self.request(commands.CmdSendMessage(message, channel))
+
+    async def list(self) -> events.EventList:
+        return await self.request(commands.CmdList())
+
+    async def list_channels(self, prefix: str = '', after: str = '', limit: int = 100) -> events.EventChannelList:
+        return await self.request(commands.CmdListChannels(prefix, after, limit))
+
+    async def history(self, channel: str, before: int = 0, limit: int = 50) -> events.EventHistory:
+        """
+        The messages themselves are yielded by iterating over the client.
+        """
+        return await self.request(commands.CmdHistory(channel, before, limit))
+
+    async def stats(self, token: str) -> str:
+        return (await self.request(commands.CmdStats(token))).report
+
+    async def profile(self, token: str, seconds: int = 10, allocations: bool = False) -> tuple[str, ...]:
+        """
+        Start a profile of the server. Returns the paths of the files on the
+        server that the results will be written to once it is done.
+        """
+        return (await self.request(commands.CmdProfile(token, seconds, allocations))).files
+
+    async def request(self, command: commands.CommandObject):
+        async with self.slots:
+            while not self.connected.is_set():
+                if self.closed:
+                    raise ConnectionError("Client is closed")
+                await self.connected.wait()
+            return await self.submit(command)
+
+    def submit(self, command: commands.CommandObject) -> asyncio.Future:
+        """
+        Send a command now, without waiting for a slot. Returns a future for
+        the command's result. Raises ConnectionError if not connected.
+        """
+        if self.protocol is None:
+            raise ConnectionError("Not connected")
+
+        future = asyncio.get_running_loop().create_future()
+        self.seq += 1
+        self.pending[self.seq] = [command, future, None]
+        self._write(shared.encode(command, self.codec, self.compressor))
+        return future
+
+    # Re-issue a command after reconnecting. Failures are not worth raising:
+    # the nickname may still be held by the dead connection, say.
+    def _restore(self, command: commands.CommandObject):
+        future = self.submit(command)
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+    def _write(self, frame: bytes):
+        self.outgoing.append(frame)
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush)
+
+    def _flush(self):
+        self.flush_scheduled = False
+        if self.outgoing and self.protocol is not None:
+            self.protocol.transport.write(b''.join(self.outgoing))
+        self.outgoing.clear()
+
+    def _push(self, event: events.EventObject | None):
+        if self.events.qsize() >= self.max_events:
+            _ = self.events.get_nowait()
+            self.dropped_events += 1
+        self.events.put_nowait(event)
+
+    def _receive(self, protocol: _Protocol, frames):
+        for payload in frames:
+            if protocol is not self.protocol:
+                # The first frame is the server's welcome
+                if self.welcome.done():
+                    return
+                try:
+                    self.codec, self.compressor, features = handshake.parse_welcome(payload)
+                    if not features & handshake.ACKS:
+                        raise ConnectionRefusedError("Server does not support acks")
+                except Exception as e:
+                    self.welcome.set_exception(e)
+                    protocol.transport.abort()
+                    return
+
+                protocol.decoder.compressor = self.compressor
+                self.protocol = protocol
+                self.seq = 0
+                self.welcome.set_result(None)
+                continue
+
+            self._handle_event(shared.decode(payload, self.codec))
+
+    def _handle_event(self, event: events.EventObject):
+        event_type = type(event)
+        if event_type is events.EventAck:
+            self._ack(event)
+
+        elif event_type is events.EventPing:
+            # Not a numbered command, so it bypasses submit()
+            self._write(shared.encode(commands.CmdPong(), self.codec, self.compressor))
+
+        else:
+            if self.pending:
+                entry = next(iter(self.pending.values()))
+                if RESULTS.get(type(entry[0])) is event_type:
+                    entry[2] = event
+                    return
+            self._push(event)
+
+    def _ack(self, ack: events.EventAck):
+        entry = self.pending.pop(ack.seq, None)
+        if entry is None:
+            return
+        command, future, result = entry
+
+        if ack.error:
+            if not future.done():
+                future.set_exception(CommandError(ack.error))
+            return
+
+        match command:
+            case commands.CmdNick(nickname=nickname):
+                self.nickname = nickname
+            case commands.CmdJoin(channel=channel):
+                self.channels.add(channel)
+            case commands.CmdLeave(channel=channel):
+                self.channels.discard(channel)
+
+        if not future.done():
+            future.set_result(result)
+
+    def _lost(self, protocol: _Protocol):
+        if protocol is not self.protocol:
+            # Failed during the handshake
+            if self.welcome is not None and not self.welcome.done():
+                self.welcome.set_exception(ConnectionResetError("Connection closed during handshake"))
+            return
+
+        self.protocol = None
+        self.connected.clear()
+        self.outgoing.clear()
+
+        # They may or may not have run
+        pending = self.pending
+        self.pending = {}
+        for _, future, _ in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Connection lost"))
+
+        if self.closed or not self.reconnect:
+            self.closed = True
+            self._push(None)
+            # Wake requests waiting for a connection, so they fail
+            self.connected.set()
+            self.connected.clear()
+        else:
+            self.reconnect_task = asyncio.get_running_loop().create_task(self._reconnect())
+
+    async def _reconnect(self):
+        window = self.min_backoff
+        while not self.closed:
+            await asyncio.sleep(random.uniform(0, window))
+            try:
+                await self.connect()
+                self.reconnects += 1
+                return
+            except (OSError, ValueError, asyncio.TimeoutError):
+                window = min(window * 2, self.max_backoff)
@@ -7,7 +7,9 @@ import threading
 
 from src.protocol import commands
 from src.protocol import events
+from src.protocol import handshake
 from src.protocol import shared
+from src.protocol.compression import Compressor
 
 
 help_block = '''
@@ -23,12 +25,27 @@ Format: /command-name <parameter> [optional parameter]
 /list
 \tList channels and number of users
 
+/channels [prefix] [after]
+\tList channels whose names start with <prefix> (or all, if it is omitted
+\tor *), with their member counts, a page at a time
+
 /join <channel>
-\tJoin a channel
+\tJoin a channel, creating it if it doesn't exist
 
 /leave [channel]
 \tLeave the current (or named, if provided) channel
 
+/history [channel] [before]
+\tShow recent messages of the current (or named) channel, older than
+\tmessage number <before> if provided
+
+/stats <token>
+\tShow the server's metrics (requires the server's admin token)
+
+/profile <token> [seconds] [allocations]
+\tProfile the server for <seconds> (default 10), tracing memory allocations
+\ttoo if 'allocations' follows (requires the server's admin token)
+
 /quit
 \tLeave chat, disconnect from server, and exit
 
@@ -52,9 +69,25 @@ class ChatClient:
         # Track the currently active channel.
         self.channel: str = ""
 
+        # Wire format and compression agreed on with the server when connecting.
+        self.codec: shared.Codec = shared.PICKLE
+        self.compressor: Compressor | None = None
+
+        # Both the input and listener threads send; pings are answered by the
+        # listener thread.
+        self.send_lock: threading.Lock = threading.Lock()
+
+        # Prefix of the last /channels listing, to suggest the next page
+        self.list_prefix: str = ''
+
     def connect(self, target_host: str, target_port: int):
         sock = socket(sckt.AF_INET, sckt.SOCK_STREAM)
         sock.connect((target_host, target_port))
+        try:
+            self.codec, self.compressor, _ = handshake.negotiate(sock, features=handshake.HEARTBEAT | handshake.PRESENCE)
+        except Exception:
+            sock.close()
+            raise
         self.connection = sock
 
         self.listener = threading.Thread(target=self.listener_thread, daemon=True)
@@ -68,16 +101,22 @@ class ChatClient:
         self.listener = None
 
     def listener_thread(self):
+        # The server may write many frames in a single call, so read whatever
+        # has arrived and handle every complete frame in it
+        decoder = shared.FrameDecoder()
+        decoder.compressor = self.compressor
+
         while self.connection is not None:
             try:
-                event = shared.receive(self.connection)
+                frames = decoder.feed(self.connection)
 
-                if event is None:
+                if frames is None:
                     print("\nDisconnected.")
                     self.disconnect()
                     break
                 else:
-                    self.handle_event(event)
+                    for payload in frames:
+                        self.handle_event(shared.decode(payload, self.codec))
 
             except Exception as e:
                 print(f"Unexpected error in listener thread: {e}")
@@ -85,7 +124,8 @@ class ChatClient:
 
     def send_to_server(self, msg: commands.CommandObject):
         if self.connection:
-            shared.send(msg, self.connection)
+            with self.send_lock:
+                shared.send(msg, self.connection, self.codec, self.compressor)
         else:
             print(f"Error: Not connected.", file=stderr)
 
@@ -109,6 +149,8 @@ class ChatClient:
                     print(f"Error: Not enough arguments. Expected server name.", file=stderr)
                 except ConnectionRefusedError:
                     print(f"Error: Connection refused", file=stderr)
+                except (ConnectionError, ValueError) as e:
+                    print(f"Error: Handshake failed: {e}", file=stderr)
 
             case 'nick':
                 try:
@@ -119,6 +161,12 @@ class ChatClient:
             case 'list':
                 self.send_to_server(commands.CmdList())
 
+            case 'channels':
+                prefix = command_parts[1] if len(command_parts) > 1 and command_parts[1] != '*' else ''
+                after = command_parts[2] if len(command_parts) > 2 else ''
+                self.send_to_server(commands.CmdListChannels(prefix, after))
+                self.list_prefix = prefix
+
             case 'join':
                 try:
                     self.send_to_server(commands.CmdJoin(command_parts[1]))
@@ -129,6 +177,30 @@ class ChatClient:
                 target_channel = command_parts[1] if len(command_parts) > 1 else self.channel
                 self.send_to_server(commands.CmdLeave(target_channel))
 
+            case 'history':
+                target_channel = command_parts[1] if len(command_parts) > 1 else self.channel
+                try:
+                    before = int(command_parts[2]) if len(command_parts) > 2 else 0
+                    self.send_to_server(commands.CmdHistory(target_channel, before))
+                except ValueError:
+                    print(f"Error: Expected a message number.", file=stderr)
+
+            case 'stats':
+                try:
+                    self.send_to_server(commands.CmdStats(command_parts[1]))
+                except IndexError:
+                    print(f"Error: Not enough arguments. Expected admin token.", file=stderr)
+
+            case 'profile':
+                try:
+                    seconds = int(command_parts[2]) if len(command_parts) > 2 else 10
+                    allocations = len(command_parts) > 3 and command_parts[3] == 'allocations'
+                    self.send_to_server(commands.CmdProfile(command_parts[1], seconds, allocations))
+                except IndexError:
+                    print(f"Error: Not enough arguments. Expected admin token.", file=stderr)
+                except ValueError:
+                    print(f"Error: Expected a number of seconds.", file=stderr)
+
             case 'quit':
                 self.disconnect()
 
@@ -155,6 +227,12 @@ class ChatClient:
                 for channel in channels:
                     print(channel)
 
+            case events.EventChannelList(channels=channels, members=members, next_after=next_after):
+                for channel, count in zip(channels, members):
+                    print(f"{channel} ({count} members)")
+                if next_after:
+                    print(f"Use '/channels {self.list_prefix or '*'} {next_after}' for more.")
+
             case events.EventJoin(new_user_nick=new_user_nick, channel=channel):
                 print(f"{new_user_nick} has joined {channel}.")
 
@@ -164,6 +242,30 @@ class ChatClient:
             case events.EventLeave(left_user_nick=left_user_nick, channel=channel):
                 print(f"{left_user_nick} has left {channel}")
 
+            case events.EventPresenceDelta(channel=channel, joined=joined, left=left,
+                                           renamed_from=renamed_from, renamed_to=renamed_to):
+                for old_nick, new_nick in zip(renamed_from, renamed_to):
+                    print(f"{old_nick} changed name to {new_nick}")
+                if left:
+                    print(f"{', '.join(left)} {'has' if len(left) == 1 else 'have'} left {channel}")
+                if joined:
+                    print(f"{', '.join(joined)} {'has' if len(joined) == 1 else 'have'} joined {channel}.")
+
+            case events.EventHistory(channel=channel, count=count, next_before=next_before):
+                if next_before:
+                    print(f"[{channel}] {count} earlier messages. Use '/history {channel} {next_before}' for more.")
+                else:
+                    print(f"[{channel}] {count} earlier messages.")
+
+            case events.EventPing():
+                self.send_to_server(commands.CmdPong())
+
+            case events.EventStats(report=report):
+                print(report, end='')
+
+            case events.EventProfile(files=files):
+                print(f"[Server] Profiling; the results will be in {', '.join(files)}")
+
             case events.EventError(error=error):
                 print(f"[Server] ERROR: {error}")
 
@@ -0,0 +1,222 @@
+from collections.abc import Callable
+from typing import Any, get_type_hints
+
+from . import commands
+from . import events
+from .shared import Codec, ProtocolObject
+
+# Type tags are part of the wire format: never renumber an existing entry, only
+# add new ones. Commands live below 0x80, events at 0x80 and above.
+MESSAGE_TYPES: dict[int, type[ProtocolObject]] = {
+    0x01: commands.CmdList,
+    0x02: commands.CmdNick,
+    0x03: commands.CmdJoin,
+    0x04: commands.CmdLeave,
+    0x05: commands.CmdSendMessage,
+    0x06: commands.CmdHistory,
+    0x07: commands.CmdStats,
+    0x08: commands.CmdPong,
+    0x09: commands.CmdListChannels,
+    0x0a: commands.CmdProfile,
+
+    0x81: events.EventReceiveMessage,
+    0x82: events.EventList,
+    0x83: events.EventNick,
+    0x84: events.EventJoin,
+    0x85: events.EventLeave,
+    0x86: events.EventError,
+    0x87: events.EventHistory,
+    0x88: events.EventStats,
+    0x89: events.EventPing,
+    0x8a: events.EventChannelList,
+    0x8b: events.EventAck,
+    0x8c: events.EventProfile,
+    0x8d: events.EventPresenceDelta,
+}
+
+Writer = Callable[[bytearray, Any], None]
+Reader = Callable[[memoryview, int], tuple[Any, int]]
+
+def _write_varint(out: bytearray, n: int):
+    # Unsigned LEB128: 7 bits per byte, high bit set on all but the last byte
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def _read_varint(buf: memoryview, pos: int) -> tuple[int, int]:
+    byte = buf[pos]
+    pos += 1
+    if byte < 0x80:
+        return byte, pos
+
+    result = byte & 0x7f
+    shift = 7
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+def _write_str(out: bytearray, value: str):
+    data = value.encode()
+    if len(data) < 0x80:
+        out.append(len(data))
+    else:
+        _write_varint(out, len(data))
+    out += data
+
+def _read_str(buf: memoryview, pos: int) -> tuple[str, int]:
+    # Inline the common single-byte length case
+    length = buf[pos]
+    if length < 0x80:
+        pos += 1
+    else:
+        length, pos = _read_varint(buf, pos)
+    end = pos + length
+    if end > len(buf):
+        raise ValueError("Truncated string field")
+    return str(buf[pos:end], 'utf-8'), end
+
+def _write_bytes(out: bytearray, value: bytes):
+    _write_varint(out, len(value))
+    out += value
+
+def _read_bytes(buf: memoryview, pos: int) -> tuple[bytes, int]:
+    length, pos = _read_varint(buf, pos)
+    end = pos + length
+    if end > len(buf):
+        raise ValueError("Truncated bytes field")
+    return bytes(buf[pos:end]), end
+
+def _write_text(out: bytearray, value: Any):
+    # Fields typed `Any` (such as EventError.error) travel as their text
+    _write_str(out, str(value))
+
+def _write_int(out: bytearray, value: int):
+    # Zigzag, so small negative numbers stay small
+    _write_varint(out, (value << 1) if value >= 0 else ((-value << 1) - 1))
+
+def _read_int(buf: memoryview, pos: int) -> tuple[int, int]:
+    raw, pos = _read_varint(buf, pos)
+    return (raw >> 1) if not raw & 1 else -((raw + 1) >> 1), pos
+
+def _write_bool(out: bytearray, value: bool):
+    out.append(1 if value else 0)
+
+def _read_bool(buf: memoryview, pos: int) -> tuple[bool, int]:
+    return buf[pos] != 0, pos + 1
+
+def _write_strs(out: bytearray, value: tuple[str, ...]):
+    _write_varint(out, len(value))
+    for item in value:
+        _write_str(out, item)
+
+def _read_strs(buf: memoryview, pos: int) -> tuple[tuple[str, ...], int]:
+    count, pos = _read_varint(buf, pos)
+    items: list[str] = []
+    for _ in range(count):
+        item, pos = _read_str(buf, pos)
+        items.append(item)
+    return tuple(items), pos
+
+def _write_ints(out: bytearray, value: tuple[int, ...]):
+    _write_varint(out, len(value))
+    for item in value:
+        _write_int(out, item)
+
+def _read_ints(buf: memoryview, pos: int) -> tuple[tuple[int, ...], int]:
+    count, pos = _read_varint(buf, pos)
+    items: list[int] = []
+    for _ in range(count):
+        item, pos = _read_int(buf, pos)
+        items.append(item)
+    return tuple(items), pos
+
+# Annotation -> (writer, reader). `bool` must be matched before `int`.
+_FIELD_TYPES: tuple[tuple[Any, Writer, Reader], ...] = (
+    (bool, _write_bool, _read_bool),
+    (int, _write_int, _read_int),
+    (str, _write_str, _read_str),
+    (bytes, _write_bytes, _read_bytes),
+    (tuple[str, ...], _write_strs, _read_strs),
+    (tuple[int, ...], _write_ints, _read_ints),
+    (Any, _write_text, _read_str),
+)
+
+def _field_codec(cls: type, name: str, annotation: Any) -> tuple[Writer, Reader]:
+    for field_type, writer, reader in _FIELD_TYPES:
+        if annotation == field_type:
+            return writer, reader
+    raise TypeError(f"{cls.__name__}.{name}: no binary encoding for {annotation}")
+
+def _slots(cls: type) -> tuple[str, ...]:
+    slots = cls.__dict__.get('__slots__', ())
+    # A bare string is a single slot, not a sequence of one-letter slots
+    return (slots,) if isinstance(slots, str) else tuple(slots)
+
+class BinaryCodec(Codec):
+    """
+    Compact, schema-driven wire format. A message is a one-byte type tag from
+    `MESSAGE_TYPES` followed by the message's `__slots__` in declaration order.
+    Strings are UTF-8 prefixed with their varint length; integers are zigzag
+    varints. The field types come from the `__init__` annotations.
+
+    Unlike pickle, decoding can only ever produce the registered classes.
+    """
+    __slots__ = ('encoders', 'decoders')
+
+    version = 1
+    name = 'binary'
+
+    def __init__(self, message_types: dict[int, type[ProtocolObject]]):
+        self.encoders: dict[type, tuple[int, tuple[tuple[str, Writer], ...]]] = {}
+        self.decoders: dict[int, tuple[type, tuple[tuple[str, Reader], ...]]] = {}
+
+        for tag, cls in message_types.items():
+            hints = get_type_hints(cls.__init__)
+            writers: list[tuple[str, Writer]] = []
+            readers: list[tuple[str, Reader]] = []
+            for name in _slots(cls):
+                writer, reader = _field_codec(cls, name, hints[name])
+                writers.append((name, writer))
+                readers.append((name, reader))
+
+            self.encoders[cls] = (tag, tuple(writers))
+            self.decoders[tag] = (cls, tuple(readers))
+
+    def dumps(self, data: ProtocolObject) -> bytes:
+        try:
+            tag, fields = self.encoders[type(data)]
+        except KeyError:
+            raise TypeError(f"No binary encoding for {type(data).__name__}") from None
+
+        out = bytearray((tag,))
+        for name, write in fields:
+            write(out, getattr(data, name))
+        return bytes(out)
+
+    def loads(self, payload) -> ProtocolObject:
+        buf = memoryview(payload)
+        try:
+            cls, fields = self.decoders[buf[0]]
+        except (KeyError, IndexError):
+            raise ValueError("Unknown message type") from None
+
+        # Skip __init__; every slot is filled in below
+        obj = cls.__new__(cls)
+        pos = 1
+        try:
+            for name, read in fields:
+                value, pos = read(buf, pos)
+                setattr(obj, name, value)
+        except IndexError:
+            raise ValueError(f"Truncated {cls.__name__}") from None
+
+        if pos != len(buf):
+            raise ValueError(f"Trailing bytes after {cls.__name__}")
+        return obj
+
+BINARY = BinaryCodec(MESSAGE_TYPES)
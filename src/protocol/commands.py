@@ -16,7 +16,7 @@ class CmdNick(CommandObject):
     """
     Command: Change nickname.
     """
-    __slots__ = ('nickname')
+    __slots__ = ('nickname',)
 
     def __init__(self, nickname: str):
         self.nickname: str = nickname
@@ -25,7 +25,7 @@ class CmdJoin(CommandObject):
     """
     Command: Join a new channel.
     """
-    __slots__ = ('channel')
+    __slots__ = ('channel',)
 
     def __init__(self, channel: str):
         self.channel: str = channel
@@ -34,7 +34,7 @@ class CmdLeave(CommandObject):
     """
     Command: Leave the chosen channel, or all channels.
     """
-    __slots__ = ('channel')
+    __slots__ = ('channel',)
 
     def __init__(self, channel: str):
         self.channel: str = channel
@@ -49,5 +49,61 @@ class CmdSendMessage(CommandObject):
         self.message: str = message
         self.channel: str = channel
 
+class CmdHistory(CommandObject):
+    """
+    Command: Fetch recent messages of a channel the client is in. Returns up
+    to `limit` messages older than the message numbered `before` (0 for the
+    newest), followed by an `EventHistory`.
+    """
+    __slots__ = ('channel', 'before', 'limit')
+
+    def __init__(self, channel: str, before: int = 0, limit: int = 50):
+        self.channel: str = channel
+        self.before: int = before
+        self.limit: int = limit
+
+class CmdStats(CommandObject):
+    """
+    Command: Fetch the server's metrics. Only allowed with the server's admin
+    token.
+    """
+    __slots__ = ('token',)
+
+    def __init__(self, token: str):
+        self.token: str = token
+
+class CmdPong(CommandObject):
+    """
+    Command: Answer an `EventPing`, showing the client is still there. Only
+    sent by clients that negotiated heartbeats.
+    """
+    __slots__ = ()
+
+class CmdListChannels(CommandObject):
+    """
+    Command: List channels in name order, with their member counts. Returns
+    up to `limit` channels whose names start with `prefix` and sort after
+    `after` ('' for the first page), as an `EventChannelList`.
+    """
+    __slots__ = ('prefix', 'after', 'limit')
+
+    def __init__(self, prefix: str = '', after: str = '', limit: int = 100):
+        self.prefix: str = prefix
+        self.after: str = after
+        self.limit: int = limit
+
+class CmdProfile(CommandObject):
+    """
+    Command: Profile the server for `seconds`, optionally tracing memory
+    allocations too. Only allowed with the server's admin token. The results
+    are written to files on the server, named in the `EventProfile` answer.
+    """
+    __slots__ = ('token', 'seconds', 'allocations')
+
+    def __init__(self, token: str, seconds: int = 10, allocations: bool = False):
+        self.token: str = token
+        self.seconds: int = seconds
+        self.allocations: bool = allocations
+
 # Commands `connect`, `quit`, and `help` can be handled locally and do not need
 # to be sent to the server, so we don't define objects for them
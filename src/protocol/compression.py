@@ -0,0 +1,76 @@
+import zlib
+
+class Compressor:
+    """
+    Base class for frame compression algorithms. Which one a connection uses,
+    if any, is agreed on during the handshake (see `src.protocol.handshake`),
+    identified by `id`.
+
+    Compression is per frame and optional: a peer only compresses frames
+    whose payload is at least its threshold, and marks them with a flag in the
+    length header (see `shared.frame`). Either side may send any frame
+    uncompressed.
+    """
+    __slots__ = ()
+
+    id: int = 0
+    name: str = ''
+
+    def compress(self, payload) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, data, max_size: int) -> bytes:
+        """
+        Decompress one payload. Raises ValueError if the data is corrupt or
+        would expand to more than `max_size` bytes.
+        """
+        raise NotImplementedError
+
+    def __repr__(self):
+        return f"{type(self).__name__}(id={self.id})"
+
+class ZlibCompressor(Compressor):
+    """
+    DEFLATE via zlib. Chat text and pasted logs compress well even at the
+    fastest levels.
+    """
+    __slots__ = ('level',)
+
+    id = 1
+    name = 'zlib'
+
+    def __init__(self, level: int = 6):
+        self.level: int = level
+
+    def compress(self, payload) -> bytes:
+        return zlib.compress(payload, self.level)
+
+    def decompress(self, data, max_size: int) -> bytes:
+        # Cap the output, so a small frame can't expand into gigabytes
+        decompressor = zlib.decompressobj()
+        try:
+            payload = decompressor.decompress(data, max_size)
+        except zlib.error as e:
+            raise ValueError(f"Corrupt compressed frame: {e}") from None
+
+        if decompressor.unconsumed_tail:
+            raise ValueError(f"Compressed frame expands beyond the {max_size} byte limit")
+        if not decompressor.eof:
+            raise ValueError("Truncated compressed frame")
+        return payload
+
+# Level 1: on chat and log text it gets most of the size reduction of the
+# default level (6) at two to three times the speed; see
+# `python -m src.bench.compression`.
+ZLIB = ZlibCompressor(1)
+
+# Sent in the welcome when no compression was agreed on
+NO_COMPRESSION = 0
+
+# New algorithms must be added here to be negotiable. Ids are part of the wire
+# format.
+COMPRESSORS: dict[int, Compressor] = {compressor.id: compressor for compressor in (ZLIB,)}
+
+# Smallest payload worth compressing. Below this, the CPU time isn't worth the
+# few bytes saved.
+DEFAULT_THRESHOLD = 1024
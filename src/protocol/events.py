@@ -77,12 +77,126 @@ class EventLeave(EventObject):
     def __str__(self):
         return f"EventLeave({self.left_user_nick}, {self.channel})"
 
+class EventPresenceDelta(EventObject):
+    """
+    Event: Clients joined or left a channel, or changed their nicknames,
+    during the last short while. Replaces `EventJoin`, `EventLeave` and
+    `EventNick` for clients that negotiated batched presence.
+    Response: Apply the renames (`renamed_from[i]` is now `renamed_to[i]`),
+    then the leaves, then the joins. Joins and leaves are listed under
+    nicknames as they stand after the renames. Renames come in an event with
+    an empty `channel` and go to every client; joins and leaves go to the
+    channel's members.
+    """
+    __slots__ = ('channel', 'joined', 'left', 'renamed_from', 'renamed_to')
+
+    def __init__(self, channel: str, joined: tuple[str, ...], left: tuple[str, ...],
+                 renamed_from: tuple[str, ...], renamed_to: tuple[str, ...]):
+        self.channel: str = channel
+        self.joined: tuple[str, ...] = joined
+        self.left: tuple[str, ...] = left
+        self.renamed_from: tuple[str, ...] = renamed_from
+        self.renamed_to: tuple[str, ...] = renamed_to
+
+    def __str__(self):
+        return (f"EventPresenceDelta({self.channel}, {len(self.joined)} joined, {len(self.left)} left, "
+                f"{len(self.renamed_to)} renamed)")
+
+class EventHistory(EventObject):
+    """
+    Event: Recent messages of a channel were just replayed, either because
+    the client joined it or asked with `CmdHistory`.
+    Response: Tell the client how many there were, and what to pass as
+    `before` to fetch the page before them (0 if there is nothing older).
+    """
+    __slots__ = ('channel', 'count', 'next_before')
+
+    def __init__(self, channel: str, count: int, next_before: int):
+        self.channel: str = channel
+        self.count: int = count
+        self.next_before: int = next_before
+
+    def __str__(self):
+        return f"EventHistory({self.channel}, {self.count}, {self.next_before})"
+
+class EventStats(EventObject):
+    """
+    Event: An admin asked for the server's metrics.
+    Response: Send the metrics report, as text.
+    """
+    __slots__ = ('report',)
+
+    def __init__(self, report: str):
+        self.report: str = report
+
+    def __str__(self):
+        return f"EventStats({len(self.report)} bytes)"
+
+class EventPing(EventObject):
+    """
+    Event: The client has been quiet for a while.
+    Response: Check that it is still there; it must answer with `CmdPong`.
+    Only sent to clients that negotiated heartbeats.
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        return "EventPing()"
+
+class EventChannelList(EventObject):
+    """
+    Event: A client asked for a page of channels with `CmdListChannels`.
+    Response: Give it the channel names and their member counts, and what to
+    pass as `after` to fetch the next page ('' if this was the last one).
+    """
+    __slots__ = ('channels', 'members', 'next_after')
+
+    def __init__(self, channels: tuple[str, ...], members: tuple[int, ...], next_after: str):
+        self.channels: tuple[str, ...] = channels
+        self.members: tuple[int, ...] = members
+        self.next_after: str = next_after
+
+    def __str__(self):
+        return f"EventChannelList({len(self.channels)} channels, {self.next_after!r})"
+
+class EventAck(EventObject):
+    """
+    Event: The server finished with a command from a client that negotiated
+    acks. Commands are numbered from 1 in the order the client sent them
+    (CmdPong excluded), and `seq` is the command's number.
+    Response: Tell the client whether the command succeeded: `error` is empty
+    if it did, or why it failed. It arrives after any events the command
+    produced for the client.
+    """
+    __slots__ = ('seq', 'error')
+
+    def __init__(self, seq: int, error: str):
+        self.seq: int = seq
+        self.error: str = error
+
+    def __str__(self):
+        return f"EventAck({self.seq}, {self.error!r})"
+
+class EventProfile(EventObject):
+    """
+    Event: An admin started a profile with `CmdProfile`.
+    Response: Tell them which files on the server the results will be written
+    to once it is done.
+    """
+    __slots__ = ('files',)
+
+    def __init__(self, files: tuple[str, ...]):
+        self.files: tuple[str, ...] = files
+
+    def __str__(self):
+        return f"EventProfile({', '.join(self.files)})"
+
 class EventError(EventObject):
     """
     Event: An error occurred.
     Response: Report the error to the relevant user(s).
     """
-    __slots__ = ('error')
+    __slots__ = ('error',)
 
     def __init__(self, error: Any):
         self.error: Any = error
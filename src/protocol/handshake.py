@@ -0,0 +1,116 @@
+import socket
+
+from .codec import BINARY
+from .compression import COMPRESSORS, NO_COMPRESSION, ZLIB, Compressor
+from .shared import PICKLE, Codec, frame, receive_payload
+
+# The first frame a client sends starts with these bytes. A pickle payload
+# always starts with b'\x80', so the two can never be confused.
+MAGIC = b'CHAT'
+
+# Sent by the server when the client offered nothing it accepts
+NO_VERSION = 0xff
+
+CODECS: dict[int, Codec] = {codec.version: codec for codec in (PICKLE, BINARY)}
+
+# Optional behaviours, as bits of the feature byte. A client sets the ones it
+# supports, and the server answers with the ones it will use.
+HEARTBEAT = 0x01 # The server sends EventPing when idle; the client answers CmdPong
+ACKS = 0x02 # The server answers every command with an EventAck
+PRESENCE = 0x04 # The server batches joins, leaves and renames into EventPresenceDelta
+
+def hello(versions: tuple[int, ...], compressions: tuple[int, ...] = (), features: int = 0) -> bytes:
+    """
+    Build the payload of a client hello: the magic bytes, then the codec
+    versions the client supports, then the compression algorithms it
+    supports, each as a count followed by ids in order of preference, then
+    the feature bits it supports.
+    """
+    return MAGIC + bytes((len(versions), *versions, len(compressions), *compressions, features))
+
+def is_hello(payload) -> bool:
+    return bytes(payload[:len(MAGIC)]) == MAGIC
+
+def parse_hello(payload) -> tuple[tuple[int, ...], tuple[int, ...], int]:
+    """
+    Return the codec versions, compression algorithms and feature bits
+    offered in a client hello. Older clients leave out the later fields,
+    which means they offer none.
+    """
+    body = bytes(payload[len(MAGIC):])
+    if not body or len(body) < 1 + body[0]:
+        raise ValueError("Malformed hello")
+    versions = tuple(body[1:1 + body[0]])
+
+    rest = body[1 + body[0]:]
+    if rest and len(rest) < 1 + rest[0]:
+        raise ValueError("Malformed hello")
+    compressions = tuple(rest[1:1 + rest[0]]) if rest else ()
+
+    rest = rest[1 + rest[0]:] if rest else b''
+    features = rest[0] if rest else 0
+    return versions, compressions, features
+
+def choose(offered: tuple[int, ...], accepted: tuple[int, ...]) -> Codec | None:
+    """
+    Pick the first codec the client offered that the server accepts.
+    """
+    for version in offered:
+        if version in accepted and version in CODECS:
+            return CODECS[version]
+    return None
+
+def choose_compression(offered: tuple[int, ...], accepted: tuple[int, ...]) -> Compressor | None:
+    """
+    Pick the first compression algorithm the client offered that the server
+    accepts, or None to send everything uncompressed.
+    """
+    for compression in offered:
+        if compression in accepted and compression in COMPRESSORS:
+            return COMPRESSORS[compression]
+    return None
+
+def welcome(codec: Codec | None, compressor: Compressor | None = None, features: int = 0) -> bytes:
+    """
+    Build the payload of the server's reply to a hello.
+    """
+    return MAGIC + bytes((
+        codec.version if codec is not None else NO_VERSION,
+        compressor.id if compressor is not None else NO_COMPRESSION,
+        features,
+    ))
+
+def parse_welcome(payload) -> tuple[Codec, Compressor | None, int]:
+    """
+    Return the codec, compression algorithm and feature bits the server
+    picked. Older servers leave out the later fields, which means none.
+    """
+    if not is_hello(payload) or len(payload) < len(MAGIC) + 1:
+        raise ValueError("Malformed welcome")
+
+    version = payload[len(MAGIC)]
+    if version not in CODECS:
+        raise ConnectionRefusedError("Server does not support any offered protocol version")
+
+    compressor = None
+    if len(payload) > len(MAGIC) + 1 and payload[len(MAGIC) + 1] != NO_COMPRESSION:
+        compressor = COMPRESSORS.get(payload[len(MAGIC) + 1])
+        if compressor is None:
+            raise ValueError("Server picked a compression algorithm that was not offered")
+
+    features = payload[len(MAGIC) + 2] if len(payload) > len(MAGIC) + 2 else 0
+    return CODECS[version], compressor, features
+
+def negotiate(sock: socket.socket, versions: tuple[int, ...] = (BINARY.version, PICKLE.version),
+              compressions: tuple[int, ...] = (ZLIB.id,), features: int = 0) -> tuple[Codec, Compressor | None, int]:
+    """
+    Client side of the handshake, for blocking sockets. Sends a hello and
+    returns the codec, compression algorithm and feature bits the server
+    picked.
+    """
+    sock.sendall(frame(hello(versions, compressions, features)))
+
+    payload = receive_payload(sock)
+    if payload is None:
+        raise ConnectionResetError("Connection closed during handshake.")
+    return parse_welcome(payload)
@@ -1,4 +1,17 @@
 import pickle, socket, struct
+from collections.abc import Iterable
+
+from .compression import DEFAULT_THRESHOLD, Compressor
+
+# Every frame starts with the payload length.
+# ! = Big endian (network order), I = 4-byte integer
+_HEADER = struct.Struct('!I')
+
+# The top bit of the length is set if the payload is compressed. Frames are
+# never anywhere near 2 GiB, so the bit is free, and a peer that hasn't
+# negotiated compression never receives it set.
+COMPRESSED = 0x80000000
+_LENGTH_MASK = COMPRESSED - 1
 
 class ProtocolObject:
     """
@@ -6,48 +19,329 @@ class ProtocolObject:
     """
     pass
 
-def send(data: ProtocolObject, sock: socket.socket):
+class Codec:
     """
-    Send a message via a TCP socket. Uses length-prefixing to form discrete
-    messages.
+    Base class for wire formats. A codec turns a protocol object into the
+    payload of a frame and back. The codec used on a connection is agreed on
+    during the handshake (see `src.protocol.handshake`), identified by
+    `version`.
+    """
+    __slots__ = ()
+
+    version: int = -1
+    name: str = ''
+
+    def dumps(self, data: ProtocolObject) -> bytes:
+        raise NotImplementedError
+
+    def loads(self, payload) -> ProtocolObject:
+        raise NotImplementedError
+
+    def __repr__(self):
+        return f"{type(self).__name__}(version={self.version})"
+
+class PickleCodec(Codec):
+    """
+    The original wire format. Kept as a fallback for older peers; never decode
+    it from a peer you don't trust, since unpickling can execute code.
+    """
+    __slots__ = ()
+
+    version = 0
+    name = 'pickle'
+
+    def dumps(self, data: ProtocolObject) -> bytes:
+        return pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, payload) -> ProtocolObject:
+        return pickle.loads(payload)
+
+PICKLE = PickleCodec()
+
+def frame(payload: bytes, compressor: Compressor | None = None, threshold: int = DEFAULT_THRESHOLD) -> bytes:
     """
-    serialized_data = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+    Length-prefix an already serialized payload. With a compressor, payloads
+    of at least `threshold` bytes are compressed, unless that doesn't make
+    them smaller.
+    """
+    if compressor is not None and len(payload) >= threshold:
+        compressed = compressor.compress(payload)
+        if len(compressed) < len(payload):
+            return _HEADER.pack(len(compressed) | COMPRESSED) + compressed
 
     # Since we're using TCP, we must encode the length of the message before we
     # send it. Otherwise, the receiver would not know how long the message is.
-    # ! = Big endian (network order), I = 4-byte integer
-    length = struct.pack('!I', len(serialized_data))
+    return _HEADER.pack(len(payload)) + payload
+
+def encode(data: ProtocolObject, codec: Codec = PICKLE, compressor: Compressor | None = None) -> bytes:
+    """
+    Serialize a message and length-prefix it, producing a complete frame that
+    can be written to any number of sockets unchanged.
+    """
+    return frame(codec.dumps(data), compressor)
+
+def send(data: ProtocolObject, sock: socket.socket, codec: Codec = PICKLE, compressor: Compressor | None = None):
+    """
+    Send a message via a TCP socket. Uses length-prefixing to form discrete
+    messages.
+    """
+    sock.sendall(encode(data, codec, compressor))
 
-    sock.sendall(length + serialized_data)
+def send_frame(frame: bytes, sock: socket.socket):
+    """
+    Send a frame previously produced by `encode()`.
+    """
+    sock.sendall(frame)
+
+def broadcast(data: ProtocolObject, socks: Iterable[socket.socket], codec: Codec = PICKLE,
+              compressor: Compressor | None = None):
+    """
+    Send the same message to many sockets. The message is serialized, framed
+    and compressed exactly once, and that single buffer is written to every
+    socket.
+    """
+    frame = encode(data, codec, compressor)
+    for sock in socks:
+        sock.sendall(frame)
 
-def receive(sock: socket.socket):
+def decode(payload, codec: Codec = PICKLE) -> ProtocolObject:
     """
-    Receive a message sent via `send()` and decode it.
+    Deserialize the payload of a single frame (without its length header).
+    Accepts any bytes-like object, including `memoryview` slices.
     """
-    # Length header is 4 bytes (see `send` implementation)
-    length_bytes: bytes | None = _recv_n(sock, 4)
+    return codec.loads(payload)
+
+def receive(sock: socket.socket, codec: Codec = PICKLE, compressor: Compressor | None = None):
+    """
+    Receive a message sent via `send()` and decode it. Only suitable for
+    blocking sockets; use `FrameDecoder` with non-blocking ones.
+    """
+    payload = receive_payload(sock, compressor)
+    if payload is None:
+        return None
+
+    return decode(payload, codec)
+
+def receive_payload(sock: socket.socket, compressor: Compressor | None = None,
+                    max_frame: int = 16 << 20) -> bytes | bytearray | None:
+    """
+    Receive a single frame and return its payload, decompressed but not
+    decoded. Frames over `max_frame` bytes raise `ValueError`.
+    """
+    # Length header is 4 bytes (see `frame` implementation)
+    length_bytes: bytearray | None = _recv_n(sock, 4)
     if length_bytes is None:
         return None
-    length: int = struct.unpack('!I', length_bytes)[0]
+    length: int = _HEADER.unpack(length_bytes)[0]
+
+    # Checked before the buffer is allocated, as the peer picks the length
+    if length & _LENGTH_MASK > max_frame:
+        raise ValueError(f"Frame of {length & _LENGTH_MASK} bytes exceeds the {max_frame} byte limit")
 
-    raw_msg: bytes | None = _recv_n(sock, length)
+    raw_msg: bytearray | None = _recv_n(sock, length & _LENGTH_MASK)
     if raw_msg is None:
         raise ConnectionResetError("Connection closed unexpectedly.")
 
-    return pickle.loads(raw_msg)
+    if length & COMPRESSED:
+        return _decompress(raw_msg, compressor, max_frame)
+    return raw_msg
 
-def _recv_n(sock: socket.socket, n: int) -> bytes | None:
+def _decompress(data, compressor: Compressor | None, max_frame: int) -> bytes:
+    if compressor is None:
+        raise ValueError("Compressed frame on a connection without compression")
+    return compressor.decompress(data, max_frame)
+
+def _recv_n(sock: socket.socket, n: int) -> bytearray | None:
     """
     Internal helper function for `receive()`.
     """
-    res = bytearray()
+    # Receive straight into the final buffer, so the payload is never copied
+    res = bytearray(n)
+    view = memoryview(res)
+    received = 0
 
-    while len(res) < n:
-        packet = sock.recv(n - len(res))
-        if not packet:
-            if len(res) == 0:
+    while received < n:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            if received == 0:
                 return None
             raise ConnectionResetError("Connection closed unexpectedly.")
-        res.extend(packet)
+        received += count
+
+    return res
+
+class FrameDecoder:
+    """
+    Incremental decoder for length-prefixed frames arriving on a non-blocking
+    socket.
+
+    Each call to `feed()` performs a single `recv_into()` on a buffer that is
+    reused for the lifetime of the connection, then returns every frame that is
+    now complete. Partial headers and bodies are kept until the next call. The
+    buffer is only allocated by the first read.
+
+    A server with many idle clients can pass every decoder the same `scratch`
+    buffer instead, as long as it only uses them from one thread. Reads then
+    go into the scratch buffer, and a decoder holds no buffer of its own
+    except while a frame is incomplete, so an idle connection costs no buffer
+    space at all. The frames returned are views into the scratch buffer, valid
+    until any of the decoders reads again.
+
+    Compressed frames are decompressed into new buffers using `compressor`,
+    which is set once the handshake has agreed on one.
+    """
+    __slots__ = ('buffer', 'view', 'start', 'end', 'size', 'scratch', 'max_frame', 'compressor')
+
+    # Don't bother issuing a read with less free space than this; move the
+    # pending bytes to the front of the buffer first.
+    MIN_READ = 4096
+
+    def __init__(self, size: int = 65536, max_frame: int = 16 << 20, scratch: memoryview | None = None):
+        # None until the first read, and again whenever a decoder using a
+        # scratch buffer has consumed everything
+        self.buffer: bytearray | memoryview | None = None
+        self.view: memoryview | None = None
+        self.size: int = size
+        self.scratch: memoryview | None = scratch
+
+        # Unconsumed bytes are buffer[start:end]
+        self.start: int = 0
+        self.end: int = 0
+
+        # Largest frame a peer may announce. Anything bigger is treated as a
+        # protocol error rather than an allocation request.
+        self.max_frame: int = max_frame
+
+        self.compressor: Compressor | None = None
+
+    def feed(self, sock: socket.socket) -> list[memoryview | bytes] | None:
+        """
+        Read whatever the socket has available and return the payloads of all
+        complete frames, without their length headers. Returns None once the
+        peer has closed the connection.
+
+        The returned views point into the decoder's buffer, so they are only
+        valid until the next call to `feed()`. Raises `BlockingIOError` if
+        there was nothing to read.
+        """
+        count = sock.recv_into(self.get_buffer())
+        if count == 0:
+            if self.start != self.end:
+                raise ConnectionResetError("Connection closed unexpectedly.")
+            return None
+
+        return self.advance(count)
+
+    def get_buffer(self) -> memoryview:
+        """
+        Return the free space at the end of the buffer, for callers that do
+        their own reads (such as `asyncio.BufferedProtocol`). Follow up with
+        `advance()`.
+        """
+        self._make_room()
+        return self.view[self.end:]
+
+    def advance(self, count: int) -> list[memoryview | bytes]:
+        """
+        Account for `count` bytes written into the view from `get_buffer()`
+        and return the payloads of all complete frames, as `feed()` does.
+        """
+        self.end += count
+        return self._split()
+
+    def pending(self) -> bytes:
+        """
+        The unconsumed bytes: the start of a frame that isn't complete yet.
+        """
+        if self.view is None:
+            return b''
+        return bytes(self.view[self.start:self.end])
+
+    def preload(self, data: bytes):
+        """
+        Put back bytes returned by `pending()`, possibly of another decoder,
+        as if they had just been read.
+        """
+        while data:
+            buffer = self.get_buffer()
+            count = min(len(buffer), len(data))
+            buffer[:count] = data[:count]
+            if self.advance(count):
+                raise ValueError("Preloaded data contains a complete frame")
+            data = data[count:]
+
+    def _split(self) -> list[memoryview | bytes]:
+        frames: list[memoryview | bytes] = []
+        view = self.view
+        start = self.start
+        end = self.end
+
+        while end - start >= 4:
+            length: int = _HEADER.unpack_from(self.buffer, start)[0]
+            compressed = length & COMPRESSED
+            length &= _LENGTH_MASK
+            if end - start - 4 < length:
+                break
+
+            start += 4
+            if compressed:
+                frames.append(_decompress(view[start:start + length], self.compressor, self.max_frame))
+            else:
+                frames.append(view[start:start + length])
+            start += length
+
+        if start == end:
+            # Everything was consumed; the next read can start from the front
+            start = end = 0
+            if self.scratch is not None:
+                # Of a buffer the next read picks, so an idle decoder has none
+                self.buffer = self.view = None
+        elif self.buffer is self.scratch:
+            # Other decoders will overwrite the scratch buffer, so the start of
+            # the incomplete frame needs a buffer of its own. The frames
+            # returned still point into the scratch buffer.
+            self.buffer = bytearray(view[start:end])
+            self.view = memoryview(self.buffer)
+            end -= start
+            start = 0
+
+        self.start = start
+        self.end = end
+        return frames
+
+    def _make_room(self):
+        if self.buffer is None:
+            # Nothing pending
+            if self.scratch is not None:
+                self.buffer = self.view = self.scratch
+            else:
+                self.buffer = bytearray(self.size)
+                self.view = memoryview(self.buffer)
+            return
+
+        capacity = len(self.buffer)
+        if capacity - self.end >= self.MIN_READ:
+            return
+
+        pending = self.end - self.start
+        needed = pending + self.MIN_READ
+
+        # If the header of the pending frame is already here, make sure the
+        # whole frame will fit
+        if pending >= 4:
+            length: int = _HEADER.unpack_from(self.buffer, self.start)[0] & _LENGTH_MASK
+            if length > self.max_frame:
+                raise ValueError(f"Frame of {length} bytes exceeds the {self.max_frame} byte limit")
+            needed = max(needed, 4 + length)
+
+        if needed > capacity:
+            new_buffer = bytearray(max(needed, capacity * 2))
+            new_buffer[:pending] = self.view[self.start:self.end]
+            self.buffer = new_buffer
+            self.view = memoryview(new_buffer)
+        elif self.start > 0:
+            # Equal-sized slice assignment, so no resize of the exported buffer
+            self.view[:pending] = self.view[self.start:self.end]
 
-    return bytes(res)
+        self.start = 0
+        self.end = pending
@@ -0,0 +1,241 @@
+import asyncio
+
+import signal
+
+import socket as sckt
+from socket import socket
+
+from sys import stderr
+
+from .connection import BaseConnection
+from .core import ACCEPT_RETRY, ChatCore
+
+class AsyncConnection(BaseConnection, asyncio.BufferedProtocol):
+    """
+    Client state for the asyncio server engine. Doubles as the asyncio
+    protocol for the client's transport; all of its callbacks run on the event
+    loop and forward to the server.
+    """
+    __slots__ = ('server', 'transport', 'paused')
+
+    def __init__(self, server: 'AsyncChatServer'):
+        super().__init__(None, None, "", server.read_buffer)
+        self.server: AsyncChatServer = server
+        self.transport: asyncio.Transport | None = None
+
+        # True while the transport's write buffer is over the high-water mark.
+        self.paused: bool = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.sock = transport.get_extra_info('socket')
+        self.address = transport.get_extra_info('peername')
+        self.server._connected(self)
+
+    def get_buffer(self, sizehint):
+        # Read straight into the frame decoder's buffer
+        return self.decoder.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        self.server._receive(self, self.decoder.advance(nbytes))
+
+    def eof_received(self):
+        # Returning False closes the transport, which calls connection_lost
+        return False
+
+    def connection_lost(self, exc):
+        self.server._lost(self)
+
+    def pause_writing(self):
+        self.server._pause(self)
+
+    def resume_writing(self):
+        self.server._resume(self)
+
+class AsyncChatServer(ChatCore):
+    """
+    The asyncio server engine. Runs everything on a single event loop: reads
+    go through `AsyncConnection`, commands run as soon as they are decoded,
+    and writes are buffered by the transports.
+
+    Keyword arguments not listed in `__init__` are passed on to `ChatCore`.
+    """
+    __slots__ = ('port', 'listener')
+
+    def __init__(self, port: int, debug_level: int, high_water: int = 1 << 20, overflow_policy: str = 'disconnect',
+                 allow_pickle: bool = False, **options):
+        super().__init__(debug_level, high_water, overflow_policy, allow_pickle, **options)
+        self.port: int = port
+        self.listener: socket | None = None
+
+    def run(self):
+        asyncio.run(self._serve())
+
+    def shutdown(self):
+        # Client connections are closed by the time run() returns
+        self.close_metrics()
+        self.close_log()
+        self.close_capture()
+
+    def _gauges(self) -> dict[str, float]:
+        return {
+            'outbound_bytes': sum(conn.transport.get_write_buffer_size() for conn in self.sessions.snapshot()),
+        }
+
+    async def _serve(self):
+        # Accepting is done here rather than by loop.create_server(), so it
+        # can be paused for the accept rate limit
+        listener = socket(sckt.AF_INET, sckt.SOCK_STREAM)
+        listener.setsockopt(sckt.SOL_SOCKET, sckt.SO_REUSEADDR, 1) # Fix 'address already in use'
+        listener.bind(('', self.port)) # Empty string listens on all interfaces
+        listener.listen(self.backlog)
+        listener.setblocking(False)
+        self.listener = listener
+
+        loop = asyncio.get_running_loop()
+        loop.add_reader(listener, self._accept)
+        ticker = asyncio.create_task(self._tick())
+        if self.profiler is not None:
+            # The loop runs the callback, not the signal handler, so starting
+            # the profiler's thread can't deadlock
+            loop.add_signal_handler(signal.SIGUSR1, self.profiler.start)
+        try:
+            # Until cancelled by a shutdown signal
+            await loop.create_future()
+        finally:
+            _ = ticker.cancel()
+            _ = loop.remove_reader(listener)
+            if self.profiler is not None:
+                _ = loop.remove_signal_handler(signal.SIGUSR1)
+            listener.close()
+            for conn in self.sessions.snapshot():
+                conn.transport.abort()
+
+    # Called when the listener is readable. Accepts every waiting connection,
+    # up to the budget; the transports are set up by tasks, as asyncio's own
+    # servers do.
+    def _accept(self):
+        loop = asyncio.get_running_loop()
+        # timers.now only moves once per tick, too seldom for the rate limit
+        now = loop.time()
+        budget = self._accept_budget(now)
+        accepted = 0
+        while accepted < budget:
+            try:
+                sock, _ = self.listener.accept()
+            except BlockingIOError:
+                # Nobody left waiting
+                break
+            except OSError as e:
+                # Out of file descriptors or memory
+                print(f"Error while accepting a connection: {e}", file=stderr)
+                self._pause_accepting(now + ACCEPT_RETRY)
+                return
+            accepted += 1
+
+            if not self._room_for_connection():
+                sock.close()
+                continue
+
+            sock.setblocking(False)
+            _ = loop.create_task(loop.connect_accepted_socket(lambda: AsyncConnection(self), sock))
+
+        resume = self._accepted(accepted, budget, now)
+        if resume is not None:
+            self._pause_accepting(resume)
+
+    # Stop watching the listener until `until` (a loop.time()). New
+    # connections wait in the kernel's backlog meanwhile.
+    def _pause_accepting(self, until: float):
+        loop = asyncio.get_running_loop()
+        if loop.remove_reader(self.listener):
+            _ = loop.call_at(until, loop.add_reader, self.listener, self._accept)
+
+    def _connected(self, conn: AsyncConnection):
+        # pause_writing() fires once the transport buffers more than this
+        conn.transport.set_write_buffer_limits(high=self.high_water)
+        self._register(conn)
+
+    def _receive(self, conn: AsyncConnection, frames: list[memoryview]):
+        # Close enough, and much cheaper than reading the clock
+        conn.last_seen = self.timers.now
+
+        if self.metrics is not None:
+            conn.frames_in += len(frames)
+            conn.bytes_in += sum(len(payload) for payload in frames) + 4 * len(frames)
+
+        try:
+            # timers.now only moves once per tick, too seldom for the rate
+            # limits
+            now = asyncio.get_running_loop().time()
+
+            # The frames are views into the decoder's buffer, so they must be
+            # decoded before returning to the event loop.
+            for payload in frames:
+                client_msg = self._decode(conn, payload)
+                if client_msg is not None and self._admit(conn, client_msg, now):
+                    self._execute(conn, client_msg, conn.seq)
+
+                if conn.closed:
+                    return
+
+        except Exception as e:
+            print(f"Error while handling client {conn.address}: {e}", file=stderr)
+            self._disconnect(conn)
+
+    # Drop a connection without flushing its buffer. The transport calls
+    # connection_lost (and so _lost) on the next loop iteration.
+    def _disconnect(self, conn: AsyncConnection):
+        conn.closed = True
+        conn.transport.abort()
+
+    # Commands only run on the event loop, so a plain callback will do.
+    def _schedule_presence(self):
+        _ = asyncio.get_running_loop().call_later(self.presence.window, self._flush_presence)
+
+    # Drive the connection timers. Ticking even when there are no timers is
+    # cheaper than keeping track of whether there are any.
+    async def _tick(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.timers.resolution)
+            self._expire_timers(loop.time())
+
+    def _lost(self, conn: AsyncConnection):
+        if self.debug_level == 1:
+            print(f"Client {conn.address} disconnected.")
+
+        self.timers.cancel(conn)
+
+        conn.closed = True
+        self._cleanup(conn)
+
+    def _pause(self, conn: AsyncConnection):
+        if not self.drop_on_overflow:
+            print(f"Client {conn.address} exceeded the outbound limit, disconnecting.", file=stderr)
+            self._disconnect(conn)
+            return
+
+        # Drop frames until the client catches up, and stop reading its
+        # commands in the meantime so it can't keep adding to its own backlog
+        conn.paused = True
+        conn.transport.pause_reading()
+
+    def _resume(self, conn: AsyncConnection):
+        conn.paused = False
+        if not conn.closed:
+            conn.transport.resume_reading()
+
+    def _deliver(self, conn: AsyncConnection, frame: bytes):
+        if conn.closed:
+            return
+
+        if conn.paused:
+            if self.debug_level == 1:
+                print(f"Dropped frame for slow client {conn.address}")
+            return
+
+        conn.transport.write(frame)
+        if self.metrics is not None:
+            conn.frames_out += 1
+            conn.bytes_out += len(frame)
@@ -0,0 +1,193 @@
+import argparse
+
+from collections.abc import Iterator
+
+import hashlib
+
+import os
+
+import struct
+
+import threading
+
+import time
+
+from src.protocol import commands
+from src.protocol.codec import BINARY
+
+from .connection import BaseConnection
+
+# A trace starts with a header: the format, the wall-clock time the capture
+# started and its flags. Every record after it is a header followed by
+# `length` bytes: the command in the binary codec for COMMAND records,
+# nothing for the others. Record times are microseconds since the capture
+# started.
+HEADER = struct.Struct('!8sdB')
+RECORD = struct.Struct('!BIQI')
+MAGIC = b'CHATTRC1'
+
+# Record kinds
+CONNECT = 1
+COMMAND = 2
+DISCONNECT = 3
+
+# Header flags
+ANONYMIZED = 0x01
+
+# Bytes buffered before the trace file is written to
+BUFFER_SIZE = 1 << 20
+
+class TrafficCapture:
+    """
+    Records what clients send, for `src.bench.replay` to play back against
+    another server: when each connection opens and closes, and every command
+    it sends, in the order the server decoded them. Handshakes and pongs are
+    left out.
+
+    Admin tokens are never recorded. With `anonymize`, nicknames are replaced
+    by pseudonyms (the same one for the same nickname, so clashes still
+    happen on replay) and message text by filler of the same length.
+    Channel names are kept.
+
+    Records are buffered and written out as the buffer fills, so a server
+    that crashes loses the last of them; closing the capture writes
+    everything. Safe to use from any thread.
+    """
+    __slots__ = ('path', 'anonymize', 'key', 'lock', 'file', 'start', 'ids', 'next_id')
+
+    def __init__(self, path: str, anonymize: bool = False):
+        self.path: str = path
+        self.anonymize: bool = anonymize
+
+        # Pseudonyms are keyed hashes, so they can't be reversed by hashing
+        # guessed nicknames
+        self.key: bytes = os.urandom(16)
+
+        # Guards everything below
+        self.lock: threading.Lock = threading.Lock()
+
+        # Never overwrites an earlier trace. None once closed.
+        self.file = open(path, 'xb', buffering=BUFFER_SIZE)
+        _ = self.file.write(HEADER.pack(MAGIC, time.time(), ANONYMIZED if anonymize else 0))
+        self.start: int = time.monotonic_ns()
+
+        # Numbers of the connections open since the capture started
+        self.ids: dict[BaseConnection, int] = {}
+        self.next_id: int = 0
+
+    def connected(self, conn: BaseConnection):
+        with self.lock:
+            if self.file is not None:
+                _ = self._id(conn)
+
+    def command(self, conn: BaseConnection, msg: commands.CommandObject, payload):
+        """
+        Record a command and the frame payload it was decoded from, which is
+        written as it is when it is already what the trace needs.
+        """
+        if self.anonymize or conn.codec is not BINARY or type(msg) in (commands.CmdStats, commands.CmdProfile):
+            payload = BINARY.dumps(self._scrub(msg))
+
+        with self.lock:
+            if self.file is not None:
+                self._write(COMMAND, self._id(conn), payload)
+
+    def disconnected(self, conn: BaseConnection):
+        with self.lock:
+            ident = self.ids.pop(conn, None)
+            if ident is not None and self.file is not None:
+                self._write(DISCONNECT, ident, b'')
+
+    # Write out everything recorded so far and stop recording.
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    # The number of a connection, recording it as connected if it is new.
+    # Clients connected before the capture started (such as those handed over
+    # by another process) appear with their first command. Called with the
+    # lock held.
+    def _id(self, conn: BaseConnection) -> int:
+        ident = self.ids.get(conn)
+        if ident is None:
+            ident = self.ids[conn] = self.next_id
+            self.next_id += 1
+            self._write(CONNECT, ident, b'')
+        return ident
+
+    # Called with the lock held, so records are in time order
+    def _write(self, kind: int, ident: int, payload):
+        micros = (time.monotonic_ns() - self.start) // 1000
+        _ = self.file.write(RECORD.pack(kind, ident, micros, len(payload)))
+        _ = self.file.write(payload)
+
+    # The command as it goes in the trace
+    def _scrub(self, msg: commands.CommandObject) -> commands.CommandObject:
+        match msg:
+            case commands.CmdStats():
+                return commands.CmdStats('')
+            case commands.CmdProfile(seconds=seconds, allocations=allocations):
+                return commands.CmdProfile('', seconds, allocations)
+            case commands.CmdNick(nickname=nickname) if self.anonymize:
+                digest = hashlib.blake2b(nickname.encode(), digest_size=6, key=self.key).hexdigest()
+                return commands.CmdNick(f"anon-{digest}")
+            case commands.CmdSendMessage(message=message, channel=channel) if self.anonymize:
+                return commands.CmdSendMessage('x' * len(message), channel)
+        return msg
+
+def read_header(f) -> tuple[float, int]:
+    """
+    Read the header of a trace from a binary file object. Returns the
+    wall-clock time the capture started and its flags.
+    """
+    data = f.read(HEADER.size)
+    if len(data) < HEADER.size or data[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{getattr(f, 'name', 'File')} is not a traffic capture")
+    _, started, flags = HEADER.unpack(data)
+    return started, flags
+
+def records(path: str, decode: bool = True) -> Iterator[tuple[int, int, int, commands.CommandObject | None]]:
+    """
+    The records of a trace, as (kind, connection, microseconds since the
+    capture started, command or None). Without `decode`, commands are
+    skipped over and None is returned in their place. A record cut short by
+    a crash ends the trace.
+    """
+    with open(path, 'rb') as f:
+        _ = read_header(f)
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            kind, ident, micros, length = RECORD.unpack(header)
+            msg = None
+            if length and not decode:
+                _ = f.seek(length, os.SEEK_CUR)
+            elif length:
+                payload = f.read(length)
+                if len(payload) < length:
+                    return
+                msg = BINARY.loads(payload)
+            yield kind, ident, micros, msg
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print the records of a traffic capture')
+    _ = parser.add_argument('trace', help='Trace file (--capture of the server)')
+    args = parser.parse_args()
+
+    with open(args.trace, 'rb') as f:
+        started, flags = read_header(f)
+    print(f"Captured {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started))}"
+          f"{', anonymized' if flags & ANONYMIZED else ''}")
+
+    names = {CONNECT: 'connect', DISCONNECT: 'disconnect'}
+    for kind, ident, micros, msg in records(args.trace):
+        if msg is not None:
+            # Commands have no __str__ of their own
+            fields = ', '.join(repr(getattr(msg, name)) for name in msg.__slots__)
+            description = f"{type(msg).__name__}({fields})"
+        else:
+            description = names.get(kind, str(kind))
+        print(f"{micros / 1e6:12.6f} {ident:>8} {description}")
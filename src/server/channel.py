@@ -0,0 +1,70 @@
+import sys
+
+import threading
+
+from .connection import BaseConnection
+from .ratelimit import TokenBucket
+
+class Channel:
+    """
+    A chat channel and its members.
+
+    Joins and leaves update a plain set under `lock`, which is O(1). Broadcasts
+    use `members`, an immutable snapshot that is rebuilt at most once per
+    change, so they can iterate it without holding any lock.
+    """
+    __slots__ = ('name', 'permanent', 'lock', 'member_set', 'snapshot', 'bucket')
+
+    def __init__(self, name: str, permanent: bool = False):
+        # Interned, so members' `channels` tuples and the server's indexes
+        # all point at this one string
+        self.name: str = sys.intern(name)
+
+        # Permanent channels stay when their last member leaves; the others
+        # are removed
+        self.permanent: bool = permanent
+        self.lock: threading.Lock = threading.Lock()
+        self.member_set: set[BaseConnection] = set()
+
+        # Cached frozenset of member_set, or None if it changed since
+        self.snapshot: frozenset[BaseConnection] | None = frozenset()
+
+        # Rate limit on messages into the channel, created on first use (see
+        # ratelimit.RateLimits)
+        self.bucket: TokenBucket | None = None
+
+    @property
+    def members(self) -> frozenset[BaseConnection]:
+        """
+        The current members, as a snapshot later changes won't affect.
+        """
+        snapshot = self.snapshot
+        if snapshot is None:
+            with self.lock:
+                snapshot = self.snapshot
+                if snapshot is None:
+                    snapshot = self.snapshot = frozenset(self.member_set)
+        return snapshot
+
+    def add(self, conn: BaseConnection):
+        with self.lock:
+            if conn not in self.member_set:
+                self.member_set.add(conn)
+                self.snapshot = None
+
+    def remove(self, conn: BaseConnection) -> bool:
+        """
+        Remove a member. Returns False if it was not a member.
+        """
+        with self.lock:
+            if conn not in self.member_set:
+                return False
+            self.member_set.remove(conn)
+            self.snapshot = None
+            return True
+
+    def __len__(self):
+        return len(self.member_set)
+
+    def __str__(self):
+        return f"Channel({self.name}, {len(self.member_set)} members)"
@@ -0,0 +1,392 @@
+import os
+import re
+
+import selectors
+from selectors import DefaultSelector
+
+import signal
+
+import socket as sckt
+from socket import socket
+
+import sys
+from sys import stderr
+
+import tempfile
+import threading
+
+from src.protocol import events
+from src.protocol import shared
+from src.protocol.codec import BINARY, BinaryCodec
+from src.protocol.shared import ProtocolObject
+
+# Every process hands out initial nicknames from its own disjoint sequence
+# (User 1, User 1 + N, ... for the first of N processes). Clients may not claim
+# names of that form, so a generated name can never collide with a chosen one.
+RESERVED_NICK = re.compile(r'User \d+')
+
+class BusPublish(ProtocolObject):
+    """
+    An event for clients connected to other processes, encoded with the
+    binary codec. The hub forwards it to every other process unchanged.
+    """
+    __slots__ = ('event',)
+
+    def __init__(self, event: bytes):
+        self.event: bytes = event
+
+class BusUsers(ProtocolObject):
+    """
+    Process to hub: the number of local connections.
+    Hub to process: the number of connections across the whole cluster.
+    """
+    __slots__ = ('count',)
+
+    def __init__(self, count: int):
+        self.count: int = count
+
+class BusClaim(ProtocolObject):
+    """
+    Ask the hub for exclusive use of a nickname, giving up the old one.
+    """
+    __slots__ = ('request', 'old_nick', 'new_nick')
+
+    def __init__(self, request: int, old_nick: str, new_nick: str):
+        self.request: int = request
+        self.old_nick: str = old_nick
+        self.new_nick: str = new_nick
+
+class BusClaimReply(ProtocolObject):
+    """
+    The hub's answer to a `BusClaim`.
+    """
+    __slots__ = ('request', 'granted')
+
+    def __init__(self, request: int, granted: bool):
+        self.request: int = request
+        self.granted: bool = granted
+
+class BusRelease(ProtocolObject):
+    """
+    A nickname is no longer in use (its client disconnected).
+    """
+    __slots__ = ('nick',)
+
+    def __init__(self, nick: str):
+        self.nick: str = nick
+
+BUS_TYPES: dict[int, type[ProtocolObject]] = {
+    0x01: BusPublish,
+    0x02: BusUsers,
+    0x03: BusClaim,
+    0x04: BusClaimReply,
+    0x05: BusRelease,
+}
+
+BUS = BinaryCodec(BUS_TYPES)
+
+_PUBLISH_TAG = 0x01
+
+class ClusterHub:
+    """
+    The parent process of a multi-process server. Relays events between the
+    server processes over a Unix socket and owns the state that must be
+    globally consistent: the set of claimed nicknames and the user count.
+    """
+    __slots__ = ('path', 'listener', 'selectors', 'peers', 'counts', 'nicks', 'seen_peers')
+
+    def __init__(self, path: str, processes: int):
+        self.path: str = path
+
+        self.listener: socket = socket(sckt.AF_UNIX, sckt.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(processes)
+        self.listener.setblocking(False)
+
+        self.selectors: DefaultSelector = DefaultSelector()
+        _ = self.selectors.register(self.listener, selectors.EVENT_READ)
+
+        # Connected server processes, and the last user count each reported
+        self.peers: dict[socket, shared.FrameDecoder] = {}
+        self.counts: dict[socket, int] = {}
+
+        # Claimed nickname -> the process whose client holds it
+        self.nicks: dict[str, socket] = {}
+
+        self.seen_peers: bool = False
+
+    def close_listener(self):
+        """
+        Called in the forked server processes, which don't need the hub's
+        socket.
+        """
+        self.selectors.close()
+        self.listener.close()
+
+    def run(self):
+        """
+        Relay messages until every server process has gone away.
+        """
+        while self.peers or not self.seen_peers:
+            for key, _ in self.selectors.select():
+                if key.fileobj is self.listener:
+                    peer, _ = self.listener.accept()
+                    self.peers[peer] = shared.FrameDecoder()
+                    self.counts[peer] = 0
+                    self.seen_peers = True
+                    _ = self.selectors.register(peer, selectors.EVENT_READ)
+                else:
+                    self._read(key.fileobj)
+
+    def shutdown(self):
+        for peer in list(self.peers):
+            peer.close()
+        self.close_listener()
+        os.unlink(self.path)
+
+    def _read(self, peer: socket):
+        try:
+            frames = self.peers[peer].feed(peer)
+        except OSError:
+            frames = None
+
+        if frames is None:
+            self._drop(peer)
+            return
+
+        for payload in frames:
+            if payload[0] == _PUBLISH_TAG:
+                # No need to decode; pass the frame on as it is
+                frame = shared.frame(bytes(payload))
+                for other in self.peers:
+                    if other is not peer:
+                        self._send(other, frame)
+                continue
+
+            match BUS.loads(payload):
+                case BusUsers(count=count):
+                    self.counts[peer] = count
+                    self._send_users()
+
+                case BusClaim(request=request, old_nick=old_nick, new_nick=new_nick):
+                    granted = new_nick not in self.nicks and not RESERVED_NICK.fullmatch(new_nick)
+                    if granted:
+                        self.nicks[new_nick] = peer
+                        if self.nicks.get(old_nick) is peer:
+                            del self.nicks[old_nick]
+                    self._send(peer, shared.encode(BusClaimReply(request, granted), BUS))
+
+                case BusRelease(nick=nick):
+                    if self.nicks.get(nick) is peer:
+                        del self.nicks[nick]
+
+                case msg:
+                    print(f"Cluster hub: unexpected message {type(msg).__name__}", file=stderr)
+
+    def _send_users(self):
+        frame = shared.encode(BusUsers(sum(self.counts.values())), BUS)
+        for peer in self.peers:
+            self._send(peer, frame)
+
+    # A process may exit while the hub relays to it, as they all do when the
+    # cluster shuts down. It is dropped once its socket is read to the end,
+    # so a failed send is ignored.
+    def _send(self, peer: socket, frame: bytes):
+        try:
+            peer.sendall(frame)
+        except OSError:
+            pass
+
+    def _drop(self, peer: socket):
+        _ = self.selectors.unregister(peer)
+        peer.close()
+        del self.peers[peer]
+        del self.counts[peer]
+
+        # The process is gone, and so are its clients
+        for nick in [nick for nick, owner in self.nicks.items() if owner is peer]:
+            del self.nicks[nick]
+        self._send_users()
+
+class BusClient:
+    """
+    A server process's connection to the `ClusterHub`.
+    """
+    __slots__ = (
+        'index',
+        'processes',
+        'sock',
+        'send_lock',
+        'users',
+        'pending',
+        'pending_lock',
+        'next_request',
+        'server',
+    )
+
+    def __init__(self, path: str, index: int, processes: int):
+        # This process's position in the cluster, used to give each process a
+        # disjoint sequence of initial nicknames
+        self.index: int = index
+        self.processes: int = processes
+
+        self.sock: socket = socket(sckt.AF_UNIX, sckt.SOCK_STREAM)
+        self.sock.connect(path)
+        self.send_lock: threading.Lock = threading.Lock()
+
+        # Connected users across the cluster, as last reported by the hub
+        self.users: int = 0
+
+        # Outstanding nickname claims: request -> [answered, granted]
+        self.pending: dict[int, list] = {}
+        self.pending_lock: threading.Lock = threading.Lock()
+        self.next_request: int = 0
+
+        self.server = None
+
+    def attach(self, server):
+        """
+        Start delivering events from other processes to `server`.
+        """
+        self.server = server
+        t = threading.Thread(target=self._reader_thread, name='bus-reader', daemon=True)
+        t.start()
+
+    def publish(self, event: events.EventObject):
+        """
+        Pass an event on to the clients of every other process.
+        """
+        self._send(BusPublish(BINARY.dumps(event)))
+
+    def report_users(self, count: int):
+        self._send(BusUsers(count))
+
+    def claim(self, old_nick: str, new_nick: str, timeout: float = 5.0) -> bool:
+        """
+        Ask the hub for `new_nick`. Blocks until the hub answers; returns
+        whether the name was granted. If the hub takes longer than `timeout`,
+        the claim is undone and counts as refused.
+        """
+        waiter = [threading.Event(), False]
+        with self.pending_lock:
+            request = self.next_request
+            self.next_request += 1
+            self.pending[request] = waiter
+
+        self._send(BusClaim(request, old_nick, new_nick))
+        if not waiter[0].wait(timeout):
+            with self.pending_lock:
+                _ = self.pending.pop(request, None)
+                undo = self.next_request
+                self.next_request += 1
+            # The hub may still grant it. It handles messages in order, so
+            # this takes the old name back from the new one, then lets go of
+            # the new one; if the claim is refused, neither changes anything.
+            # The answer to the undo is ignored, as nobody waits for it.
+            if not RESERVED_NICK.fullmatch(old_nick):
+                self._send(BusClaim(undo, new_nick, old_nick))
+            self.release(new_nick)
+            return False
+        return waiter[1]
+
+    def release(self, nick: str):
+        if not RESERVED_NICK.fullmatch(nick):
+            self._send(BusRelease(nick))
+
+    def _send(self, msg: ProtocolObject):
+        frame = shared.encode(msg, BUS)
+        with self.send_lock:
+            self.sock.sendall(frame)
+
+    def _reader_thread(self):
+        while True:
+            try:
+                payload = shared.receive_payload(self.sock)
+            except (OSError, ValueError):
+                # Gone, or sent a frame too big to be one of the hub's
+                payload = None
+
+            if payload is None:
+                print("Lost connection to the cluster hub.", file=stderr)
+                # Shut this process down as SIGTERM would. The signal goes to
+                # the main thread, so it interrupts the selector's wait;
+                # _thread.interrupt_main() would only be noticed once the
+                # wait ended by itself.
+                signal.pthread_kill(threading.main_thread().ident, signal.SIGTERM)
+                return
+
+            try:
+                match BUS.loads(payload):
+                    case BusPublish(event=event):
+                        self.server._remote_event(BINARY.loads(event))
+
+                    case BusUsers(count=count):
+                        self.users = count
+
+                    case BusClaimReply(request=request, granted=granted):
+                        with self.pending_lock:
+                            waiter = self.pending.pop(request, None)
+                        if waiter is not None:
+                            waiter[1] = granted
+                            waiter[0].set()
+
+            except Exception as e:
+                print(f"Error handling cluster message: {e}", file=stderr)
+
+def run_cluster(processes: int, make_server, run_server) -> int:
+    """
+    Fork `processes` server processes that share the listening port through
+    SO_REUSEPORT, and relay events between them until they all exit. SIGTERM
+    is passed on to the server processes.
+
+    `make_server(bus)` builds a server attached to the given `BusClient`, and
+    `run_server(server)` runs it and returns an exit code.
+    """
+    path = os.path.join(tempfile.mkdtemp(prefix='chat-cluster-'), 'bus.sock')
+    hub = ClusterHub(path, processes)
+
+    children: list[int] = []
+    for index in range(processes):
+        pid = os.fork()
+        if pid == 0:
+            hub.close_listener()
+            exit_code = 1
+            try:
+                server = make_server(BusClient(path, index, processes))
+                exit_code = run_server(server)
+            finally:
+                # Never fall back into the parent's code
+                sys.stdout.flush()
+                os._exit(exit_code)
+        children.append(pid)
+
+    def terminate(signum, frame):
+        # The server processes shut themselves down, and the hub keeps
+        # relaying until they have
+        for pid in children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+    _ = signal.signal(signal.SIGTERM, terminate)
+
+    exit_code = 0
+    try:
+        hub.run()
+    except KeyboardInterrupt:
+        # Pass the interrupt on, in case it wasn't sent to the whole process
+        # group. The server processes shut themselves down.
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGINT)
+            except ProcessLookupError:
+                pass
+    finally:
+        for pid in children:
+            _, status = os.waitpid(pid, 0)
+            if os.waitstatus_to_exitcode(status) != 0:
+                exit_code = 1
+        hub.shutdown()
+        os.rmdir(os.path.dirname(path))
+
+    return exit_code
@@ -0,0 +1,198 @@
+from collections import deque
+
+from itertools import islice
+
+from socket import socket
+
+import threading
+
+from src.protocol import shared
+from src.protocol.compression import Compressor
+
+from .ratelimit import TokenBucket
+
+class BaseConnection:
+    """
+    Server-side state for a single client that every server engine keeps.
+    """
+    __slots__ = (
+        'sock',
+        'address',
+        'nick',
+        'codec',
+        'compressor',
+        'decoder',
+        'channels',
+        'closed',
+        'features',
+        'last_seen',
+        'pinged_at',
+        'buckets',
+        'seq',
+        'bytes_in',
+        'frames_in',
+        'bytes_out',
+        'frames_out',
+    )
+
+    def __init__(self, sock, address, nick: str, read_buffer: memoryview | None = None):
+        self.sock = sock
+        self.address = address
+        self.nick: str = nick
+
+        # Wire format agreed on in the handshake. None until the client's first
+        # frame has arrived.
+        self.codec: shared.Codec | None = None
+
+        # Compression agreed on in the handshake, if any. Applies to frames in
+        # both directions; the decoder has its own reference.
+        self.compressor: Compressor | None = None
+
+        # Keeps partially received frames between readiness events. Reads go
+        # into the engine's `read_buffer` if it has one, shared by every
+        # connection, so an idle client holds no read buffer.
+        self.decoder: shared.FrameDecoder = shared.FrameDecoder(scratch=read_buffer)
+
+        # Names of the channels this client is in, so disconnecting only has to
+        # visit those. Only changed by the thread handling the client's
+        # commands. A tuple of the channels' own name strings: clients are in
+        # few channels, and a tuple costs far less than a set.
+        self.channels: tuple[str, ...] = ()
+
+        self.closed: bool = False
+
+        # Feature bits agreed on in the handshake (see handshake.HEARTBEAT)
+        self.features: int = 0
+
+        # time.monotonic() of the last frame from the client, give or take a
+        # timer tick. Drives idle reaping and heartbeats.
+        self.last_seen: float = 0.0
+
+        # When the server last sent an EventPing. An answer is still due if
+        # this is later than last_seen.
+        self.pinged_at: float = 0.0
+
+        # Rate limit token buckets by command type, created on first use (see
+        # ratelimit.RateLimits). Only touched by the thread reading from the
+        # socket.
+        self.buckets: dict[type, TokenBucket] | None = None
+
+        # Commands received so far, which numbers them for EventAck. Only
+        # touched by the thread reading from the socket.
+        self.seq: int = 0
+
+        # Traffic counters. Only kept up to date when metrics are enabled.
+        self.bytes_in: int = 0
+        self.frames_in: int = 0
+        self.bytes_out: int = 0
+        self.frames_out: int = 0
+
+    def __str__(self):
+        return f"{type(self).__name__}({self.address}, {self.nick})"
+
+class Connection(BaseConnection):
+    """
+    Client state for the threaded server engine.
+
+    Worker threads never write to the socket directly. Instead, they append
+    frames to `outbound`, and the selector thread writes them out whenever the
+    socket is writable. This way a slow client can only ever delay itself.
+    """
+    __slots__ = (
+        'worker',
+        'lock',
+        'outbound',
+        'outbound_bytes',
+        'flush_scheduled',
+        'writing',
+        'overflowed',
+    )
+
+    def __init__(self, sock: socket, address, nick: str, read_buffer: memoryview | None = None):
+        super().__init__(sock, address, nick, read_buffer)
+
+        # Index of the worker thread that runs this client's commands.
+        self.worker: int = 0
+
+        # Guards everything below, as well as `closed`. Held only for short,
+        # non-blocking operations.
+        self.lock: threading.Lock = threading.Lock()
+
+        # Frames waiting to be written. The first entry may be a memoryview over
+        # a partially written frame. None while there are none, which is most
+        # of the time, as an empty deque still takes over 600 bytes.
+        self.outbound: deque[bytes | memoryview] | None = None
+        self.outbound_bytes: int = 0
+
+        # True while this connection is waiting in the server's flush list, so
+        # it is only scheduled once no matter how many frames are queued.
+        self.flush_scheduled: bool = False
+
+        # True while the socket is registered for EVENT_WRITE.
+        self.writing: bool = False
+
+        # Set when the outbound queue went over the high-water mark and the
+        # server's policy is to disconnect.
+        self.overflowed: bool = False
+
+    def enqueue(self, frame: bytes, high_water: int, drop: bool) -> bool:
+        """
+        Queue a frame for writing. Must be called with `lock` held.
+
+        Returns False if the frame was not queued because the backlog would
+        exceed `high_water`. If `drop` is False, the connection is also marked
+        as overflowed so the server disconnects it.
+        """
+        if self.closed or self.overflowed:
+            return False
+
+        if self.outbound_bytes + len(frame) > high_water:
+            if not drop:
+                self.overflowed = True
+            return False
+
+        if self.outbound is None:
+            self.outbound = deque()
+        self.outbound.append(frame)
+        self.outbound_bytes += len(frame)
+        return True
+
+    def flush(self, batch_cap: int) -> tuple[bool, int, int]:
+        """
+        Write as much of the backlog as the socket accepts without blocking.
+        Must be called with `lock` held.
+
+        Up to `batch_cap` queued frames go out in a single scatter/gather
+        `sendmsg()` call, without being joined into one buffer first.
+
+        Returns (drained, frames written, system calls made).
+        """
+        outbound = self.outbound
+        frames = 0
+        calls = 0
+        if outbound is None:
+            return True, frames, calls
+
+        while outbound:
+            batch = list(islice(outbound, batch_cap))
+            try:
+                sent = self.sock.sendmsg(batch)
+            except (BlockingIOError, InterruptedError):
+                return False, frames, calls
+
+            calls += 1
+            self.outbound_bytes -= sent
+
+            for buf in batch:
+                if sent < len(buf):
+                    if sent:
+                        outbound[0] = memoryview(buf)[sent:]
+                    # The kernel buffer is full; wait for EVENT_WRITE
+                    return False, frames, calls
+
+                sent -= len(buf)
+                _ = outbound.popleft()
+                frames += 1
+
+        self.outbound = None
+        return True, frames, calls
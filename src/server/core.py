@@ -0,0 +1,972 @@
+from base64 import b64decode, b64encode
+
+import hmac
+
+import threading
+
+from sys import stderr
+
+from time import monotonic, perf_counter_ns
+
+from src.protocol import commands
+from src.protocol import events
+from src.protocol import handshake
+from src.protocol import shared
+from src.protocol.codec import BINARY
+from src.protocol.compression import COMPRESSORS, DEFAULT_THRESHOLD, ZLIB, Compressor
+
+from .capture import TrafficCapture
+from .channel import Channel
+from .connection import BaseConnection
+from .handoff import SNAPSHOT_VERSION, split_frames
+from .history import HistoryStore
+from .index import SortedIndex
+from .metrics import Metrics, MetricsEndpoint
+from .persist import MessageLog
+from .presence import PresenceBuffer
+from .profiler import Profiler
+from .ratelimit import RateLimits, TokenBucket
+from .timers import TimerWheel
+from .registry import SessionRegistry
+
+# Channels that exist even without members
+PERMANENT_CHANNELS = ("General", "Meta", "Misc")
+
+MAX_CHANNEL_NAME = 64
+
+# Most channels in one EventChannelList, and in the EventList answering the
+# original CmdList, which has no way to ask for more
+MAX_LIST_PAGE = 1000
+LEGACY_LIST_LIMIT = 100
+
+# Most messages in one answer to CmdHistory, all sent in a single write
+MAX_HISTORY_PAGE = 1000
+
+# Seconds to stop accepting connections after accept() fails for lack of file
+# descriptors or memory, so the clients being served can free some
+ACCEPT_RETRY = 0.1
+
+# Size of the buffer every connection reads into. Bigger frames are read into
+# a buffer of the connection's own.
+READ_BUFFER_SIZE = 65536
+
+# Longest profile an admin may ask for with CmdProfile
+MAX_PROFILE_SECONDS = 300
+
+# Events the other processes of a cluster pass on to their own clients
+CLUSTER_EVENTS = (events.EventReceiveMessage, events.EventJoin, events.EventLeave, events.EventNick)
+
+def valid_channel_name(name: str) -> bool:
+    """
+    Channel names are 1 to MAX_CHANNEL_NAME printable characters, without
+    spaces.
+    """
+    return 0 < len(name) <= MAX_CHANNEL_NAME and name.isprintable() and not any(c.isspace() for c in name)
+
+class ChatCore:
+    """
+    Server state and command handling shared by every server engine.
+
+    An engine accepts connections, reads frames and hands them to `_receive`,
+    and implements `_deliver` to get frames back out to clients. Everything
+    else (handshakes, channels, nicknames) lives here.
+    """
+    __slots__ = (
+        'debug_level',
+        'username_generator',
+        'sessions',
+        'channels',
+        'channel_index',
+        'channel_lock',
+        'max_channels',
+        'accepted_codecs',
+        'high_water',
+        'drop_on_overflow',
+        'bus',
+        'history',
+        'join_replay',
+        'metrics',
+        'admin_token',
+        'metrics_endpoint',
+        'profiler',
+        'presence',
+        'capture',
+        'accepted_compressions',
+        'compress_threshold',
+        'features',
+        'timers',
+        'handshake_timeout',
+        'ping_interval',
+        'pong_timeout',
+        'idle_timeout',
+        'rate_limits',
+        'log',
+        'backlog',
+        'max_connections',
+        'accept_limit',
+        'read_buffer',
+    )
+
+    def __init__(self, debug_level: int, high_water: int, overflow_policy: str, allow_pickle: bool, bus=None,
+                 history: HistoryStore | None = None, join_replay: int = 20, metrics: Metrics | None = None,
+                 admin_token: str | None = None, compressions: tuple[int, ...] = (ZLIB.id,),
+                 compress_threshold: int = DEFAULT_THRESHOLD, handshake_timeout: float = 10.0,
+                 ping_interval: float = 30.0, pong_timeout: float = 10.0, idle_timeout: float = 0.0,
+                 rate_limits: RateLimits | None = None, max_channels: int = 1_000_000,
+                 log: MessageLog | None = None, backlog: int = 1024, max_connections: int = 0,
+                 accept_rate: tuple[float, float] | None = None, profiler: Profiler | None = None,
+                 presence_window: float = 0.1, capture: TrafficCapture | None = None):
+        self.debug_level: int = debug_level
+
+        # Per-client and per-channel command rate limits, or None for no
+        # limits. Checked by the engine before a command is run or queued.
+        self.rate_limits: RateLimits | None = rate_limits
+
+        # Admission of new connections. The kernel queues up to `backlog`
+        # connections until the engine accepts them, and the engine accepts
+        # at most that many at once, so a reconnect storm can't keep it from
+        # its other clients for long. Beyond max_connections (0 for no limit),
+        # connections are closed as soon as they are accepted. Beyond the
+        # accept rate (per second, burst), the engine stops accepting for a
+        # while and new connections wait in the backlog.
+        self.backlog: int = backlog
+        self.max_connections: int = max_connections
+        self.accept_limit: TokenBucket | None = None
+        if accept_rate is not None:
+            self.accept_limit = TokenBucket(*accept_rate, monotonic())
+
+        # Every connection's reads go into this one buffer (see
+        # FrameDecoder). Only the engine's reading thread may use it.
+        self.read_buffer: memoryview = memoryview(bytearray(READ_BUFFER_SIZE))
+
+        # Every connection has at most one timer, for whichever of these comes
+        # first. A client must finish the handshake within handshake_timeout
+        # of connecting. Clients that negotiated heartbeats get an EventPing
+        # after ping_interval seconds of silence and are dropped if nothing
+        # arrives within pong_timeout of it. Other clients are dropped after
+        # idle_timeout seconds of silence, if it is set.
+        self.timers: TimerWheel = TimerWheel(now=monotonic())
+        self.handshake_timeout: float = handshake_timeout
+        self.ping_interval: float = ping_interval
+        self.pong_timeout: float = pong_timeout
+        self.idle_timeout: float = idle_timeout
+        self.features: int = handshake.ACKS | (handshake.HEARTBEAT if ping_interval > 0 else 0)
+
+        # Compression algorithms clients may pick during the handshake, and
+        # the smallest payload the server compresses for clients that did.
+        self.accepted_compressions: tuple[int, ...] = compressions
+        self.compress_threshold: int = compress_threshold
+
+        # Counters and histograms, or None when metrics are disabled. Clients
+        # holding the admin token may read them with CmdStats.
+        self.metrics: Metrics | None = metrics
+        self.admin_token: str | None = admin_token
+        self.metrics_endpoint: MetricsEndpoint | None = None
+
+        # Samples the server's threads on demand, or None when profiling is
+        # disabled. Started by SIGUSR1 or by clients holding the admin token,
+        # with CmdProfile.
+        self.profiler: Profiler | None = profiler
+
+        # Joins, leaves and renames waiting to be announced in a batch, or
+        # None to announce each one as it happens. Clients that negotiated it
+        # get an EventPresenceDelta per batch; the others get the individual
+        # events, all in one write.
+        self.presence: PresenceBuffer | None = None
+        if presence_window > 0:
+            self.presence = PresenceBuffer(presence_window)
+            self.features |= handshake.PRESENCE
+
+        # Records every connection and command for replaying later, or None.
+        # Written to by the engine's reading thread and by whichever thread
+        # cleans up after clients.
+        self.capture: TrafficCapture | None = capture
+
+        # Recent messages of each channel, or None to keep no history. Members
+        # get the last join_replay of them when they join a channel.
+        self.history: HistoryStore | None = history
+        self.join_replay: int = join_replay
+
+        # Durable record of messages, joins, leaves and nickname changes, or
+        # None. History older than what is held in memory is read from it, and
+        # the memory is filled from it on startup.
+        self.log: MessageLog | None = log
+        if log is not None and history is not None:
+            self._load_history()
+
+        # Link to the other processes of a multi-process server (a
+        # cluster.BusClient), or None when running as a single process.
+        self.bus = bus
+
+        # Codec versions clients may pick during the handshake. Pickle lets a
+        # client run arbitrary code on the server, so it is opt-in.
+        self.accepted_codecs: tuple[int, ...] = tuple(
+            version for version in handshake.CODECS
+            if allow_pickle or version != shared.PICKLE.version
+        )
+
+        # Used to generate the initial username of a new clint. In a cluster,
+        # each process takes every N-th number so names never collide.
+        if bus is not None:
+            self.username_generator = self.gen_initial_username(bus.index + 1, bus.processes)
+        else:
+            self.username_generator = self.gen_initial_username()
+
+        # Active connections, indexed by socket and by nickname. The registry
+        # and each channel have their own locks, and no lock is ever held
+        # while writing to a socket.
+        self.sessions: SessionRegistry = SessionRegistry()
+
+        # Channels by name. Joining a channel that doesn't exist creates it,
+        # and channels are removed when their last member leaves, except the
+        # permanent ones. The index lists the names in order for CmdList and
+        # CmdListChannels. Creating and removing channels, and reading the
+        # index, happen under channel_lock; looking up a channel does not.
+        self.channels: dict[str, Channel] = {
+            name: Channel(name, permanent=True) for name in PERMANENT_CHANNELS
+        }
+        self.channel_index: SortedIndex = SortedIndex()
+        for name in self.channels:
+            self.channel_index.add(name)
+        self.channel_lock: threading.Lock = threading.Lock()
+        self.max_channels: int = max_channels
+
+        # Maximum number of unsent bytes a single client may have queued. What
+        # happens when a client goes over it depends on the overflow policy:
+        # 'disconnect' closes the connection, 'drop' discards the new frame.
+        if overflow_policy not in ('disconnect', 'drop'):
+            raise ValueError(f"Unknown overflow policy '{overflow_policy}'")
+        self.high_water: int = high_water
+        self.drop_on_overflow: bool = overflow_policy == 'drop'
+
+    def gen_initial_username(self, first: int = 1, step: int = 1):
+        x = first - step
+        while True:
+            x += step
+            username = f"User {x}"
+            yield username
+
+    # Serve the metrics report on a Unix socket at `path`.
+    def serve_metrics(self, path: str):
+        if self.metrics is None:
+            raise ValueError("Metrics are disabled")
+        self.metrics_endpoint = MetricsEndpoint(path, self.stats_report)
+
+    def close_metrics(self):
+        if self.metrics_endpoint is not None:
+            self.metrics_endpoint.close()
+            self.metrics_endpoint = None
+
+    # Write out everything logged so far and close the log.
+    def close_log(self):
+        if self.log is not None:
+            self.log.close()
+
+    # Write out the rest of the traffic capture and stop capturing.
+    def close_capture(self):
+        if self.capture is not None:
+            self.capture.close()
+
+    # Fill the history with the newest messages of the log, as far as the
+    # history's limits go, numbered as they are in the log.
+    def _load_history(self):
+        history = self.history
+        loaded: list[tuple[str, list[bytes], int]] = []
+        size = 0
+        # Most recently active channels first, until the history is full
+        for channel in reversed(self.log.channels()):
+            if size >= history.max_bytes:
+                break
+            frames, _ = self.log.page(channel, 0, history.max_entries)
+            loaded.append((channel, frames, self.log.count(channel) - len(frames) + 1))
+            size += sum(len(frame) for frame in frames)
+
+        # Oldest first, so the least recently active channels are evicted first
+        for channel, frames, first in reversed(loaded):
+            for seq, frame in enumerate(frames, first):
+                history.append(channel, frame, seq)
+
+    # Engine-specific values sampled when a report is made. Overridden by
+    # engines that have any.
+    def _gauges(self) -> dict[str, float]:
+        return {}
+
+    def stats_report(self) -> str:
+        gauges = self._gauges()
+        gauges['connections'] = len(self.sessions)
+        gauges['channels'] = len(self.channels)
+        if self.history is not None:
+            gauges['history_bytes'] = self.history.size
+        return self.metrics.report(gauges, self.sessions.snapshot())
+
+    # How many connections the engine may accept now: at most `backlog`, and
+    # no more than the accept rate limit allows.
+    def _accept_budget(self, now: float) -> int:
+        bucket = self.accept_limit
+        if bucket is None:
+            return self.backlog
+        return min(self.backlog, int(bucket.available(now)))
+
+    # Account for `count` connections accepted out of a budget. Returns when
+    # the engine may accept again if the rate limit stopped it, or None if it
+    # may carry on whenever there are more.
+    def _accepted(self, count: int, budget: int, now: float) -> float | None:
+        bucket = self.accept_limit
+        if bucket is None:
+            return None
+        bucket.tokens -= count
+        if count < budget or bucket.tokens >= 1:
+            return None
+        return now + (1 - bucket.tokens) / bucket.rate
+
+    # Whether there is room for a connection that was just accepted. If not,
+    # the engine closes it right away, so the client knows to try later
+    # instead of waiting in the backlog.
+    def _room_for_connection(self) -> bool:
+        if not self.max_connections or len(self.sessions) < self.max_connections:
+            return True
+        if self.metrics is not None:
+            self.metrics.count('refused_connections')
+        if self.debug_level == 1:
+            print(f"Refused a connection: already at {self.max_connections} clients")
+        return False
+
+    # Give a new connection its initial nickname and add it to the registry.
+    # Runs on the thread that owns the timers.
+    def _register(self, conn: BaseConnection):
+        _ = self.sessions.add(conn, self.username_generator)
+
+        conn.last_seen = monotonic()
+        self.timers.schedule(conn, conn.last_seen + self.handshake_timeout)
+
+        if self.capture is not None:
+            self.capture.connected(conn)
+
+        if self.bus is not None:
+            self.bus.report_users(len(self.sessions))
+
+        if self.debug_level == 1:
+            print(f"New client {conn.address} connected with initial nickname {conn.nick}")
+
+    # Queue a frame for a connection. Implemented by each engine.
+    def _deliver(self, conn: BaseConnection, frame: bytes):
+        raise NotImplementedError
+
+    # Close a connection from the server side. Implemented by each engine.
+    def _disconnect(self, conn: BaseConnection):
+        raise NotImplementedError
+
+    # Make sure _flush_presence runs once presence.deadline has passed. Called
+    # from whichever thread runs commands. Implemented by each engine.
+    def _schedule_presence(self):
+        raise NotImplementedError
+
+    # When a connection that has finished the handshake next needs looking at,
+    # or None if never.
+    def _next_check(self, conn: BaseConnection) -> float | None:
+        if conn.features & handshake.HEARTBEAT:
+            return conn.last_seen + self.ping_interval
+        if self.idle_timeout > 0:
+            return conn.last_seen + self.idle_timeout
+        return None
+
+    # Handle every connection timer that is due: drop clients that never
+    # finished the handshake or went quiet, and ping heartbeat clients that
+    # have been silent for a while. Engines call this at least once per timer
+    # tick, from the thread that owns the timers.
+    def _expire_timers(self, now: float):
+        for conn in self.timers.expire(now):
+            if conn.closed:
+                continue
+
+            reason = None
+            if conn.codec is None:
+                reason = "did not finish the handshake"
+
+            elif conn.features & handshake.HEARTBEAT:
+                if now - conn.last_seen < self.ping_interval:
+                    self.timers.schedule(conn, conn.last_seen + self.ping_interval)
+                elif conn.pinged_at <= conn.last_seen:
+                    conn.pinged_at = now
+                    self._deliver(conn, shared.encode(events.EventPing(), conn.codec))
+                    self.timers.schedule(conn, now + self.pong_timeout)
+                elif now - conn.pinged_at >= self.pong_timeout:
+                    reason = "stopped answering pings"
+                else:
+                    self.timers.schedule(conn, conn.pinged_at + self.pong_timeout)
+
+            elif self.idle_timeout > 0:
+                if now - conn.last_seen >= self.idle_timeout:
+                    reason = "was idle for too long"
+                else:
+                    self.timers.schedule(conn, conn.last_seen + self.idle_timeout)
+
+            if reason is not None:
+                if self.debug_level == 1:
+                    print(f"Client {conn.address} {reason}, disconnecting.")
+                if self.metrics is not None:
+                    self.metrics.count('reaped')
+                self._disconnect(conn)
+
+    # Turn one frame from a client into a command. Returns None if the frame
+    # was part of the handshake. Raises ValueError on anything a client should
+    # be disconnected for.
+    def _decode(self, conn: BaseConnection, payload) -> commands.CommandObject | None:
+        if conn.codec is None and self._handshake(conn, payload):
+            return None
+
+        client_msg = shared.decode(payload, conn.codec)
+        if not isinstance(client_msg, commands.CommandObject):
+            raise ValueError(f"Expected a command, got {type(client_msg).__name__}")
+        if type(client_msg) is commands.CmdPong:
+            # Receiving it was all that mattered
+            return None
+        conn.seq += 1
+
+        if self.capture is not None:
+            self.capture.command(conn, client_msg, payload)
+        return client_msg
+
+    # Handle the first frame from a client. Returns True if it was a handshake
+    # hello, or False if it is a command from a legacy pickle client.
+    def _handshake(self, conn: BaseConnection, payload) -> bool:
+        conn.last_seen = monotonic()
+        if not handshake.is_hello(payload):
+            if shared.PICKLE.version not in self.accepted_codecs:
+                raise ValueError("Client did not negotiate a protocol version (legacy pickle clients need --allow-pickle)")
+            conn.codec = shared.PICKLE
+            self._schedule_check(conn)
+            return False
+
+        versions, compressions, features = handshake.parse_hello(payload)
+        codec = handshake.choose(versions, self.accepted_codecs)
+        if codec is None:
+            raise ValueError("No protocol version in common with client")
+        compressor = handshake.choose_compression(compressions, self.accepted_compressions)
+
+        conn.codec = codec
+        conn.compressor = conn.decoder.compressor = compressor
+        conn.features = features & self.features
+        self._deliver(conn, shared.frame(handshake.welcome(codec, compressor, conn.features)))
+        self._schedule_check(conn)
+
+        if self.debug_level == 1:
+            compression = compressor.name if compressor is not None else 'no'
+            print(f"Client {conn.address} negotiated the {codec.name} codec with {compression} compression")
+        return True
+
+    # Check a command against the rate limits at time `now`, which must be
+    # fresh: token buckets refill by it. Refused commands are answered with
+    # an EventError and must not be run. Runs on the thread reading from the
+    # client's socket.
+    def _admit(self, conn: BaseConnection, msg: commands.CommandObject, now: float) -> bool:
+        rate_limits = self.rate_limits
+        if rate_limits is None:
+            return True
+
+        channel = self.channels.get(msg.channel) if type(msg) is commands.CmdSendMessage else None
+        reason = rate_limits.check(conn, msg, now, channel)
+        if reason is None:
+            return True
+
+        if self.metrics is not None:
+            self.metrics.count('rate_limited')
+        self._refuse(conn, reason)
+        return False
+
+    # Answer the command just decoded from a client, which will not be run.
+    def _refuse(self, conn: BaseConnection, reason: str):
+        if self.debug_level == 1:
+            print(f"Refused a command from {conn.address}: {reason}")
+        if conn.features & handshake.ACKS:
+            response = events.EventAck(conn.seq, reason)
+        else:
+            response = events.EventError(reason)
+        self._deliver(conn, shared.encode(response, conn.codec, conn.compressor))
+
+    # Replace the handshake timer with the connection's regular one.
+    def _schedule_check(self, conn: BaseConnection):
+        when = self._next_check(conn)
+        if when is None:
+            self.timers.cancel(conn)
+        else:
+            self.timers.schedule(conn, when)
+
+    # Run one command, timing it by command type if metrics are enabled. `seq`
+    # is the command's number (BaseConnection.seq when it was decoded).
+    def _execute(self, origin: BaseConnection, msg: commands.CommandObject, seq: int):
+        metrics = self.metrics
+        if metrics is None:
+            self._handle_command(origin, msg, seq)
+            return
+
+        start = perf_counter_ns()
+        self._handle_command(origin, msg, seq)
+        metrics.command(type(msg), perf_counter_ns() - start)
+
+    # Process commands from the client. Commands from one client are always
+    # handled one at a time, in order.
+    def _handle_command(self, origin: BaseConnection, msg: commands.CommandObject, seq: int):
+        origin_nick = origin.nick
+        targets: frozenset[BaseConnection] | list[BaseConnection] = ()
+        response: events.EventObject = events.EventObject()
+        error: events.EventError | None = None
+        replay: tuple[str, int, int] | None = None
+        presence = self.presence
+
+        match msg:
+            case commands.CmdSendMessage(message=message, channel=channel):
+                try:
+                    # A snapshot; joins and leaves never modify it in place
+                    targets = self.channels[channel].members
+                    if origin not in targets:
+                        error = events.EventError(f"Not in channel '{channel}', consider joining")
+                    else:
+                        response = events.EventReceiveMessage(origin_nick, message, channel)
+
+                except KeyError:
+                    error = events.EventError(f"Channel '{channel}' not found")
+
+            case commands.CmdList():
+                num_users = self.bus.users if self.bus is not None else len(self.sessions)
+                with self.channel_lock:
+                    channels, _ = self.channel_index.page(limit=LEGACY_LIST_LIMIT)
+                response = events.EventList(num_users, tuple(channels))
+                targets = [origin]
+
+            case commands.CmdListChannels(prefix=prefix, after=after, limit=limit):
+                limit = max(1, min(limit, MAX_LIST_PAGE))
+                with self.channel_lock:
+                    channels, next_after = self.channel_index.page(prefix, after, limit)
+                    members = tuple(len(self.channels[name]) for name in channels)
+                response = events.EventChannelList(tuple(channels), members, next_after)
+                targets = [origin]
+
+            case commands.CmdNick(nickname=new_nick):
+                # Across a cluster, the hub decides who gets a name. This is a
+                # round trip, so it happens before taking the lock.
+                if self.bus is not None and not self.bus.claim(origin_nick, new_nick):
+                    error = events.EventError("Duplicate nickname")
+                else:
+                    old_nick = self.sessions.rename(origin, new_nick)
+                    if old_nick is None:
+                        error = events.EventError("Duplicate nickname")
+                    else:
+                        response = events.EventNick(old_nick, new_nick)
+                        if presence is None:
+                            targets = self.sessions.snapshot()
+                        elif presence.rename(origin, old_nick, monotonic()):
+                            self._schedule_presence()
+
+            case commands.CmdJoin(channel=channel):
+                if not valid_channel_name(channel):
+                    error = events.EventError(f"Invalid channel name '{channel}'")
+                else:
+                    target_channel = self._join_channel(origin, channel)
+                    if target_channel is None:
+                        error = events.EventError("Too many channels, can't create another")
+                    else:
+                        if target_channel.name not in origin.channels:
+                            origin.channels += (target_channel.name,)
+                        response = events.EventJoin(origin_nick, channel)
+                        if presence is None:
+                            targets = target_channel.members
+                        elif presence.join(target_channel, origin, monotonic()):
+                            self._schedule_presence()
+                        if (self.history is not None or self.log is not None) and self.join_replay > 0:
+                            replay = (channel, 0, self.join_replay)
+
+            case commands.CmdHistory(channel=channel, before=before, limit=limit):
+                if self.history is None and self.log is None:
+                    error = events.EventError("History is disabled on this server")
+                elif channel not in self.channels:
+                    error = events.EventError(f"Channel '{channel}' not found")
+                elif origin not in self.channels[channel].members:
+                    error = events.EventError(f"Not in channel '{channel}', consider joining")
+                else:
+                    replay = (channel, before, max(1, min(limit, MAX_HISTORY_PAGE)))
+
+            case commands.CmdLeave(channel=channel):
+                if channel not in self.channels:
+                    error = events.EventError(f"Channel '{channel}' not found")
+                else:
+                    target_channel = self._leave_channel(origin, channel)
+                    if target_channel is None:
+                        error = events.EventError(f"Not a member of '{channel}'")
+                    else:
+                        origin.channels = tuple(name for name in origin.channels if name != channel)
+                        response = events.EventLeave(origin_nick, channel)
+                        if presence is None:
+                            targets = target_channel.members
+                        elif presence.leave(target_channel, origin, monotonic()):
+                            self._schedule_presence()
+
+            case commands.CmdStats(token=token):
+                # Constant-time comparison, so the token can't be guessed
+                # byte by byte
+                if self.admin_token is None or not hmac.compare_digest(token.encode(), self.admin_token.encode()):
+                    error = events.EventError("Not authorized")
+                elif self.metrics is None:
+                    error = events.EventError("Metrics are disabled on this server")
+                else:
+                    response = events.EventStats(self.stats_report())
+                    targets = [origin]
+
+            case commands.CmdProfile(token=token, seconds=seconds, allocations=allocations):
+                if self.admin_token is None or not hmac.compare_digest(token.encode(), self.admin_token.encode()):
+                    error = events.EventError("Not authorized")
+                elif self.profiler is None:
+                    error = events.EventError("Profiling is disabled on this server")
+                elif not 0 < seconds <= MAX_PROFILE_SECONDS:
+                    error = events.EventError(f"A profile must last 1 to {MAX_PROFILE_SECONDS} seconds")
+                else:
+                    files = self.profiler.start(seconds, allocations)
+                    if files is None:
+                        error = events.EventError("A profile is already running")
+                    else:
+                        response = events.EventProfile(tuple(files))
+                        targets = [origin]
+
+            case _:
+                print(f"Error: Unknown command '{msg}'", file=stderr)
+
+        # End of match block. Nothing below holds a lock.
+        acks = origin.features & handshake.ACKS
+        if error is not None:
+            print(f"ERROR:\nOrigin: {origin.address}\n{error}\n", file=stderr)
+            if not acks:
+                # Otherwise the ack carries it
+                self._deliver(origin, shared.encode(error, origin.codec, origin.compressor))
+        elif targets:
+            if self.debug_level == 1:
+                print(f"EVENT:\nOrigin: {origin.address}\n{response}\n")
+
+            frames = self._broadcast(response, targets)
+
+            if (self.history is not None or self.log is not None) and isinstance(response, events.EventReceiveMessage):
+                self._record(response, frames)
+
+        # Members connected to other processes get the event from the hub,
+        # even when no client of this process needs it, as when the last
+        # local member leaves a channel. The hub batches nothing, so changes
+        # held back for the next presence batch go out now too.
+        if self.bus is not None and error is None and isinstance(response, CLUSTER_EVENTS):
+            self.bus.publish(response)
+
+        # Messages were logged by _record. Leaving is logged even when nobody
+        # is left in the channel to tell.
+        if self.log is not None and error is None and isinstance(response, (events.EventJoin, events.EventLeave, events.EventNick)):
+            _ = self.log.append(response)
+
+        # After the join event, so the joining client sees it first, unless
+        # presence changes are batched
+        if replay is not None:
+            self._replay(origin, *replay)
+
+        # Last, so everything the command produced for the client comes first
+        if acks:
+            ack = events.EventAck(seq, str(error.error) if error is not None else '')
+            self._deliver(origin, shared.encode(ack, origin.codec, origin.compressor))
+
+    # Deliver an event published by another process of the cluster to the
+    # local clients it concerns.
+    def _remote_event(self, event: events.EventObject):
+        presence = self.presence
+        match event:
+            case events.EventNick(old_nick=old_nick, new_nick=new_nick) if presence is not None:
+                user = presence.remote(old_nick)
+                user.nick = new_nick
+                if presence.rename(user, old_nick, monotonic()):
+                    self._schedule_presence()
+                return
+
+            case events.EventJoin(new_user_nick=nick, channel=channel) if presence is not None:
+                target_channel = self.channels.get(channel)
+                if target_channel is not None and presence.join(target_channel, presence.remote(nick), monotonic()):
+                    self._schedule_presence()
+                return
+
+            case events.EventLeave(left_user_nick=nick, channel=channel) if presence is not None:
+                target_channel = self.channels.get(channel)
+                if target_channel is not None and presence.leave(target_channel, presence.remote(nick), monotonic()):
+                    self._schedule_presence()
+                return
+
+            case events.EventNick():
+                targets = self.sessions.snapshot()
+
+            case events.EventReceiveMessage(channel=channel) | events.EventJoin(channel=channel) | events.EventLeave(channel=channel):
+                target_channel = self.channels.get(channel)
+                targets = target_channel.members if target_channel is not None else ()
+
+            case _:
+                return
+
+        frames = self._broadcast(event, targets)
+
+        # Only for channels that exist here, so history isn't kept for
+        # channels whose members are all on other processes
+        if (self.history is not None or self.log is not None) and isinstance(event, events.EventReceiveMessage) and targets:
+            self._record(event, frames)
+
+    # Add a client to a channel, creating the channel if it doesn't exist.
+    # Returns None if it would have to be created but there are already
+    # max_channels.
+    def _join_channel(self, conn: BaseConnection, name: str) -> Channel | None:
+        with self.channel_lock:
+            channel = self.channels.get(name)
+            if channel is None:
+                if len(self.channels) >= self.max_channels:
+                    return None
+                channel = Channel(name)
+                self.channels[channel.name] = channel
+                self.channel_index.add(channel.name)
+            channel.add(conn)
+        return channel
+
+    # Remove a client from a channel, and the channel with it if that was its
+    # last member. Returns None if the client was not a member.
+    def _leave_channel(self, conn: BaseConnection, name: str) -> Channel | None:
+        with self.channel_lock:
+            channel = self.channels.get(name)
+            if channel is None or not channel.remove(conn):
+                return None
+
+            if not len(channel) and not channel.permanent:
+                del self.channels[name]
+                _ = self.channel_index.remove(name)
+                if self.history is not None:
+                    self.history.discard(name)
+        return channel
+
+    # Announce every presence change collected since the last batch, one
+    # batch per channel with changes, and one to everyone with the renames.
+    # Runs once presence.deadline has passed.
+    def _flush_presence(self):
+        channels, renamed = self.presence.take()
+
+        # Dropping clients who changed their name back again
+        renames = [(old_nick, conn.nick) for conn, old_nick in renamed.items() if conn.nick != old_nick]
+        if renames:
+            old_nicks = tuple(old_nick for old_nick, _ in renames)
+            new_nicks = tuple(new_nick for _, new_nick in renames)
+            self._announce(events.EventPresenceDelta('', (), (), old_nicks, new_nicks),
+                           [events.EventNick(old_nick, new_nick) for old_nick, new_nick in renames],
+                           self.sessions.snapshot())
+
+        for channel, changes in channels.items():
+            members = channel.members
+            if not members or not (changes.joined or changes.left):
+                continue
+
+            name = channel.name
+            joined = tuple(conn.nick for conn in changes.joined)
+            left = tuple(conn.nick for conn in changes.left)
+            legacy: list[events.EventObject] = [events.EventLeave(nick, name) for nick in left]
+            legacy.extend(events.EventJoin(nick, name) for nick in joined)
+            self._announce(events.EventPresenceDelta(name, joined, left, (), ()), legacy, members)
+
+    # Send a batch of presence changes to many connections: as `delta` to
+    # those that negotiated batched presence, and as the `legacy` events,
+    # in a single write, to the others. Each form is serialized once per
+    # codec and compression, as in _broadcast.
+    def _announce(self, delta: events.EventPresenceDelta, legacy: list[events.EventObject], targets):
+        if self.debug_level == 1:
+            print(f"EVENT:\n{delta}\n")
+        if self.metrics is not None:
+            self.metrics.record('fanout', len(targets))
+
+        threshold = self.compress_threshold
+        frames: dict[tuple[shared.Codec, Compressor | None, bool], bytes] = {}
+        for conn in targets:
+            codec = conn.codec
+            if codec is None:
+                # Still handshaking
+                continue
+
+            batched = bool(conn.features & handshake.PRESENCE)
+            key = (codec, conn.compressor, batched)
+            frame = frames.get(key)
+            if frame is None:
+                if batched:
+                    frame = shared.frame(codec.dumps(delta), conn.compressor, threshold)
+                else:
+                    frame = b''.join(shared.frame(codec.dumps(event), conn.compressor, threshold) for event in legacy)
+                frames[key] = frame
+            self._deliver(conn, frame)
+
+    # Send one event to many connections. The event is serialized once per
+    # codec and compressed once per compression algorithm in use, and every
+    # target with the same combination gets the same frame. Returns the
+    # frames, by (codec, compressor).
+    def _broadcast(self, response: events.EventObject, targets) -> dict[tuple[shared.Codec, Compressor | None], bytes]:
+        if self.metrics is not None:
+            self.metrics.record('fanout', len(targets))
+
+        payloads: dict[shared.Codec, bytes] = {}
+        frames: dict[tuple[shared.Codec, Compressor | None], bytes] = {}
+        for conn in targets:
+            codec = conn.codec
+            if codec is None:
+                # Still handshaking
+                continue
+
+            key = (codec, conn.compressor)
+            frame = frames.get(key)
+            if frame is None:
+                payload = payloads.get(codec)
+                if payload is None:
+                    payload = payloads[codec] = codec.dumps(response)
+                frame = frames[key] = shared.frame(payload, conn.compressor, self.compress_threshold)
+            self._deliver(conn, frame)
+        return frames
+
+    # Add a message to the history of its channel, and to the log. Both are
+    # always kept in the binary format, uncompressed, reusing the broadcast
+    # frame when there was one.
+    def _record(self, message: events.EventReceiveMessage, frames: dict[tuple[shared.Codec, Compressor | None], bytes]):
+        frame = frames.get((BINARY, None))
+        if frame is None:
+            frame = shared.encode(message, BINARY)
+
+        if self.log is None:
+            self.history.append(message.channel, frame)
+            return
+
+        # Under the log's lock, so the history numbers messages as the log
+        # does even when two workers record in the same channel at once
+        with self.log.lock:
+            seq = self.log.append(message, frame, message.channel)
+            if self.history is not None:
+                self.history.append(message.channel, frame, seq)
+
+    # Send a page of a channel's history to one client, followed by an
+    # EventHistory, all in a single write.
+    def _replay(self, conn: BaseConnection, channel: str, before: int, limit: int):
+        frames, next_before = [], 0
+        if self.history is not None:
+            frames, next_before = self.history.page(channel, before, limit)
+
+        if self.log is not None and next_before == 0 and len(frames) < limit:
+            # Past the oldest message held in memory; the rest come from disk
+            end = self.history.first(channel) if frames else before
+            older, next_before = self.log.page(channel, end, limit - len(frames))
+            frames = older + frames
+
+        codec = conn.codec
+        compressor = conn.compressor
+        threshold = self.compress_threshold
+        if codec is not BINARY:
+            # Rare: only legacy clients use another codec
+            frames = [shared.encode(BINARY.loads(memoryview(frame)[4:]), codec) for frame in frames]
+        elif compressor is not None:
+            # Compress only the messages that are worth it
+            frames = [
+                shared.frame(memoryview(frame)[4:], compressor, threshold) if len(frame) - 4 >= threshold else frame
+                for frame in frames
+            ]
+
+        count = len(frames)
+        frames.append(shared.encode(events.EventHistory(channel, count, next_before), codec))
+        self._deliver(conn, b''.join(frames))
+
+    # Remove a disconnected client from the server state. Must run after any
+    # commands the client sent before leaving.
+    def _cleanup(self, conn: BaseConnection):
+        self.sessions.remove(conn)
+
+        # Only the channels this client was in, not every channel
+        for name in conn.channels:
+            _ = self._leave_channel(conn, name)
+        conn.channels = ()
+
+        if self.capture is not None:
+            self.capture.disconnected(conn)
+
+        if self.bus is not None:
+            self.bus.release(conn.nick)
+            self.bus.report_users(len(self.sessions))
+
+    # The state a new server process needs to take over the given connections
+    # (see handoff.py), with the output each one has not been sent yet. Must
+    # run while no command is. Returns the snapshot and the history frames it
+    # refers to, which are too many to put in it.
+    def _snapshot(self, conns: list[BaseConnection], outputs: list[bytes]) -> tuple[dict, bytes]:
+        # Channels are not listed: the permanent ones always exist, and the
+        # others are recreated by their members
+        connections = [
+            {
+                'address': conn.address,
+                'nick': conn.nick,
+                'codec': conn.codec.version if conn.codec is not None else None,
+                'compressor': conn.compressor.id if conn.compressor is not None else None,
+                'features': conn.features,
+                'seq': conn.seq,
+                'channels': list(conn.channels),
+                'input': b64encode(conn.decoder.pending()).decode(),
+                'output': b64encode(output).decode(),
+            }
+            for conn, output in zip(conns, outputs)
+        ]
+
+        histories = []
+        frames: list[bytes] = []
+        if self.history is not None:
+            with self.history.lock:
+                # Least recently active first, as they are evicted
+                for name in self.history.active:
+                    entries = self.history.histories[name].entries
+                    if entries:
+                        histories.append({'channel': name, 'first': entries[0][0], 'count': len(entries)})
+                        frames.extend(frame for _, frame in entries)
+        history = b''.join(frames)
+
+        # This skips a name, which does no harm
+        next_user = int(next(self.username_generator).removeprefix("User "))
+
+        snapshot = {
+            'version': SNAPSHOT_VERSION,
+            'next_user': next_user,
+            'connections': connections,
+            'history': histories,
+            'history_bytes': len(history),
+        }
+        return snapshot, history
+
+    # Take over the connections of the server process that handed off to this
+    # one. `conns` are the engine's connections for the sockets it received,
+    # in snapshot order. Runs before the engine starts.
+    def _restore(self, snapshot: dict, history: bytes, conns: list[BaseConnection]):
+        self.username_generator = self.gen_initial_username(snapshot['next_user'])
+
+        now = monotonic()
+        for conn, entry in zip(conns, snapshot['connections']):
+            if entry['codec'] is not None:
+                conn.codec = handshake.CODECS[entry['codec']]
+            if entry['compressor'] is not None:
+                conn.compressor = conn.decoder.compressor = COMPRESSORS[entry['compressor']]
+            conn.features = entry['features'] & self.features
+            conn.seq = entry['seq']
+            conn.decoder.preload(b64decode(entry['input']))
+            self.sessions.adopt(conn)
+
+            for name in entry['channels']:
+                channel = self._join_channel(conn, name)
+                if channel is not None:
+                    conn.channels += (channel.name,)
+
+            conn.last_seen = now
+            if conn.codec is None:
+                self.timers.schedule(conn, now + self.handshake_timeout)
+            else:
+                self._schedule_check(conn)
+
+        if self.history is not None:
+            frames = split_frames(history)
+            for entry in snapshot['history']:
+                first = entry['first']
+                for seq in range(first, first + entry['count']):
+                    self.history.append(entry['channel'], next(frames), seq)
+
+        if self.debug_level == 1:
+            print(f"Took over {len(conns)} clients")
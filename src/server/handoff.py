@@ -0,0 +1,155 @@
+import json
+
+import os
+
+import socket as sckt
+from socket import socket
+
+import struct
+
+# Snapshots in another format are refused, so the old server keeps running
+SNAPSHOT_VERSION = 1
+
+# The snapshot is sent after its length
+LENGTH = struct.Struct('!I')
+
+# File descriptors sent per message. The kernel refuses more than 253
+# (SCM_MAX_FD) in one.
+MAX_FDS = 250
+
+# Sent by the new process once it holds everything, and by the old one once it
+# has let go of the log and the socket paths
+RECEIVED = b'R'
+DONE = b'D'
+
+# Seconds either side waits for the other before giving up
+TIMEOUT = 30.0
+
+class Handoff:
+    """
+    Everything a new server process receives from the one it takes over from:
+    the snapshot (see `ChatCore._snapshot`), the history frames it refers to,
+    the listening socket and one socket per connection in the snapshot, in
+    order.
+    """
+    __slots__ = ('snapshot', 'history', 'listener', 'sockets')
+
+    def __init__(self, snapshot: dict, history: bytes, listener: socket, sockets: list[socket]):
+        self.snapshot: dict = snapshot
+        self.history: bytes = history
+        self.listener: socket = listener
+        self.sockets: list[socket] = sockets
+
+def listen(path: str) -> socket:
+    """
+    Open the Unix socket a new server process connects to when it is started
+    with `--takeover`. Non-blocking, for the selector.
+    """
+    # A leftover socket file from a previous run would make bind() fail
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+    listener = socket(sckt.AF_UNIX, sckt.SOCK_STREAM)
+    listener.bind(path)
+    # Whoever connects gets every client's socket
+    os.chmod(path, 0o600)
+    listener.listen(1)
+    listener.setblocking(False)
+    return listener
+
+def close(listener: socket, path: str):
+    listener.close()
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+def send(sock: socket, snapshot: dict, history: bytes, fds: list[int]):
+    """
+    Old server's side, first half: send the snapshot, the history and the
+    file descriptors, and wait for the new process to confirm it has them.
+    Until then nothing has changed hands, so on any error the old server can
+    carry on as before.
+    """
+    data = json.dumps(snapshot, separators=(',', ':')).encode()
+    sock.sendall(LENGTH.pack(len(data)) + data)
+    sock.sendall(history)
+
+    # One byte of data to carry each batch; with exactly one byte read per
+    # batch, the receiver never mixes two batches up
+    for i in range(0, len(fds), MAX_FDS):
+        _ = sckt.send_fds(sock, [b'\0'], fds[i:i + MAX_FDS])
+
+    if _receive_exactly(sock, 1) != RECEIVED:
+        raise ConnectionError("New server process did not confirm the handoff")
+
+def finish(sock: socket):
+    """
+    Old server's side, second half: tell the new process it may start. After
+    this, the old server must not touch any client again.
+    """
+    sock.sendall(DONE)
+
+def receive(path: str, timeout: float = TIMEOUT) -> Handoff:
+    """
+    New server's side: connect to the old server at `path` and take
+    everything over. Returns once the old server has let go, so the new one
+    may open the log and the socket paths.
+    """
+    sock = socket(sckt.AF_UNIX, sckt.SOCK_STREAM)
+    with sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+
+        length: int = LENGTH.unpack(_receive_exactly(sock, LENGTH.size))[0]
+        snapshot = json.loads(_receive_exactly(sock, length))
+        history = _receive_exactly(sock, snapshot['history_bytes'])
+
+        count = len(snapshot['connections']) + 1
+        fds: list[int] = []
+        try:
+            while len(fds) < count:
+                _, received, flags, _ = sckt.recv_fds(sock, 1, MAX_FDS)
+                fds.extend(received)
+                if flags & sckt.MSG_CTRUNC:
+                    raise ConnectionError("File descriptors were lost in transit; is the limit on open files too low?")
+                if not received:
+                    raise ConnectionError("Old server closed the connection during the handoff")
+
+            if snapshot.get('version') != SNAPSHOT_VERSION:
+                raise ValueError(f"Unsupported snapshot version {snapshot.get('version')}")
+        except BaseException:
+            for fd in fds:
+                os.close(fd)
+            raise
+
+        sockets = [socket(fileno=fd) for fd in fds]
+        sock.sendall(RECEIVED)
+        if _receive_exactly(sock, 1) != DONE:
+            raise ConnectionError("Old server did not finish the handoff")
+
+    return Handoff(snapshot, history, sockets[0], sockets[1:])
+
+def split_frames(data: bytes):
+    """
+    The complete, uncompressed frames laid end to end in `data`, such as the
+    history sent with a snapshot.
+    """
+    offset = 0
+    while offset < len(data):
+        end = offset + LENGTH.size + LENGTH.unpack_from(data, offset)[0]
+        yield data[offset:end]
+        offset = end
+
+def _receive_exactly(sock: socket, size: int) -> bytes:
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            raise ConnectionError("Handoff connection closed early")
+        received += count
+    return bytes(data)
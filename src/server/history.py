@@ -0,0 +1,147 @@
+from collections import OrderedDict, deque
+from itertools import islice
+from threading import Lock
+
+class ChannelHistory:
+    """
+    The most recent messages of one channel, kept as complete frames exactly
+    as they were broadcast, so replaying them needs no serialization.
+
+    Every message gets the next sequence number of its channel. Sequence
+    numbers keep counting when old messages are evicted, so clients can page
+    backwards with them.
+    """
+    __slots__ = ('entries', 'size', 'next_seq')
+
+    def __init__(self):
+        # (sequence number, frame), oldest first. Sequence numbers are
+        # contiguous, so a message is found by arithmetic.
+        self.entries: deque[tuple[int, bytes]] = deque()
+        self.size: int = 0
+        self.next_seq: int = 1
+
+    def append(self, frame: bytes, max_entries: int, max_bytes: int, seq: int = 0) -> int:
+        """
+        Store a frame and drop the oldest ones until the channel is within
+        its limits again. Returns the change in stored bytes.
+
+        `seq` numbers the message, if it is numbered elsewhere (by the message
+        log). If that leaves a gap, the older messages are dropped, to keep
+        the numbers contiguous.
+        """
+        before = self.size
+        if seq and seq != self.next_seq:
+            _ = self.clear()
+            self.next_seq = seq
+
+        entries = self.entries
+        entries.append((self.next_seq, frame))
+        self.next_seq += 1
+        self.size += len(frame)
+
+        # The newest frame is always kept, even if it is over the limit alone
+        while len(entries) > max_entries or (self.size > max_bytes and len(entries) > 1):
+            self.size -= len(entries.popleft()[1])
+        return self.size - before
+
+    def clear(self) -> int:
+        """
+        Drop every stored frame. Returns the number of bytes released.
+        """
+        released = self.size
+        self.entries = deque()
+        self.size = 0
+        return released
+
+    def page(self, before: int, limit: int) -> tuple[list[bytes], int]:
+        """
+        Return up to `limit` frames older than sequence number `before` (or
+        the newest ones if `before` is 0), oldest first, along with the
+        `before` to use for the page preceding them, or 0 if there is none.
+        """
+        entries = self.entries
+        if not entries or limit <= 0:
+            return [], 0
+
+        first = entries[0][0]
+        end = self.next_seq if before <= 0 else min(before, self.next_seq)
+        start = max(end - limit, first)
+        if start >= end:
+            return [], 0
+
+        frames = [frame for _, frame in islice(entries, start - first, end - first)]
+        return frames, (start if start > first else 0)
+
+class HistoryStore:
+    """
+    Message history of every channel, with a limit per channel and one for
+    the whole server. When the server-wide limit is reached, the channels
+    that were least recently written to lose their history first.
+    """
+    __slots__ = ('lock', 'histories', 'active', 'size', 'max_entries', 'max_channel_bytes', 'max_bytes')
+
+    def __init__(self, max_entries: int, max_channel_bytes: int, max_bytes: int):
+        self.lock: Lock = Lock()
+
+        self.histories: dict[str, ChannelHistory] = {}
+
+        # Channels that currently hold frames, least recently written first
+        self.active: OrderedDict[str, None] = OrderedDict()
+
+        # Total bytes of frames held across all channels
+        self.size: int = 0
+
+        self.max_entries: int = max_entries
+        self.max_channel_bytes: int = max_channel_bytes
+        self.max_bytes: int = max_bytes
+
+    def append(self, channel: str, frame: bytes, seq: int = 0):
+        """
+        Record a message broadcast to a channel, numbered `seq` if it is
+        numbered elsewhere (see `ChannelHistory.append`).
+        """
+        with self.lock:
+            history = self.histories.get(channel)
+            if history is None:
+                history = self.histories[channel] = ChannelHistory()
+
+            self.size += history.append(frame, self.max_entries, self.max_channel_bytes, seq)
+            self.active[channel] = None
+            self.active.move_to_end(channel)
+
+            # Never evict the channel that was just written to
+            while self.size > self.max_bytes and len(self.active) > 1:
+                name, _ = self.active.popitem(last=False)
+                self.size -= self.histories[name].clear()
+
+    def page(self, channel: str, before: int, limit: int) -> tuple[list[bytes], int]:
+        """
+        See `ChannelHistory.page`. A channel nobody has written to has an
+        empty history.
+        """
+        with self.lock:
+            history = self.histories.get(channel)
+            if history is None:
+                return [], 0
+            return history.page(before, limit)
+
+    def first(self, channel: str) -> int:
+        """
+        Number of the oldest message held for a channel, or 0 if there are
+        none.
+        """
+        with self.lock:
+            history = self.histories.get(channel)
+            if history is None or not history.entries:
+                return 0
+            return history.entries[0][0]
+
+    def discard(self, channel: str):
+        """
+        Forget a channel entirely.
+        """
+        with self.lock:
+            history = self.histories.pop(channel, None)
+            if history is not None:
+                self.size -= history.clear()
+                _ = self.active.pop(channel, None)
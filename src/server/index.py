@@ -0,0 +1,118 @@
+from bisect import bisect_left, bisect_right, insort
+
+from collections.abc import Iterator
+
+class SortedIndex:
+    """
+    A set of strings kept in sorted order, for listing a range of them
+    without sorting or copying the whole set.
+
+    Names are split into chunks of at most 2 * `load`, with the largest name
+    of each chunk in `maxes`. Adding or removing a name bisects `maxes`, then
+    shifts at most one chunk, so it stays cheap at any size. Not thread-safe.
+    """
+    __slots__ = ('load', 'chunks', 'maxes', 'size')
+
+    def __init__(self, load: int = 512):
+        self.load: int = load
+        self.chunks: list[list[str]] = []
+        self.maxes: list[str] = []
+        self.size: int = 0
+
+    def add(self, name: str):
+        """
+        Add a name that is not in the index yet.
+        """
+        chunks = self.chunks
+        maxes = self.maxes
+        self.size += 1
+        if not chunks:
+            chunks.append([name])
+            maxes.append(name)
+            return
+
+        i = bisect_left(maxes, name)
+        if i == len(maxes):
+            # Past the end: extend the last chunk
+            i -= 1
+            chunks[i].append(name)
+            maxes[i] = name
+        else:
+            insort(chunks[i], name)
+
+        chunk = chunks[i]
+        if len(chunk) > 2 * self.load:
+            half = len(chunk) // 2
+            chunks.insert(i + 1, chunk[half:])
+            del chunk[half:]
+            maxes.insert(i, chunk[-1])
+
+    def remove(self, name: str) -> bool:
+        """
+        Remove a name. Returns False if it was not in the index.
+        """
+        maxes = self.maxes
+        i = bisect_left(maxes, name)
+        if i == len(maxes):
+            return False
+
+        chunk = self.chunks[i]
+        j = bisect_left(chunk, name)
+        if j == len(chunk) or chunk[j] != name:
+            return False
+
+        del chunk[j]
+        self.size -= 1
+        if not chunk:
+            del self.chunks[i]
+            del maxes[i]
+        elif j == len(chunk):
+            maxes[i] = chunk[-1]
+        return True
+
+    def range(self, start: str, inclusive: bool = True) -> Iterator[str]:
+        """
+        Names from `start` onwards, in order. Changing the index while
+        iterating is not allowed.
+        """
+        find = bisect_left if inclusive else bisect_right
+        chunks = self.chunks
+        i = find(self.maxes, start)
+        if i == len(chunks):
+            return
+
+        chunk = chunks[i]
+        yield from chunk[find(chunk, start):]
+        for i in range(i + 1, len(chunks)):
+            yield from chunks[i]
+
+    def page(self, prefix: str = '', after: str = '', limit: int = 100) -> tuple[list[str], str]:
+        """
+        Up to `limit` names starting with `prefix` that sort after `after`,
+        and the `after` to pass for the next page ('' if there are no more).
+        """
+        names: list[str] = []
+        if after < prefix:
+            candidates = self.range(prefix)
+        else:
+            candidates = self.range(after, inclusive=False)
+
+        for name in candidates:
+            if not name.startswith(prefix):
+                # Everything with the prefix sorts together
+                return names, ''
+            if len(names) == limit:
+                return names, names[-1]
+            names.append(name)
+        return names, ''
+
+    def __contains__(self, name: str) -> bool:
+        i = bisect_left(self.maxes, name)
+        if i == len(self.maxes):
+            return False
+        chunk = self.chunks[i]
+        j = bisect_left(chunk, name)
+        return j < len(chunk) and chunk[j] == name
+
+    def __len__(self) -> int:
+        return self.size
@@ -1,10 +1,16 @@
 import argparse
 
+from base64 import b64decode
+
 from queue import Queue
 
 import selectors
 from selectors import DefaultSelector
 
+import os
+
+import signal
+
 import sys
 from sys import stderr
 
@@ -13,235 +19,800 @@ from socket import socket
 
 import threading
 
-from src.protocol import commands
-from src.protocol import events
-from src.protocol import shared
+import time
 
-class ChatServer:
+from src.protocol import commands
+from src.protocol.compression import COMPRESSORS, DEFAULT_THRESHOLD, ZLIB
+
+from .aio import AsyncChatServer
+from .capture import TrafficCapture
+from .cluster import run_cluster
+from .connection import Connection
+from .core import ACCEPT_RETRY, ChatCore
+from . import handoff
+from .handoff import Handoff
+from .history import HistoryStore
+from .metrics import Metrics
+from .persist import MessageLog
+from .profiler import Profiler
+from .ratelimit import DEFAULT_CHANNEL_LIMIT, RateLimits, parse_limit, parse_limits
+
+class ChatServer(ChatCore):
+    """
+    The threaded server engine: a selector loop for all socket I/O, and a pool
+    of worker threads that run commands.
+
+    Keyword arguments not listed in `__init__` are passed on to `ChatCore`.
+    """
     __slots__ = (
-        'debug_level',
-        'username_generator',
         'selectors',
-        'connections',
-        'channels',
-        'lock',
-        'work_queue',
+        'work_queues',
+        'queue_limit',
+        'next_worker',
+        'pending_flush',
+        'pending_lock',
+        'wakeup_pending',
+        'wakeup_send',
+        'wakeup_recv',
+        'flush_interval',
+        'flush_deadline',
+        'batch_cap',
+        'write_calls',
+        'frames_written',
+        'listener',
+        'handoff_path',
+        'handoff_listener',
+        'handed_off',
+        'accept_resume',
+        'profile_requested',
     )
 
-    def __init__(self, port: int, debug_level: int):
-        self.debug_level: int = debug_level
-
-        # Used for the 3 worker threads
-        self.lock: threading.Lock = threading.Lock()
-        self.work_queue: Queue[tuple[socket, commands.CommandObject]] = Queue()
-
-        # Used to generate the initial username of a new clint
-        self.username_generator = self.gen_initial_username()
+    def __init__(self, port: int, debug_level: int, high_water: int = 1 << 20, overflow_policy: str = 'disconnect',
+                 allow_pickle: bool = False, workers: int = 3, reuse_port: bool = False, bus=None,
+                 flush_interval: float = 0.0, batch_cap: int = 64, queue_limit: int = 0,
+                 handoff_path: str | None = None, takeover: Handoff | None = None, **options):
+        super().__init__(debug_level, high_water, overflow_policy, allow_pickle, bus, **options)
+
+        # One queue per worker thread. Every connection is pinned to a single
+        # worker, so its commands run in the order they were sent while
+        # commands from different clients run in parallel. A None command asks
+        # the worker to clean up after a disconnected client. Each command
+        # comes with when it was queued, if metrics are enabled, and its
+        # number (see BaseConnection.seq).
+        if workers < 1:
+            raise ValueError("At least one worker thread is required")
+        self.work_queues: list[Queue[tuple[Connection, commands.CommandObject | None, int, int]]] = [
+            Queue() for _ in range(workers)
+        ]
+        self.next_worker: int = 0
+
+        # Most commands waiting in a single worker's queue, or 0 for no limit.
+        # Commands arriving while it is full are refused with an EventError
+        # rather than queued behind work the server can't keep up with.
+        # Cleanup requests are always queued.
+        self.queue_limit: int = queue_limit
 
         # Global selector. This is used to listen on connections without blocking.
         self.selectors: DefaultSelector = DefaultSelector()
 
-        # Dictionary of active connections, mapping sockets to nicknames.
-        self.connections: dict[socket, str] = {}
-
-        self.channels: dict[str, set[socket]] = {
-            "General": set(),
-            "Meta": set(),
-            "Misc": set(),
-        }
-
-        listener: socket = socket(sckt.AF_INET, sckt.SOCK_STREAM) # AF_INET: IPv4; SOCK_STREAM: TCP
-        listener.setsockopt(sckt.SOL_SOCKET, sckt.SO_REUSEADDR, 1) # Fix 'address already in use'
-        listener.bind(('', port)) # Empty string listens on all interfaces
-        listener.listen(5) # Allow 5 unaccepted connections before dropping further requests
+        # Connections with frames waiting to be written. Workers append to this
+        # list and wake the selector thread, which does the actual writing.
+        self.pending_flush: list[Connection] = []
+        self.pending_lock: threading.Lock = threading.Lock()
+        self.wakeup_pending: bool = False
+
+        # Write coalescing. Everything queued for a connection goes out in one
+        # sendmsg() call of at most batch_cap frames. With a flush interval,
+        # the selector thread also waits up to that long after the first
+        # queued frame, so more frames can pile up per call.
+        self.flush_interval: float = flush_interval
+        self.flush_deadline: float | None = None
+        self.batch_cap: int = max(1, min(batch_cap, os.sysconf('SC_IOV_MAX')))
+
+        # Frames written and the sendmsg() calls it took; see write_stats()
+        self.write_calls: int = 0
+        self.frames_written: int = 0
+
+        # The selector thread may be blocked in select(), so workers write a
+        # byte to this socket pair to wake it up.
+        self.wakeup_recv, self.wakeup_send = sckt.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        _ = self.selectors.register(self.wakeup_recv, selectors.EVENT_READ, data=self._wakeup_callback)
+
+        # Set by the SIGUSR1 handler; the selector thread starts the profile
+        self.profile_requested: bool = False
+
+        if takeover is not None:
+            # Already bound and listening, in the server process this one
+            # replaces. Connections that arrived meanwhile wait in its backlog.
+            listener = takeover.listener
+        else:
+            listener: socket = socket(sckt.AF_INET, sckt.SOCK_STREAM) # AF_INET: IPv4; SOCK_STREAM: TCP
+            listener.setsockopt(sckt.SOL_SOCKET, sckt.SO_REUSEADDR, 1) # Fix 'address already in use'
+            if reuse_port:
+                # Several processes listen on the same port; the kernel spreads
+                # incoming connections between them
+                listener.setsockopt(sckt.SOL_SOCKET, sckt.SO_REUSEPORT, 1)
+            listener.bind(('', port)) # Empty string listens on all interfaces
+            listener.listen(self.backlog) # Connections the kernel holds until they are accepted
         listener.setblocking(False) # Necessary for selectors to work
+        self.listener: socket = listener
 
         _ = self.selectors.register(listener, selectors.EVENT_READ, data=self._listener_callback)
 
-        # Start the worker threads
-        for i in range(3):
-            t = threading.Thread(target=self._worker_thread, daemon=True)
+        # While accepting is paused (see _pause_accepting), when to resume
+        self.accept_resume: float | None = None
+
+        # Graceful upgrades: a new server process started with --takeover
+        # connects to this Unix socket and is handed the listener and every
+        # client (see _hand_off). Once it has them, this one stops.
+        self.handoff_path: str | None = handoff_path
+        self.handoff_listener: socket | None = None
+        self.handed_off: bool = False
+
+        # Start the worker threads, named so profiles tell them apart
+        for i, work_queue in enumerate(self.work_queues):
+            t = threading.Thread(target=self._worker_thread, args=(work_queue,), name=f'worker-{i}', daemon=True)
             t.start()
 
-    def _worker_thread(self):
+        if takeover is not None:
+            self._take_over(takeover)
+
+        # Only now, since the previous server process had it until the
+        # takeover finished
+        if handoff_path is not None:
+            self.handoff_listener = handoff.listen(handoff_path)
+            _ = self.selectors.register(self.handoff_listener, selectors.EVENT_READ, data=self._handoff_callback)
+
+        if bus is not None:
+            bus.attach(self)
+
+    def _worker_thread(self, work_queue: Queue):
         while True:
             # Note: queue.Queue is inherently blocking and thread-safe, so no
             # locking is required here.
-            origin, event = self.work_queue.get()
+            origin, event, queued, seq = work_queue.get()
             try:
-                with self.lock:
-                    self._handle_command(origin, event)
+                if queued:
+                    self.metrics.record('work_queue_wait_us', time.perf_counter_ns() - queued)
+
+                if event is None:
+                    self._cleanup(origin)
+                elif not origin.closed:
+                    self._execute(origin, event, seq)
 
             except Exception as e:
                 print(f"Error in worker thread: {e}", file=stderr)
 
             finally:
-                self.work_queue.task_done()
-
-    def gen_initial_username(self):
-        x = 0
-        while True:
-            x += 1
-            username = f"User {x}"
-            yield username
+                work_queue.task_done()
 
     def run(self):
-        while True:
-            events = self.selectors.select(timeout=180) # 3 minutes * 60 = 180 seconds
-            if len(events) == 0:
-                raise TimeoutError
-
-            for key, _ in events:
+        if self.profiler is not None:
+            _ = signal.signal(signal.SIGUSR1, self._profile_signal)
+
+        while not self.handed_off:
+            # Sleep until the next timer tick or flush, or indefinitely if
+            # there is neither
+            now = time.monotonic()
+            timeout = self.timers.timeout(now)
+            presence_deadline = self.presence.deadline if self.presence is not None else None
+            for deadline in (self.flush_deadline, self.accept_resume, presence_deadline):
+                if deadline is not None:
+                    wait = max(0.0, deadline - now)
+                    timeout = wait if timeout is None else min(timeout, wait)
+
+            events = self.selectors.select(timeout=timeout)
+
+            # Before the callbacks, so they see a fresh timers.now
+            now = time.monotonic()
+            self._expire_timers(now)
+
+            if self.profile_requested:
+                self.profile_requested = False
+                _ = self.profiler.start()
+
+            if self.presence is not None and self.presence.deadline is not None and now >= self.presence.deadline:
+                self._flush_presence()
+
+            if self.accept_resume is not None and now >= self.accept_resume:
+                self.accept_resume = None
+                _ = self.selectors.register(self.listener, selectors.EVENT_READ, data=self._listener_callback)
+
+            metrics = self.metrics
+            if metrics is not None:
+                start = time.perf_counter_ns()
+
+            for key, mask in events:
                 callback = key.data
-                callback(key)
+                callback(key, mask)
+                if self.handed_off:
+                    # The sockets belong to the new process now
+                    return
+
+            if self.flush_deadline is not None and time.monotonic() >= self.flush_deadline:
+                self._flush_pending()
+
+            if metrics is not None:
+                metrics.record('selector_iteration_us', time.perf_counter_ns() - start)
+                metrics.record('selector_events', len(events))
+
+    def write_stats(self) -> dict[str, float]:
+        """
+        How well writes are being coalesced.
+        """
+        return {
+            'frames': self.frames_written,
+            'syscalls': self.write_calls,
+            'frames_per_syscall': self.frames_written / self.write_calls if self.write_calls else 0.0,
+        }
+
+    def _gauges(self) -> dict[str, float]:
+        stats = self.write_stats()
+        return {
+            'work_queue_depth': sum(work_queue.qsize() for work_queue in self.work_queues),
+            'pending_flush': len(self.pending_flush),
+            'outbound_bytes': sum(conn.outbound_bytes for conn in self.sessions.snapshot()),
+            'frames_written': stats['frames'],
+            'write_syscalls': stats['syscalls'],
+            'frames_per_syscall': stats['frames_per_syscall'],
+        }
 
     def shutdown(self):
-        # Close all the open connections registered with the selector
+        if self.debug_level == 1:
+            print(f"Write stats: {self.write_stats()}")
+
+        self.close_metrics()
+        self.close_log()
+        self.close_capture()
+
+        if self.handoff_listener is not None:
+            _ = self.selectors.unregister(self.handoff_listener)
+            handoff.close(self.handoff_listener, self.handoff_path)
+
+        if self.accept_resume is not None:
+            # Not registered while paused
+            self.listener.close()
+
+        # Close all the open connections registered with the selector. After a
+        # handoff, this only closes this process's copies of the sockets, so
+        # the clients stay connected to the new process.
         for _, key in list(self.selectors.get_map().items()):
             sock: socket = key.fileobj
             _ = self.selectors.unregister(sock)
             sock.close()
 
+        self.wakeup_send.close()
         self.selectors.close()
 
-    # Process commands from the client.
-    def _handle_command(self, origin: socket, msg: commands.CommandObject):
-        origin_nick = self.connections[origin]
-        targets: set[socket] = set()
-        response: events.EventObject = events.EventObject()
-        error: events.EventError | None = None
-
-        match msg:
-            case commands.CmdSendMessage(message=message, channel=channel):
-                try:
-                    targets = self.channels[channel]
-                    if origin not in targets:
-                        error = events.EventError(f"Not in channel '{channel}', consider joining")
-                    else:
-                        response = events.EventReceiveMessage(origin_nick, message, channel)
-
-                except KeyError:
-                    error = events.EventError(f"Channel '{channel}' not found")
-
-            case commands.CmdList():
-                num_users = len(self.connections)
-                channels = tuple(self.channels.keys())
-                response = events.EventList(num_users, channels)
-                targets = {origin}
-
-            case commands.CmdNick(nickname=new_nick):
-                if new_nick in self.connections.values():
-                    error = events.EventError("Duplicate nickname")
+    # Queue a frame for a connection. Safe to call from any thread; the
+    # selector thread performs the write.
+    def _deliver(self, conn: Connection, frame: bytes):
+        with conn.lock:
+            if not conn.enqueue(frame, self.high_water, self.drop_on_overflow):
+                if conn.closed:
+                    return
+                if not conn.overflowed:
+                    if self.debug_level == 1:
+                        print(f"Dropped frame for slow client {conn.address}")
+                    return
+                # Otherwise, fall through so the selector thread notices the
+                # overflow and disconnects the client.
+            elif self.metrics is not None:
+                conn.frames_out += 1
+                conn.bytes_out += len(frame)
+
+            if conn.flush_scheduled:
+                return
+            conn.flush_scheduled = True
+
+        with self.pending_lock:
+            self.pending_flush.append(conn)
+            wake = not self.wakeup_pending
+            self.wakeup_pending = True
+
+        if wake:
+            self._wake()
+
+    # The workers started a presence window. Wake the selector thread, so it
+    # sleeps no longer than presence.deadline.
+    def _schedule_presence(self):
+        with self.pending_lock:
+            wake = not self.wakeup_pending
+            self.wakeup_pending = True
+
+        if wake:
+            self._wake()
+
+    # Interrupt the selector thread's select(). Only call this after setting
+    # wakeup_pending, under pending_lock.
+    def _wake(self):
+        try:
+            _ = self.wakeup_send.send(b'\0')
+        except BlockingIOError:
+            # The pair is already full of wakeups; the selector will run
+            pass
+
+    # SIGUSR1 handler. It runs on the selector thread, between any two
+    # bytecodes, possibly while that thread holds a lock, so it takes none:
+    # starting a profile takes locks and starts a thread, so the loop does
+    # it, and pending_lock is skipped, at the cost of a spare wakeup.
+    def _profile_signal(self, signum, frame):
+        self.profile_requested = True
+        try:
+            _ = self.wakeup_send.send(b'\0')
+        except OSError:
+            # Full of wakeups already, or closed by shutdown()
+            pass
+
+    # Callback for the listener socket. Accepts every waiting connection,
+    # up to the budget, rather than one per selector pass.
+    def _listener_callback(self, key, mask):
+        sock = key.fileobj
+        now = self.timers.now
+        budget = self._accept_budget(now)
+        accepted = 0
+        while accepted < budget:
+            try:
+                client_sock, address = sock.accept()
+            except BlockingIOError:
+                # Nobody left waiting
+                break
+            except OSError as e:
+                # Out of file descriptors or memory
+                print(f"Error while accepting a connection: {e}", file=stderr)
+                self._pause_accepting(now + ACCEPT_RETRY)
+                return
+            accepted += 1
+
+            if not self._room_for_connection():
+                client_sock.close()
+                continue
+
+            # Necessary for selectors to work
+            client_sock.setblocking(False)
+
+            conn = Connection(client_sock, address, "", self.read_buffer)
+            self._register(conn)
+
+            # Round-robin assignment of connections to workers
+            conn.worker = self.next_worker
+            self.next_worker = (self.next_worker + 1) % len(self.work_queues)
+
+            _ = self.selectors.register(client_sock, selectors.EVENT_READ, data=self._message_callback)
+
+        resume = self._accepted(accepted, budget, now)
+        if resume is not None:
+            self._pause_accepting(resume)
+
+    # Stop watching the listener until `until`; run() resumes it. New
+    # connections wait in the kernel's backlog meanwhile.
+    def _pause_accepting(self, until: float):
+        if self.accept_resume is None:
+            _ = self.selectors.unregister(self.listener)
+        self.accept_resume = until
+
+    # Callback for the handoff socket: a new server process wants to take
+    # over. Until it confirms it has everything, nothing changes hands, so if
+    # it fails, this server carries on.
+    def _handoff_callback(self, key, mask):
+        try:
+            successor, _ = self.handoff_listener.accept()
+        except BlockingIOError:
+            return
+
+        with successor:
+            successor.settimeout(handoff.TIMEOUT)
+            try:
+                self._hand_off(successor)
+            except (OSError, ValueError) as e:
+                if self.handed_off:
+                    print(f"New server process failed at the end of the handoff: {e}", file=stderr)
                 else:
-                    old_nick = self.connections[origin]
-                    self.connections[origin] = new_nick
-                    response = events.EventNick(old_nick, new_nick)
-                    targets = set(self.connections.keys())
-
-            case commands.CmdJoin(channel=channel):
-                try:
-                    targets = self.channels[channel]
-                    targets.add(origin)
-                    response = events.EventJoin(origin_nick, channel)
-
-                except KeyError:
-                    error = events.EventError(f"Channel '{channel}' not found")
-
-            case commands.CmdLeave(channel=channel):
-                if channel not in self.channels:
-                    error = events.EventError(f"Channel '{channel}' not found")
+                    print(f"Handoff to a new server process failed, carrying on: {e}", file=stderr)
+
+    # Hand the listener and every client to a new server process. Runs on
+    # the selector thread, so no client is read from meanwhile.
+    def _hand_off(self, successor: socket):
+        # Run every queued command and write out what they produced, so the
+        # state is final and as little output as possible is left over
+        for work_queue in self.work_queues:
+            work_queue.join()
+        if self.presence is not None:
+            # Nothing else would announce them
+            self._flush_presence()
+        self._flush_pending()
+        for work_queue in self.work_queues:
+            # Cleanups of clients whose writes just failed
+            work_queue.join()
+
+        conns: list[Connection] = []
+        outputs: list[bytes] = []
+        for conn in self.sessions.snapshot():
+            with conn.lock:
+                if conn.closed:
+                    continue
+                conns.append(conn)
+                # Unwritten output goes along, and the new process sends it
+                outputs.append(b''.join(conn.outbound or ()))
+
+        snapshot, history = self._snapshot(conns, outputs)
+        fds = [self.listener.fileno()] + [conn.sock.fileno() for conn in conns]
+        handoff.send(successor, snapshot, history, fds)
+
+        # No way back from here. Let go of everything the new process opens
+        # at the same paths before it starts.
+        self.handed_off = True
+        self.close_metrics()
+        self.close_log()
+        self.close_capture()
+        _ = self.selectors.unregister(self.handoff_listener)
+        handoff.close(self.handoff_listener, self.handoff_path)
+        self.handoff_listener = None
+        handoff.finish(successor)
+
+        print(f"Handed off {len(conns)} clients to a new server process.")
+
+    # Register the clients handed over by the previous server process.
+    def _take_over(self, takeover: Handoff):
+        conns: list[Connection] = []
+        for sock, entry in zip(takeover.sockets, takeover.snapshot['connections']):
+            sock.setblocking(False)
+            conn = Connection(sock, tuple(entry['address']), entry['nick'], self.read_buffer)
+            conn.worker = self.next_worker
+            self.next_worker = (self.next_worker + 1) % len(self.work_queues)
+            conns.append(conn)
+
+        self._restore(takeover.snapshot, takeover.history, conns)
+
+        for conn, entry in zip(conns, takeover.snapshot['connections']):
+            _ = self.selectors.register(conn.sock, selectors.EVENT_READ, data=self._message_callback)
+            output = b64decode(entry['output'])
+            if output:
+                self._deliver(conn, output)
+
+    # Callback for the wakeup socket. Writes out everything the workers queued.
+    def _wakeup_callback(self, key, mask):
+        try:
+            while self.wakeup_recv.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        if self.flush_interval <= 0:
+            self._flush_pending()
+        elif self.flush_deadline is None:
+            # Give the workers a moment to queue more; run() flushes once the
+            # deadline passes
+            self.flush_deadline = time.monotonic() + self.flush_interval
+
+    # Write out every connection the workers queued frames for.
+    def _flush_pending(self):
+        self.flush_deadline = None
+        with self.pending_lock:
+            pending = self.pending_flush
+            self.pending_flush = []
+            self.wakeup_pending = False
+
+        for conn in pending:
+            self._flush(conn)
+
+    # Write a connection's backlog and keep its selector registration in sync:
+    # EVENT_WRITE is only requested while there is something left to write.
+    def _flush(self, conn: Connection):
+        try:
+            with conn.lock:
+                conn.flush_scheduled = False
+                if conn.closed:
+                    return
+                overflowed = conn.overflowed
+                if overflowed:
+                    drained = True
                 else:
-                    try:
-                        targets = self.channels[channel]
-                        targets.remove(origin)
-                        response = events.EventLeave(origin_nick, channel)
-
-                    except KeyError:
-                        error = events.EventError(f"Not a member of '{channel}'")
-
-            case _:
-                print(f"Error: Unknown command '{msg}'", file=stderr)
+                    drained, frames, calls = conn.flush(self.batch_cap)
+                    self.frames_written += frames
+                    self.write_calls += calls
 
-        # End of match block
-        if error is not None:
-            print(f"ERROR:\nOrigin: {origin.getpeername()}\n{error}\n", file=stderr)
-            shared.send(error, origin)
-        else:
+        except OSError as e:
+            # Broken pipe, reset by peer, etc.
             if self.debug_level == 1:
-                print(f"EVENT:\nOrigin: {origin.getpeername()}\n{response}\n")
-
-            for conn in targets:
-                shared.send(response, conn)
-
-    # Callback for the listener socket.
-    def _listener_callback(self, key):
-        sock = key.fileobj
-        client_sock, _ = sock.accept()
+                print(f"Write to client {conn.address} failed: {e}")
+            self._disconnect(conn)
+            return
+
+        if overflowed:
+            print(f"Client {conn.address} exceeded the outbound limit, disconnecting.", file=stderr)
+            self._disconnect(conn)
+
+        elif drained and conn.writing:
+            conn.writing = False
+            _ = self.selectors.modify(conn.sock, selectors.EVENT_READ, data=self._message_callback)
+
+        elif not drained and not conn.writing:
+            conn.writing = True
+            _ = self.selectors.modify(conn.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, data=self._message_callback)
+
+    # Close a client's socket and hand the rest of the cleanup to its worker.
+    def _disconnect(self, conn: Connection):
+        with conn.lock:
+            if conn.closed:
+                return
+            # From now on workers skip this client's commands and drop frames
+            # addressed to it
+            conn.closed = True
+            conn.outbound = None
+            conn.outbound_bytes = 0
 
-        # Necessary for selectors to work
-        client_sock.setblocking(False)
-
-        _ = self.selectors.register(client_sock, selectors.EVENT_READ, data=self._message_callback)
+        if self.debug_level == 1:
+            print(f"Client {conn.address} disconnected.")
 
-        # Workers may be accessing self.connections, so we have to lock here
-        with self.lock:
-            initial_nickname = next(self.username_generator)
-            self.connections[client_sock] = initial_nickname
+        self.timers.cancel(conn)
+        _ = self.selectors.unregister(conn.sock)
+        conn.sock.close()
 
-        if self.debug_level == 1:
-            print(f"New client {client_sock.getpeername()} connected with initial nickname {initial_nickname}")
+        self.work_queues[conn.worker].put((conn, None, 0, 0))
 
     # Callback for client sockets.
-    def _message_callback(self, key):
+    def _message_callback(self, key, mask):
         sock = key.fileobj
+        conn = self.sessions.get(sock)
+        if conn is None:
+            # Disconnected earlier in this selector pass
+            return
+
+        if mask & selectors.EVENT_WRITE:
+            self._flush(conn)
+            if conn.closed or not mask & selectors.EVENT_READ:
+                return
 
         try:
-            client_msg = shared.receive(sock)
+            # One read, however many frames it completes
+            frames = conn.decoder.feed(sock)
 
-            # This indicates a disconnect
-            if client_msg is None:
-                # Must lock here, since workers may be busy reading self.connections
-                with self.lock:
-                    if self.debug_level == 1:
-                        print(f"Client {sock.getpeername()} disconnected.")
+        except BlockingIOError:
+            return
 
-                    _ = self.connections.pop(sock, None)
+        except Exception as e:
+            print(f"Error while reading from client {conn.address}: {e}", file=stderr)
+            self._disconnect(conn)
+            return
+
+        # This indicates a disconnect
+        if frames is None:
+            self._disconnect(conn)
+            return
 
-                    for conns_set in self.channels.values():
-                        if sock in conns_set:
-                            conns_set.remove(sock)
+        # Close enough, and much cheaper than reading the clock
+        conn.last_seen = self.timers.now
 
-                    _ = self.selectors.unregister(sock)
+        metrics = self.metrics
+        queued = 0
+        if metrics is not None:
+            conn.frames_in += len(frames)
+            conn.bytes_in += sum(len(payload) for payload in frames) + 4 * len(frames)
+            queued = time.perf_counter_ns()
+
+        try:
+            work_queue = self.work_queues[conn.worker]
+            queue_limit = self.queue_limit
+
+            # The frames are views into the decoder's buffer, so they must be
+            # decoded before the next read.
+            for payload in frames:
+                client_msg = self._decode(conn, payload)
+                if client_msg is None or not self._admit(conn, client_msg, self.timers.now):
+                    continue
+
+                if queue_limit and work_queue.qsize() >= queue_limit:
+                    if metrics is not None:
+                        metrics.count('shed')
+                    self._refuse(conn, "Server is overloaded, command dropped")
+                    continue
 
-                    sock.close()
-            else:
                 # Queues are inherently thread safe, so we don't need to lock here
-                self.work_queue.put((sock, client_msg))
+                work_queue.put((conn, client_msg, queued, conn.seq))
+                if metrics is not None:
+                    metrics.record('work_queue_depth', work_queue.qsize())
 
         except Exception as e:
-            print(f"Error while handling client {sock.getpeername()}: {e}", file=stderr)
+            print(f"Error while handling client {conn.address}: {e}", file=stderr)
+            self._disconnect(conn)
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Server-side implementation of the chat protocol')
-    _ = parser.add_argument('-p', '--port', help='Port number to run the server on', type=int, required=True)
-    _ = parser.add_argument('-d', '--debug-level', help='How many events to log. May be 0 (only errors) or 1 (all events).', type=int)
-    args = parser.parse_args()
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def run_server(server) -> int:
+    """
+    Run a server until it is interrupted (SIGINT or SIGTERM), then shut it
+    down. Returns the process exit code.
+    """
+    # A clean shutdown writes out the message log. The engines handle
+    # SIGUSR1 themselves, if profiling is enabled.
+    _ = signal.signal(signal.SIGTERM, _interrupt)
 
     exit_code = 0
-    server = ChatServer(args.port, args.debug_level)
     try:
         server.run()
 
     except KeyboardInterrupt:
         print("\nDetected shutdown signal. Shutting down...")
 
-    except TimeoutError:
-        print("Timed out. Shutting down...")
-
     except Exception as e:
         print(f"Unexpected error: {e}\nShutting down...")
         exit_code = 1
 
     finally:
         server.shutdown()
-        sys.exit(exit_code)
+
+    return exit_code
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Server-side implementation of the chat protocol')
+    _ = parser.add_argument('-p', '--port', help='Port number to run the server on', type=int, required=True)
+    _ = parser.add_argument('-d', '--debug-level', help='How many events to log. May be 0 (only errors) or 1 (all events).', type=int)
+    _ = parser.add_argument('--high-water', help='Maximum bytes queued for a single client before the overflow policy applies', type=int, default=1 << 20)
+    _ = parser.add_argument('--overflow', help='What to do with a client over the high-water mark', choices=('disconnect', 'drop'), default='disconnect')
+    _ = parser.add_argument('-e', '--engine', help='Concurrency model of the server', choices=('threaded', 'asyncio'), default='threaded')
+    _ = parser.add_argument('-w', '--workers', help='Number of worker threads handling commands (threaded engine only)', type=int, default=3)
+    _ = parser.add_argument('--flush-interval', help='Seconds to wait for more outgoing frames before writing (threaded engine only)', type=float, default=0.0)
+    _ = parser.add_argument('--batch-cap', help='Most frames written per system call (threaded engine only)', type=int, default=64)
+    _ = parser.add_argument('--processes', help='Number of server processes sharing the port (threaded engine only)', type=int, default=1)
+    _ = parser.add_argument('--history', help='Messages kept per channel and replayed on request. 0 disables history.', type=int, default=100)
+    _ = parser.add_argument('--history-channel-bytes', help='Most bytes of history kept per channel', type=int, default=256 << 10)
+    _ = parser.add_argument('--history-bytes', help='Most bytes of history kept by the whole server; the least recently active channels lose theirs first', type=int, default=64 << 20)
+    _ = parser.add_argument('--join-replay', help='Messages of history sent to a client when it joins a channel', type=int, default=20)
+    _ = parser.add_argument('--log-dir', help='Keep every message, join, leave and nickname change in a durable log in this directory')
+    _ = parser.add_argument('--log-segment-bytes', help='Size at which the log starts a new segment file', type=int, default=64 << 20)
+    _ = parser.add_argument('--log-commit-interval', help='Seconds between log fsyncs; a crash loses at most this much', type=float, default=0.01)
+    _ = parser.add_argument('--metrics', help='Keep counters and latency histograms', action='store_true')
+    _ = parser.add_argument('--metrics-socket', help='Serve the metrics report on a Unix socket at this path (implies --metrics)')
+    _ = parser.add_argument('--admin-token', help='Let clients holding this token read the metrics with /stats (implies --metrics)')
+    _ = parser.add_argument('--compression', help='Compression algorithms clients may use, or none', nargs='+',
+                            choices=(*(compressor.name for compressor in COMPRESSORS.values()), 'none'), default=[ZLIB.name])
+    _ = parser.add_argument('--compress-threshold', help='Smallest payload, in bytes, compressed for clients that support it', type=int, default=DEFAULT_THRESHOLD)
+    _ = parser.add_argument('--handshake-timeout', help='Seconds a new client has to complete the handshake', type=float, default=10.0)
+    _ = parser.add_argument('--ping-interval', help='Seconds of silence before pinging a client that supports heartbeats. 0 disables heartbeats.', type=float, default=30.0)
+    _ = parser.add_argument('--pong-timeout', help='Seconds a pinged client has to answer before it is disconnected', type=float, default=10.0)
+    _ = parser.add_argument('--idle-timeout', help='Seconds of silence before disconnecting a client without heartbeats. 0 never disconnects them.', type=float, default=0.0)
+    _ = parser.add_argument('--presence-window', help='Seconds over which joins, leaves and nickname changes are collected and announced together. 0 announces each at once.', type=float, default=0.1)
+    _ = parser.add_argument('--max-channels', help='Most channels that may exist at once; joining a missing channel creates it', type=int, default=1_000_000)
+    _ = parser.add_argument('--rate-limit', help="Per-client limits as COMMAND=RATE/BURST (e.g. CmdNick=1/5), overriding the defaults. RATE 0 lifts a command's limit; 'off' lifts them all.",
+                            nargs='+', default=[])
+    _ = parser.add_argument('--channel-rate-limit', help='Messages per second into one channel, as RATE/BURST. 0 disables it.', default='/'.join(str(n) for n in DEFAULT_CHANNEL_LIMIT))
+    _ = parser.add_argument('--queue-limit', help='Most commands waiting per worker thread before new ones are refused. 0 disables it. (threaded engine only)', type=int, default=10000)
+    _ = parser.add_argument('--backlog', help='Connections the kernel queues until the server accepts them, and the most accepted at once', type=int, default=1024)
+    _ = parser.add_argument('--max-connections', help='Most clients connected at once; connections beyond it are closed right away. 0 for no limit.', type=int, default=0)
+    _ = parser.add_argument('--accept-rate', help='New connections accepted per second, as RATE/BURST; the rest wait in the backlog. 0 for no limit.', default='0')
+    _ = parser.add_argument('--handoff-socket', help='Hand the listening socket and every client to a new server process that connects to this Unix socket, then exit (threaded engine only)')
+    _ = parser.add_argument('--takeover', help='Start by taking over from the server at --handoff-socket, if one is running', action='store_true')
+    _ = parser.add_argument('--profile-dir', help='Enable profiling, started by SIGUSR1 or /profile, and write the results to this directory')
+    _ = parser.add_argument('--profile-seconds', help='How long a profile started by SIGUSR1 runs', type=float, default=10.0)
+    _ = parser.add_argument('--profile-allocations', help='Also trace memory allocations in profiles started by SIGUSR1', action='store_true')
+    _ = parser.add_argument('--capture', help='Record every connection and command to this new file, for src.bench.replay')
+    _ = parser.add_argument('--capture-anonymize', help='Replace nicknames and message text in the capture', action='store_true')
+    _ = parser.add_argument('--allow-pickle', help='Accept clients that use the legacy pickle wire format. Unsafe with untrusted clients.', action='store_true')
+    args = parser.parse_args()
+
+    try:
+        limits = parse_limits(args.rate_limit)
+        channel_limit = parse_limit(args.channel_rate_limit)
+        accept_rate = parse_limit(args.accept_rate)
+    except ValueError as e:
+        parser.error(str(e))
+    if channel_limit[0] <= 0:
+        channel_limit = None
+    if accept_rate[0] <= 0:
+        accept_rate = None
+    if args.backlog < 1:
+        parser.error("--backlog must be at least 1")
+    if args.profile_dir and not os.path.isdir(args.profile_dir):
+        parser.error(f"--profile-dir: no such directory '{args.profile_dir}'")
+    if args.profile_seconds <= 0:
+        parser.error("--profile-seconds must be positive")
+
+    if args.capture_anonymize and not args.capture:
+        parser.error("--capture-anonymize requires --capture")
+    if args.capture:
+        if not os.path.isdir(os.path.dirname(args.capture) or '.'):
+            parser.error(f"--capture: no such directory '{os.path.dirname(args.capture)}'")
+        # Each process of a cluster records its own clients
+        capture_paths = [args.capture] if args.processes <= 1 else [f"{args.capture}.{i}" for i in range(args.processes)]
+        for path in capture_paths:
+            if os.path.exists(path):
+                parser.error(f"--capture: '{path}' already exists")
+
+    if args.handoff_socket and (args.engine != 'threaded' or args.processes > 1):
+        parser.error("--handoff-socket requires the threaded engine and a single process")
+    if args.takeover and not args.handoff_socket:
+        parser.error("--takeover requires --handoff-socket")
+
+    def make_server(bus=None, takeover: Handoff | None = None):
+        history = None
+        if args.history > 0:
+            history = HistoryStore(args.history, args.history_channel_bytes, args.history_bytes)
+
+        log = None
+        if args.log_dir:
+            # Every process of a cluster keeps its own log
+            directory = args.log_dir if bus is None else os.path.join(args.log_dir, str(bus.index))
+            log = MessageLog(directory, args.log_segment_bytes, args.log_commit_interval)
+
+        metrics = None
+        if args.metrics or args.metrics_socket or args.admin_token:
+            metrics = Metrics()
+
+        compressions = tuple(
+            compressor.id for compressor in COMPRESSORS.values() if compressor.name in args.compression
+        )
+
+        profiler = None
+        if args.profile_dir:
+            profiler = Profiler(args.profile_dir, args.profile_seconds, args.profile_allocations)
+
+        capture = None
+        if args.capture:
+            path = args.capture if bus is None else f"{args.capture}.{bus.index}"
+            capture = TrafficCapture(path, args.capture_anonymize)
+
+        rate_limits = None
+        if limits is not None or channel_limit is not None:
+            rate_limits = RateLimits(limits or {}, channel_limit)
+
+        # Settings shared by both engines (see ChatCore)
+        options = dict(
+            history=history,
+            join_replay=args.join_replay,
+            metrics=metrics,
+            admin_token=args.admin_token,
+            compressions=compressions,
+            compress_threshold=args.compress_threshold,
+            handshake_timeout=args.handshake_timeout,
+            ping_interval=args.ping_interval,
+            pong_timeout=args.pong_timeout,
+            idle_timeout=args.idle_timeout,
+            rate_limits=rate_limits,
+            max_channels=args.max_channels,
+            log=log,
+            backlog=args.backlog,
+            max_connections=args.max_connections,
+            accept_rate=accept_rate,
+            profiler=profiler,
+            presence_window=args.presence_window,
+            capture=capture,
+        )
+
+        if args.engine == 'asyncio':
+            server = AsyncChatServer(args.port, args.debug_level, args.high_water, args.overflow, args.allow_pickle,
+                                     **options)
+        else:
+            server = ChatServer(args.port, args.debug_level, args.high_water, args.overflow, args.allow_pickle,
+                                args.workers, reuse_port=bus is not None, bus=bus,
+                                flush_interval=args.flush_interval, batch_cap=args.batch_cap,
+                                queue_limit=args.queue_limit, handoff_path=args.handoff_socket,
+                                takeover=takeover, **options)
+
+        if args.metrics_socket:
+            # Every process of a cluster gets its own endpoint
+            server.serve_metrics(args.metrics_socket if bus is None else f"{args.metrics_socket}.{bus.index}")
+        return server
+
+    if args.processes > 1:
+        if args.engine != 'threaded':
+            parser.error("--processes requires the threaded engine")
+
+        sys.exit(run_cluster(args.processes, make_server, run_server))
+
+    takeover = None
+    if args.takeover:
+        # Before making the server, since the old one has the log and the
+        # socket paths until the handoff is over
+        try:
+            takeover = handoff.receive(args.handoff_socket)
+        except (FileNotFoundError, ConnectionRefusedError):
+            print("No server to take over from, starting a new one")
+        except (OSError, ValueError) as e:
+            print(f"Takeover failed: {e}", file=stderr)
+            sys.exit(1)
+
+    sys.exit(run_server(make_server(takeover=takeover)))
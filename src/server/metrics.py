@@ -0,0 +1,207 @@
+import os
+
+import socket as sckt
+from socket import socket
+
+from sys import stderr
+
+import threading
+import time
+
+class Histogram:
+    """
+    Log-linear histogram of non-negative integers, in the style of
+    HdrHistogram: every power of two is split into `2 ** (SUB_BITS - 1)`
+    equal buckets, so any recorded value is known to within about 3%, and
+    recording is a few integer operations and one list increment.
+
+    Recording takes no lock. Two threads recording into the same bucket at
+    the same moment can lose one of the counts, which is fine for metrics.
+    """
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    SUB_BITS = 6
+    HALF = 1 << (SUB_BITS - 1)
+
+    # Values with more bits than this land in the last bucket
+    MAX_BITS = 48
+
+    def __init__(self):
+        size = (1 << self.SUB_BITS) + (self.MAX_BITS - self.SUB_BITS) * self.HALF
+        self.counts: list[int] = [0] * size
+        self.count: int = 0
+        self.total: int = 0
+        self.max: int = 0
+
+    @classmethod
+    def _index(cls, value: int) -> int:
+        bits = value.bit_length()
+        if bits <= cls.SUB_BITS:
+            return value
+        shift = min(bits, cls.MAX_BITS) - cls.SUB_BITS
+        # The top SUB_BITS bits of the value; always in [HALF, 2 * HALF)
+        top = min(value >> shift, (1 << cls.SUB_BITS) - 1)
+        return (1 << cls.SUB_BITS) + (shift - 1) * cls.HALF + (top - cls.HALF)
+
+    @classmethod
+    def _lowest(cls, index: int) -> int:
+        # Smallest value that falls in a bucket; the inverse of _index()
+        if index < 1 << cls.SUB_BITS:
+            return index
+        shift, offset = divmod(index - (1 << cls.SUB_BITS), cls.HALF)
+        return (cls.HALF + offset) << (shift + 1)
+
+    def record(self, value: int):
+        self.counts[self._index(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction: float) -> int:
+        """
+        The smallest recorded bucket that at least `fraction` of all values
+        fall at or below.
+        """
+        if not self.count:
+            return 0
+        rank = max(1, int(fraction * self.count + 0.5))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self._lowest(index), self.max)
+        return self.max
+
+    def summary(self, scale: float = 1.0) -> str:
+        """
+        One line with the count, mean and percentiles, each divided by
+        `scale`.
+        """
+        if not self.count:
+            return "count=0"
+        parts = [f"count={self.count}", f"mean={self.total / self.count / scale:.1f}"]
+        for label, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('p99.9', 0.999)):
+            parts.append(f"{label}={self.percentile(fraction) / scale:.1f}")
+        parts.append(f"max={self.max / scale:.1f}")
+        return ' '.join(parts)
+
+class Metrics:
+    """
+    Counters and histograms for one server process. A server with metrics
+    disabled has no `Metrics` at all, so every recording site is behind a
+    single `is not None` check.
+    """
+    __slots__ = ('started', 'counters', 'histograms', 'commands')
+
+    def __init__(self):
+        self.started: float = time.monotonic()
+        self.counters: dict[str, int] = {}
+
+        # Durations are in nanoseconds; histograms whose name ends in '_us'
+        # are reported in microseconds.
+        self.histograms: dict[str, Histogram] = {}
+
+        # Time spent handling each command type, by class name
+        self.commands: dict[str, Histogram] = {}
+
+    def count(self, name: str, amount: int = 1):
+        counters = self.counters
+        counters[name] = counters.get(name, 0) + amount
+
+    def record(self, name: str, value: int):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms.setdefault(name, Histogram())
+        histogram.record(value)
+
+    def command(self, command_type: type, elapsed: int):
+        histogram = self.commands.get(command_type.__name__)
+        if histogram is None:
+            histogram = self.commands.setdefault(command_type.__name__, Histogram())
+        histogram.record(elapsed)
+
+    def report(self, gauges: dict[str, float], connections, top: int = 10) -> str:
+        """
+        Render everything as plain text, one metric per line. `connections`
+        are the live connections; the `top` busiest are listed individually.
+        """
+        lines = [f"uptime_seconds {time.monotonic() - self.started:.1f}"]
+
+        for name, value in sorted(gauges.items()):
+            lines.append(f"{name} {value:g}")
+
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"{name} {value}")
+
+        for name, histogram in sorted(self.histograms.items()):
+            scale = 1000.0 if name.endswith('_us') else 1.0
+            lines.append(f"{name} {histogram.summary(scale)}")
+
+        for name, histogram in sorted(self.commands.items()):
+            lines.append(f"command_us{{{name}}} {histogram.summary(1000.0)}")
+
+        connections = list(connections)
+        busiest = sorted(connections, key=lambda conn: conn.bytes_out + conn.bytes_in, reverse=True)[:top]
+        for conn in busiest:
+            lines.append(
+                f"connection{{{conn.nick}}} bytes_in={conn.bytes_in} frames_in={conn.frames_in} "
+                f"bytes_out={conn.bytes_out} frames_out={conn.frames_out}"
+            )
+
+        return '\n'.join(lines) + '\n'
+
+class MetricsEndpoint:
+    """
+    A Unix socket that writes the current metrics report to every client
+    that connects, then closes. Served by its own thread, so reading metrics
+    never touches the server's event loop. Try it with
+    `nc -U <path>` or `socat - UNIX-CONNECT:<path>`.
+    """
+    __slots__ = ('path', 'listener', 'render')
+
+    def __init__(self, path: str, render):
+        self.path: str = path
+        self.render = render
+
+        # A leftover socket file from a previous run would make bind() fail
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+        self.listener: socket = socket(sckt.AF_UNIX, sckt.SOCK_STREAM)
+        self.listener.bind(path)
+        # Only the server's user may read its metrics
+        os.chmod(path, 0o600)
+        self.listener.listen(8)
+
+        t = threading.Thread(target=self._serve, name='metrics-endpoint', daemon=True)
+        t.start()
+
+    def _serve(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                # Closed by close()
+                return
+
+            try:
+                client.settimeout(1)
+                client.sendall(self.render().encode())
+            except Exception as e:
+                print(f"Error while writing metrics: {e}", file=stderr)
+            finally:
+                client.close()
+
+    def close(self):
+        try:
+            self.listener.shutdown(sckt.SHUT_RDWR)
+        except OSError:
+            pass
+        self.listener.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
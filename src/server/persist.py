@@ -0,0 +1,438 @@
+import argparse
+
+from array import array
+
+from bisect import bisect_right
+
+import mmap
+
+import os
+
+import struct
+
+import sys
+
+import threading
+
+import time
+
+import zlib
+
+from src.protocol import events
+from src.protocol import shared
+from src.protocol.codec import BINARY
+
+# Every record is a header, then a complete binary frame (its own length
+# header and payload) exactly as it was broadcast. The checksum covers the
+# time and the frame.
+RECORD = struct.Struct('!Id')
+LENGTH = struct.Struct('!I')
+
+# One index entry: where a message starts, relative to its segment
+OFFSETS = 'I'
+
+class MessageLog:
+    """
+    Durable, append-only log of chat events, split into segment files named
+    after the position of their first byte in the whole log. A new segment is
+    started once the current one reaches `segment_bytes`.
+
+    Appending only copies the record into a buffer. A background thread
+    writes the buffer out and fsyncs it every `commit_interval` seconds, so
+    many appends share one fsync and nobody waits for the disk; a crash loses
+    at most the last interval. A torn record at the end of the last segment
+    is cut off when the log is reopened.
+
+    Messages are also indexed by channel: each channel's list of positions,
+    in order, numbers its messages from 1. When a segment is finished, its
+    part of the index is saved next to it, so reopening the log reads the
+    index files and the last segment, never the other segments' records.
+    Records are read through mmap, so a history page costs the records on
+    it.
+    """
+    __slots__ = (
+        'directory',
+        'segment_bytes',
+        'commit_interval',
+        'lock',
+        'commit_lock',
+        'index',
+        'segment_messages',
+        'starts',
+        'maps',
+        'end',
+        'pending',
+        'writing',
+        'written',
+        'file',
+        'reader',
+        'commit_thread',
+        'closed',
+        'wakeup',
+    )
+
+    def __init__(self, directory: str, segment_bytes: int = 64 << 20, commit_interval: float = 0.01):
+        self.directory: str = directory
+        self.segment_bytes: int = segment_bytes
+        self.commit_interval: float = commit_interval
+        os.makedirs(directory, exist_ok=True)
+
+        # Guards everything below; never held during disk writes. Those are
+        # serialized by commit_lock instead. Reentrant, so callers can hold it
+        # across an append to keep other state numbered like the log.
+        self.lock: threading.RLock = threading.RLock()
+        self.commit_lock: threading.Lock = threading.Lock()
+
+        # Channel -> global positions of its messages, oldest first
+        self.index: dict[str, array] = {}
+
+        # (channel, position) of the messages in the last segment, saved to
+        # its index file when it is finished
+        self.segment_messages: list[tuple[str, int]] = []
+
+        # Global position of the first byte of each segment, and the maps of
+        # finished segments, opened on first read
+        self.starts: list[int] = []
+        self.maps: dict[int, mmap.mmap] = {}
+
+        # Global position after the last appended record; records before
+        # `written` are in the file, the rest are in `writing` (being written
+        # out right now) followed by `pending`
+        self.end: int = 0
+        self.pending: bytearray = bytearray()
+        self.writing: bytes = b''
+        self.written: int = 0
+
+        # The last segment, open for appending and for reading
+        self.file = None
+        self.reader = None
+
+        self._open()
+
+        self.closed: bool = False
+        self.wakeup: threading.Event = threading.Event()
+        self.commit_thread: threading.Thread = threading.Thread(target=self._commit_loop, name='log-commit', daemon=True)
+        self.commit_thread.start()
+
+    def append(self, event: events.EventObject, frame: bytes | None = None, channel: str | None = None) -> int:
+        """
+        Log an event, given its binary frame if there is one already. With a
+        channel, the event is indexed as one of that channel's messages, and
+        its number there is returned; otherwise 0.
+        """
+        if frame is None:
+            frame = shared.encode(event, BINARY)
+        stamp = time.time()
+        header = RECORD.pack(zlib.crc32(frame, zlib.crc32(struct.pack('!d', stamp))), stamp)
+
+        with self.lock:
+            position = self.end
+            self.pending += header
+            self.pending += frame
+            self.end += len(header) + len(frame)
+            if channel is None:
+                return 0
+
+            offsets = self.index.get(channel)
+            if offsets is None:
+                offsets = self.index[channel] = array('Q')
+            offsets.append(position)
+            self.segment_messages.append((channel, position))
+            return len(offsets)
+
+    def count(self, channel: str) -> int:
+        """
+        Number of messages ever logged in a channel.
+        """
+        with self.lock:
+            offsets = self.index.get(channel)
+            return len(offsets) if offsets is not None else 0
+
+    def channels(self) -> list[str]:
+        """
+        Channels with logged messages, the one with the latest message last.
+        """
+        with self.lock:
+            return sorted(self.index, key=lambda channel: self.index[channel][-1])
+
+    def page(self, channel: str, before: int, limit: int) -> tuple[list[bytes], int]:
+        """
+        Same as `HistoryStore.page`, for every message ever logged: up to
+        `limit` frames older than message number `before` (0 for the newest),
+        oldest first, and the `before` for the page preceding them, or 0.
+        """
+        with self.lock:
+            offsets = self.index.get(channel)
+            if offsets is None or limit <= 0:
+                return [], 0
+            end = len(offsets) + 1 if before <= 0 else min(before, len(offsets) + 1)
+            start = max(end - limit, 1)
+            positions = offsets[start - 1:end - 1]
+            if not positions:
+                return [], 0
+
+            # The disk reads happen after letting go of the lock, which every
+            # append takes. Records not written out yet are copied now, and
+            # the last segment is read through a descriptor of its own, as
+            # the reader is replaced when the segment is finished.
+            written = self.written
+            unwritten = self.writing + self.pending if positions[-1] >= written else b''
+            starts = self.starts[:]
+            fd = os.dup(self.reader.fileno()) if positions[0] < written else -1
+
+        try:
+            frames = [self._read(position, written, unwritten, starts, fd) for position in positions]
+        finally:
+            if fd >= 0:
+                os.close(fd)
+        return frames, (start if start > 1 else 0)
+
+    def records(self, start: int = 0):
+        """
+        Every record from global position `start` on, as (time, event). For
+        exports; reads the segments one after the other.
+        """
+        self.commit()
+        for i, segment_start in enumerate(self.starts):
+            segment_end = self.starts[i + 1] if i + 1 < len(self.starts) else self.written
+            if segment_end <= start:
+                continue
+            with open(self._path(segment_start, '.log'), 'rb') as f:
+                data = f.read()
+            position = max(start - segment_start, 0)
+            while position < len(data):
+                stamp, frame, position = _parse(data, position)
+                if frame is None:
+                    break
+                yield stamp, BINARY.loads(frame[LENGTH.size:])
+
+    def commit(self):
+        """
+        Write out and fsync everything appended so far, now.
+        """
+        with self.commit_lock:
+            with self.lock:
+                self.writing = bytes(self.pending)
+                self.pending = bytearray()
+            self._write()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.wakeup.set()
+        self.commit_thread.join()
+        self.commit()
+        self.file.close()
+        self.reader.close()
+        for segment_map in self.maps.values():
+            segment_map.close()
+
+    def _commit_loop(self):
+        while not self.closed:
+            _ = self.wakeup.wait(self.commit_interval)
+            if self.pending:
+                self.commit()
+
+    # Called with commit_lock held.
+    def _write(self):
+        data = self.writing
+        if data:
+            self.file.write(data)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+        with self.lock:
+            self.written += len(data)
+            self.writing = b''
+            finished = self.written - self.starts[-1] >= self.segment_bytes
+            if finished:
+                # Messages appended since the write belong to the next segment
+                messages = [entry for entry in self.segment_messages if entry[1] < self.written]
+                self.segment_messages = self.segment_messages[len(messages):]
+
+        if finished:
+            self._finish_segment(self.starts[-1], messages)
+
+    def _finish_segment(self, start: int, messages: list[tuple[str, int]]):
+        self._save_index(start, messages)
+        self.file.close()
+        self.file = open(self._path(self.written, '.log'), 'ab')
+
+        with self.lock:
+            self.starts.append(self.written)
+            self.reader.close()
+            self.reader = open(self._path(self.written, '.log'), 'rb')
+
+    def _save_index(self, start: int, messages: list[tuple[str, int]]):
+        by_channel: dict[str, array] = {}
+        for channel, position in messages:
+            offsets = by_channel.get(channel)
+            if offsets is None:
+                offsets = by_channel[channel] = array(OFFSETS)
+            offsets.append(position - start)
+
+        # Channel name, count, then the offsets; written whole, then renamed,
+        # so a crash never leaves half an index
+        out = bytearray()
+        for channel, offsets in by_channel.items():
+            name = channel.encode()
+            out += LENGTH.pack(len(name)) + name + LENGTH.pack(len(offsets))
+            if sys.byteorder != 'little':
+                offsets.byteswap()
+            out += offsets.tobytes()
+        temporary = self._path(start, '.idx.tmp')
+        with open(temporary, 'wb') as f:
+            _ = f.write(out)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self._path(start, '.idx'))
+
+    def _load_index(self, start: int):
+        with open(self._path(start, '.idx'), 'rb') as f:
+            data = f.read()
+
+        position = 0
+        while position < len(data):
+            (length,) = LENGTH.unpack_from(data, position)
+            position += LENGTH.size
+            channel = data[position:position + length].decode()
+            position += length
+            (count,) = LENGTH.unpack_from(data, position)
+            position += LENGTH.size
+
+            offsets = array(OFFSETS)
+            offsets.frombytes(data[position:position + count * offsets.itemsize])
+            if sys.byteorder != 'little':
+                offsets.byteswap()
+            position += count * offsets.itemsize
+
+            index = self.index.get(channel)
+            if index is None:
+                index = self.index[channel] = array('Q')
+            index.extend(start + offset for offset in offsets)
+
+    # Find the segments, load the indexes of finished ones, and scan the
+    # last one, cutting off anything after its last complete record.
+    def _open(self):
+        self.starts = sorted(
+            int(name[:-len('.log')]) for name in os.listdir(self.directory) if name.endswith('.log')
+        )
+        if not self.starts:
+            self.starts = [0]
+            self.file = open(self._path(0, '.log'), 'ab')
+            self.reader = open(self._path(0, '.log'), 'rb')
+            return
+
+        for start in self.starts[:-1]:
+            if not os.path.exists(self._path(start, '.idx')):
+                # Crashed between finishing a segment and saving its index
+                self._save_index(start, self._scan(start)[0])
+            self._load_index(start)
+
+        last = self.starts[-1]
+        messages, size = self._scan(last)
+        for channel, position in messages:
+            index = self.index.get(channel)
+            if index is None:
+                index = self.index[channel] = array('Q')
+            index.append(position)
+        self.segment_messages = messages
+
+        self.file = open(self._path(last, '.log'), 'ab')
+        self.file.truncate(size)
+        self.reader = open(self._path(last, '.log'), 'rb')
+        self.written = self.end = last + size
+
+    # Read a segment record by record. Returns its messages, as (channel,
+    # global position), and the size of its valid part.
+    def _scan(self, start: int) -> tuple[list[tuple[str, int]], int]:
+        with open(self._path(start, '.log'), 'rb') as f:
+            data = f.read()
+
+        messages: list[tuple[str, int]] = []
+        position = 0
+        while position < len(data):
+            _, frame, next_position = _parse(data, position)
+            if frame is None:
+                break
+            event = BINARY.loads(frame[LENGTH.size:])
+            if isinstance(event, events.EventReceiveMessage):
+                messages.append((event.channel, start + position))
+            position = next_position
+        return messages, position
+
+    # The frame of the record at a global position, given what page() copied
+    # under the lock: where the written records end, the ones after that,
+    # the segment starts and a descriptor for the last segment.
+    def _read(self, position: int, written: int, unwritten: bytes, starts: list[int], fd: int) -> bytes:
+        if position >= written:
+            buffered = unwritten
+            offset = position - written
+        else:
+            i = bisect_right(starts, position) - 1
+            start = starts[i]
+            if i == len(starts) - 1:
+                # The last segment is still growing, so it isn't mapped
+                frame_start = position - start + RECORD.size
+                (length,) = LENGTH.unpack(os.pread(fd, LENGTH.size, frame_start))
+                return os.pread(fd, LENGTH.size + length, frame_start)
+            buffered = self._map(start)
+            offset = position - start
+
+        frame_start = offset + RECORD.size
+        (length,) = LENGTH.unpack_from(buffered, frame_start)
+        return bytes(buffered[frame_start:frame_start + LENGTH.size + length])
+
+    # The map of a finished segment, opened on first use
+    def _map(self, start: int) -> mmap.mmap:
+        segment_map = self.maps.get(start)
+        if segment_map is None:
+            with open(self._path(start, '.log'), 'rb') as f:
+                segment_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            with self.lock:
+                kept = self.maps.setdefault(start, segment_map)
+            if kept is not segment_map:
+                # Another reader got there first
+                segment_map.close()
+                segment_map = kept
+        return segment_map
+
+    def _path(self, start: int, suffix: str) -> str:
+        return os.path.join(self.directory, f"{start:020}{suffix}")
+
+def _parse(data, position: int) -> tuple[float, bytes | None, int]:
+    # One record: its time, its frame (None if it is torn or corrupt) and
+    # where the next one starts
+    frame_start = position + RECORD.size
+    if frame_start + LENGTH.size > len(data):
+        return 0.0, None, position
+    checksum, stamp = RECORD.unpack_from(data, position)
+    (length,) = LENGTH.unpack_from(data, frame_start)
+    end = frame_start + LENGTH.size + length
+    if end > len(data):
+        return 0.0, None, position
+
+    frame = bytes(data[frame_start:end])
+    if zlib.crc32(frame, zlib.crc32(struct.pack('!d', stamp))) != checksum:
+        return 0.0, None, position
+    return stamp, frame, end
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print the events in a message log')
+    _ = parser.add_argument('directory', help='Log directory (--log-dir of the server)')
+    _ = parser.add_argument('-c', '--channel', help="Only this channel's messages, read through the index")
+    _ = parser.add_argument('-n', '--last', help='Only the last N messages of the channel', type=int, default=0)
+    args = parser.parse_args()
+
+    log = MessageLog(args.directory)
+    try:
+        if args.channel is not None:
+            frames, _ = log.page(args.channel, 0, args.last or log.count(args.channel))
+            for frame in frames:
+                print(BINARY.loads(frame[LENGTH.size:]))
+        else:
+            for stamp, event in log.records():
+                print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stamp))} {event}")
+    finally:
+        log.close()
@@ -0,0 +1,136 @@
+import threading
+
+from .channel import Channel
+from .connection import BaseConnection
+
+class RemoteUser:
+    """
+    Stands in for a client connected to another process of a cluster, whose
+    changes arrive from the hub. There is one per remote client with changes
+    in the window (see `PresenceBuffer.remote`), so its changes add up as a
+    local client's do.
+    """
+    __slots__ = ('nick',)
+
+    def __init__(self, nick: str):
+        self.nick: str = nick
+
+class ChannelChanges:
+    """
+    Joins and leaves in one channel since the last batch was announced. A
+    member who joins and leaves again (or the other way around) within a
+    window cancels out, so nobody hears about it.
+    """
+    __slots__ = ('joined', 'left')
+
+    def __init__(self):
+        # Dicts rather than sets, so they are announced in order
+        self.joined: dict[BaseConnection | RemoteUser, None] = {}
+        self.left: dict[BaseConnection | RemoteUser, None] = {}
+
+class PresenceBuffer:
+    """
+    Joins, leaves and nickname changes waiting to be announced. Changes are
+    collected for `window` seconds after the first one, then announced all
+    at once, one batch per channel (see `ChatCore._flush_presence`), so a
+    reconnect storm costs each client one frame per window instead of one
+    per change.
+
+    Changes are recorded by connection, and announced under the nickname the
+    client has when the batch goes out. Renames are listed with the name
+    each client had before its first change in the window, so applying the
+    renames first, then the leaves, then the joins gives the right result.
+
+    Safe to use from any thread.
+    """
+    __slots__ = ('window', 'lock', 'channels', 'renamed', 'remote_users', 'deadline')
+
+    def __init__(self, window: float):
+        self.window: float = window
+        self.lock: threading.Lock = threading.Lock()
+
+        # Keyed by channel object rather than name, so a channel that is
+        # removed and created again within a window starts over
+        self.channels: dict[Channel, ChannelChanges] = {}
+
+        # Nickname each renamed client had before the window
+        self.renamed: dict[BaseConnection | RemoteUser, str] = {}
+
+        # Stand-ins for remote clients with changes in the window, by their
+        # current nickname
+        self.remote_users: dict[str, RemoteUser] = {}
+
+        # When the changes are due to be announced, or None if there are none
+        self.deadline: float | None = None
+
+    def join(self, channel: Channel, conn: BaseConnection | RemoteUser, now: float) -> bool:
+        """
+        Record a join. Returns True if it is the first change of a window, in
+        which case the caller must make sure `ChatCore._flush_presence` runs
+        at `deadline`. So do the other methods.
+        """
+        with self.lock:
+            changes = self._changes(channel)
+            if conn in changes.left:
+                del changes.left[conn]
+            else:
+                changes.joined[conn] = None
+            return self._start(now)
+
+    def leave(self, channel: Channel, conn: BaseConnection | RemoteUser, now: float) -> bool:
+        with self.lock:
+            changes = self._changes(channel)
+            if conn in changes.joined:
+                del changes.joined[conn]
+            else:
+                changes.left[conn] = None
+            return self._start(now)
+
+    def rename(self, conn: BaseConnection | RemoteUser, old_nick: str, now: float) -> bool:
+        """
+        Record that a client has changed its nickname from `old_nick` to the
+        one it now has.
+        """
+        with self.lock:
+            _ = self.renamed.setdefault(conn, old_nick)
+            if type(conn) is RemoteUser:
+                # Gone already if a batch went out since remote() was called
+                _ = self.remote_users.pop(old_nick, None)
+                self.remote_users[conn.nick] = conn
+            return self._start(now)
+
+    def remote(self, nick: str) -> RemoteUser:
+        """
+        The stand-in for the remote client now called `nick`. To rename it,
+        set its `nick`, then call `rename()`. Only the thread receiving
+        events from the hub may use this.
+        """
+        with self.lock:
+            user = self.remote_users.get(nick)
+            if user is None:
+                user = self.remote_users[nick] = RemoteUser(nick)
+            return user
+
+    def take(self) -> tuple[dict[Channel, ChannelChanges], dict[BaseConnection | RemoteUser, str]]:
+        """
+        Everything recorded since the last call, which starts a new window.
+        """
+        with self.lock:
+            channels, renamed = self.channels, self.renamed
+            self.channels = {}
+            self.renamed = {}
+            self.remote_users = {}
+            self.deadline = None
+        return channels, renamed
+
+    def _changes(self, channel: Channel) -> ChannelChanges:
+        changes = self.channels.get(channel)
+        if changes is None:
+            changes = self.channels[channel] = ChannelChanges()
+        return changes
+
+    def _start(self, now: float) -> bool:
+        if self.deadline is not None:
+            return False
+        self.deadline = now + self.window
+        return True
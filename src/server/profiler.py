@@ -0,0 +1,160 @@
+import os
+
+from sys import _current_frames, stderr
+
+import threading
+import time
+
+import tracemalloc
+
+# Seconds between stack samples. Each sample briefly holds the GIL, so this
+# is about 1% of one core.
+SAMPLE_INTERVAL = 0.01
+
+# Frames kept per allocation traceback while tracing allocations
+ALLOCATION_FRAMES = 32
+
+class Profiler:
+    """
+    On-demand sampling profiler. `start()` launches a thread that, for a
+    limited time, samples the stack of every other thread in the process
+    (the selector loop, the workers, the log writer) and counts how often
+    each stack was seen. With `allocations`, it also traces memory
+    allocations for that time and records where memory grew.
+
+    Results are written to `directory` in the collapsed stack format that
+    flamegraph.pl, speedscope and similar tools read: one line per distinct
+    stack, frames from the root down separated by ';', then a space and a
+    count (samples, or bytes for allocations). Stacks start with the name of
+    the thread.
+
+    Until it is started, the profiler costs nothing: no thread, no hooks and
+    no tracing.
+    """
+    __slots__ = ('directory', 'seconds', 'allocations', 'running', 'labels')
+
+    def __init__(self, directory: str, seconds: float = 10.0, allocations: bool = False):
+        self.directory: str = directory
+
+        # Defaults for `start()`, which is what SIGUSR1 uses
+        self.seconds: float = seconds
+        self.allocations: bool = allocations
+
+        # Held for as long as a profile runs, so only one runs at a time.
+        # Released by the sampling thread when it is done.
+        self.running: threading.Lock = threading.Lock()
+
+        # Frame labels by code object. Only used by the sampling thread.
+        self.labels: dict = {}
+
+    def start(self, seconds: float | None = None, allocations: bool | None = None) -> list[str] | None:
+        """
+        Start profiling for `seconds` in the background. Returns the paths of
+        the files that will be written when it is done, or None if a profile
+        is already running. Not safe to call from a signal handler, as it
+        takes a lock and starts a thread.
+        """
+        if seconds is None:
+            seconds = self.seconds
+        if allocations is None:
+            allocations = self.allocations
+
+        if not self.running.acquire(blocking=False):
+            return None
+
+        try:
+            base = os.path.join(self.directory, f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}")
+            paths = [f"{base}.stacks"]
+            if allocations:
+                paths.append(f"{base}.allocs")
+
+            t = threading.Thread(target=self._run, args=(seconds, paths), name='profiler', daemon=True)
+            t.start()
+        except BaseException:
+            self.running.release()
+            raise
+        return paths
+
+    def _run(self, seconds: float, paths: list[str]):
+        try:
+            before = None
+            tracing = len(paths) > 1 and not tracemalloc.is_tracing()
+            if len(paths) > 1:
+                if tracing:
+                    tracemalloc.start(ALLOCATION_FRAMES)
+                before = tracemalloc.take_snapshot()
+
+            stacks = self._sample(time.monotonic() + seconds)
+            self._write(paths[0], stacks)
+
+            if before is not None:
+                after = tracemalloc.take_snapshot()
+                # Only stop tracing if this started it
+                if tracing:
+                    tracemalloc.stop()
+                self._write(paths[1], self._growth(before, after))
+
+            print(f"Profile written to {', '.join(paths)}")
+        except Exception as e:
+            print(f"Profiling failed: {e}", file=stderr)
+        finally:
+            self.labels.clear()
+            self.running.release()
+
+    # Counts of every stack seen in the other threads until `deadline`
+    def _sample(self, deadline: float) -> dict[str, int]:
+        own = threading.get_ident()
+        stacks: dict[str, int] = {}
+        names: dict[int, str] = {}
+        label = self._label
+
+        while time.monotonic() < deadline:
+            for ident, frame in _current_frames().items():
+                if ident == own:
+                    continue
+
+                name = names.get(ident)
+                if name is None:
+                    # A thread started since the last refresh
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                    name = names.get(ident, str(ident))
+
+                frames: list[str] = []
+                while frame is not None:
+                    frames.append(label(frame.f_code))
+                    frame = frame.f_back
+                frames.append(name)
+                frames.reverse()
+
+                stack = ';'.join(frames)
+                stacks[stack] = stacks.get(stack, 0) + 1
+
+            time.sleep(SAMPLE_INTERVAL)
+        return stacks
+
+    def _label(self, code) -> str:
+        label = self.labels.get(code)
+        if label is None:
+            label = self.labels[code] = f"{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return label
+
+    # Bytes allocated and not freed between two snapshots, by stack
+    @staticmethod
+    def _growth(before: tracemalloc.Snapshot, after: tracemalloc.Snapshot) -> dict[str, int]:
+        # Leave out the profiler's own allocations
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+        stats = after.filter_traces(ignore).compare_to(before.filter_traces(ignore), 'traceback')
+
+        growth: dict[str, int] = {}
+        for stat in stats:
+            if stat.size_diff > 0:
+                # Oldest frame first
+                stack = ';'.join(f"{os.path.basename(frame.filename)}:{frame.lineno}" for frame in stat.traceback)
+                growth[stack] = growth.get(stack, 0) + stat.size_diff
+        return growth
+
+    @staticmethod
+    def _write(path: str, counts: dict[str, int]):
+        with open(path, 'w') as f:
+            for stack, count in sorted(counts.items(), key=lambda item: -item[1]):
+                _ = f.write(f"{stack} {count}\n")
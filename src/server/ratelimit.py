@@ -0,0 +1,134 @@
+from src.protocol import commands
+
+class TokenBucket:
+    """
+    Allows `rate` events per second on average, and bursts of up to `burst`
+    at once. Starts full.
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate: float = rate
+        self.burst: float = burst
+        self.tokens: float = burst
+        self.stamp: float = now
+
+    def take(self, now: float) -> bool:
+        """
+        Use up one token if there is one. Returns False if the event should be
+        refused.
+        """
+        tokens = self.tokens + (now - self.stamp) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        self.stamp = now
+
+        if tokens < 1:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - 1
+        return True
+
+    def available(self, now: float) -> float:
+        """
+        Refill the bucket and return how many tokens it holds, for callers
+        that take several at once by subtracting from `tokens`.
+        """
+        tokens = self.tokens + (now - self.stamp) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        self.stamp = now
+        self.tokens = tokens
+        return tokens
+
+# Per-connection limits, as (commands per second, burst), used unless
+# overridden on the command line. Nickname changes are broadcast to every
+# client, so they are the most expensive and get the lowest limit.
+DEFAULT_LIMITS: dict[type[commands.CommandObject], tuple[float, float]] = {
+    commands.CmdSendMessage: (20, 40),
+    commands.CmdNick: (1, 5),
+    commands.CmdJoin: (5, 20),
+    commands.CmdLeave: (5, 20),
+    commands.CmdList: (2, 10),
+    commands.CmdHistory: (5, 20),
+    commands.CmdStats: (1, 5),
+    commands.CmdProfile: (1, 5),
+}
+
+# Messages per second into a single channel, from all of its members together
+DEFAULT_CHANNEL_LIMIT: tuple[float, float] = (200, 400)
+
+class RateLimits:
+    """
+    Token buckets for each connection and command type, and for messages into
+    each channel. Checked on the thread that reads from the sockets, before
+    a command is queued, so a flooding client costs the workers nothing.
+    Not thread-safe.
+    """
+    __slots__ = ('limits', 'channel_limit')
+
+    def __init__(self, limits: dict[type[commands.CommandObject], tuple[float, float]],
+                 channel_limit: tuple[float, float] | None):
+        # Command types missing from `limits` are not limited
+        self.limits: dict[type[commands.CommandObject], tuple[float, float]] = limits
+        self.channel_limit: tuple[float, float] | None = channel_limit
+
+    def check(self, conn, msg: commands.CommandObject, now: float, channel=None) -> str | None:
+        """
+        Returns None if `msg` may run, or the reason it may not. `channel` is
+        the channel a CmdSendMessage is for, if it exists.
+        """
+        command_type = type(msg)
+        limit = self.limits.get(command_type)
+        if limit is not None:
+            buckets = conn.buckets
+            if buckets is None:
+                # Most clients only ever use a few command types
+                buckets = conn.buckets = {}
+
+            bucket = buckets.get(command_type)
+            if bucket is None:
+                bucket = buckets[command_type] = TokenBucket(*limit, now)
+            if not bucket.take(now):
+                return f"Rate limit exceeded for {command_type.__name__}, slow down"
+
+        if channel is not None and self.channel_limit is not None:
+            # Kept on the channel, so it goes away with it
+            bucket = channel.bucket
+            if bucket is None:
+                bucket = channel.bucket = TokenBucket(*self.channel_limit, now)
+            if not bucket.take(now):
+                return f"Channel '{channel.name}' is too busy, message dropped"
+
+        return None
+
+def parse_limit(text: str) -> tuple[float, float]:
+    """
+    Parse a limit written as 'RATE/BURST', or just 'RATE' for a burst of the
+    same size.
+    """
+    rate, _, burst = text.partition('/')
+    return float(rate), float(burst or rate)
+
+def parse_limits(specs: list[str]) -> dict[type[commands.CommandObject], tuple[float, float]] | None:
+    """
+    Apply command line overrides such as 'CmdNick=1/5' to the default limits.
+    'CmdNick=0' removes the limit for that command, and 'off' removes all
+    limits (returns None).
+    """
+    limits = dict(DEFAULT_LIMITS)
+    by_name = {command_type.__name__: command_type for command_type in DEFAULT_LIMITS}
+    for spec in specs:
+        if spec == 'off':
+            return None
+
+        name, sep, limit = spec.partition('=')
+        if not sep or name not in by_name:
+            raise ValueError(f"Expected COMMAND=RATE/BURST with COMMAND one of {', '.join(by_name)}, got '{spec}'")
+
+        rate, burst = parse_limit(limit)
+        if rate <= 0:
+            _ = limits.pop(by_name[name], None)
+        else:
+            limits[by_name[name]] = (rate, burst)
+    return limits
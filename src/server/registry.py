@@ -0,0 +1,82 @@
+from .connection import BaseConnection
+
+class SessionRegistry:
+    """
+    All connected clients, indexed by socket and by nickname so lookups,
+    renames and removals never scan the whole user list.
+
+    There is no lock. Every change is a single dict operation, which the
+    interpreter runs atomically, and a nickname is claimed with `setdefault`,
+    so when two threads want the same name exactly one gets it. Only the
+    thread handling a client's commands renames or removes it, so a client's
+    own entries never change under it.
+    """
+    __slots__ = ('by_sock', 'by_nick')
+
+    def __init__(self):
+        self.by_sock: dict[object, BaseConnection] = {}
+        self.by_nick: dict[str, BaseConnection] = {}
+
+    def add(self, conn: BaseConnection, nicknames) -> str:
+        """
+        Register a new connection, giving it the first name from the
+        `nicknames` iterator that nobody is using. Returns that name. Only one
+        thread may call this at a time, as `nicknames` is not shared.
+        """
+        by_nick = self.by_nick
+        nick = next(nicknames)
+        while by_nick.setdefault(nick, conn) is not conn:
+            # Someone picked this name with /nick already
+            nick = next(nicknames)
+
+        conn.nick = nick
+        self.by_sock[conn.sock] = conn
+        return nick
+
+    def adopt(self, conn: BaseConnection):
+        """
+        Register a connection under the nickname it already has, taken over
+        from another server process. Raises ValueError if the name is in use.
+        """
+        if self.by_nick.setdefault(conn.nick, conn) is not conn:
+            raise ValueError(f"Duplicate nickname '{conn.nick}'")
+        self.by_sock[conn.sock] = conn
+
+    def rename(self, conn: BaseConnection, new_nick: str) -> str | None:
+        """
+        Give a connection a new nickname. Returns the old one, or None if the
+        new one is taken.
+        """
+        old_nick = conn.nick
+        if new_nick == old_nick or self.by_nick.setdefault(new_nick, conn) is not conn:
+            return None
+
+        conn.nick = new_nick
+        self._release(conn, old_nick)
+        return old_nick
+
+    def remove(self, conn: BaseConnection):
+        _ = self.by_sock.pop(conn.sock, None)
+        self._release(conn, conn.nick)
+
+    # Nothing else can take a name while it is held, so checking then
+    # deleting is safe.
+    def _release(self, conn: BaseConnection, nick: str):
+        if self.by_nick.get(nick) is conn:
+            del self.by_nick[nick]
+
+    def get(self, sock) -> BaseConnection | None:
+        return self.by_sock.get(sock)
+
+    def find(self, nick: str) -> BaseConnection | None:
+        return self.by_nick.get(nick)
+
+    def snapshot(self) -> list[BaseConnection]:
+        """
+        Every connection, as a list that later changes won't affect.
+        """
+        # Copied in one step, which no other thread can interrupt
+        return list(self.by_sock.values())
+
+    def __len__(self):
+        return len(self.by_sock)
@@ -0,0 +1,86 @@
+import math
+
+from collections.abc import Hashable
+
+class TimerWheel:
+    """
+    Hashed timer wheel. Time is split into ticks of `resolution` seconds, and
+    a timer due at tick t lives in slot t % slots. Scheduling and cancelling
+    are O(1) regardless of how many timers exist; expiring costs one slot
+    visit per elapsed tick, plus the timers in those slots. Timers fire up to
+    one tick late, never early.
+
+    Each item (typically a connection) has at most one timer. Scheduling an
+    item again moves its timer. Not thread-safe: use it from one thread only.
+    """
+    __slots__ = ('resolution', 'slots', 'due', 'tick', 'now')
+
+    def __init__(self, resolution: float = 1.0, slots: int = 512, now: float = 0.0):
+        self.resolution: float = resolution
+        self.slots: list[set[Hashable]] = [set() for _ in range(slots)]
+
+        # Tick each item is due at
+        self.due: dict[Hashable, int] = {}
+
+        # Last tick expired, and the time passed to the last expire() call
+        self.tick: int = int(now // resolution)
+        self.now: float = now
+
+    def schedule(self, item: Hashable, when: float):
+        """
+        Fire `item` at time `when` (on the same clock as `expire()`).
+        """
+        tick = max(math.ceil(when / self.resolution), self.tick + 1)
+        old = self.due.get(item)
+        if old is not None:
+            if old == tick:
+                return
+            self.slots[old % len(self.slots)].discard(item)
+
+        self.due[item] = tick
+        self.slots[tick % len(self.slots)].add(item)
+
+    def cancel(self, item: Hashable):
+        tick = self.due.pop(item, None)
+        if tick is not None:
+            self.slots[tick % len(self.slots)].discard(item)
+
+    def expire(self, now: float) -> list[Hashable]:
+        """
+        Advance to `now` and return the items whose time has come. Their
+        timers are removed; schedule them again to keep them.
+        """
+        self.now = now
+        target = int(now // self.resolution)
+        if target <= self.tick:
+            return []
+
+        expired: list[Hashable] = []
+        due = self.due
+        slots = self.slots
+        # After a long pause, every slot is visited once
+        last = min(target, self.tick + len(slots))
+        for tick in range(self.tick + 1, last + 1):
+            slot = slots[tick % len(slots)]
+            if not slot:
+                continue
+            # Items further than one turn of the wheel away share the slot
+            ready = [item for item in slot if due[item] <= target]
+            for item in ready:
+                slot.remove(item)
+                del due[item]
+            expired.extend(ready)
+
+        self.tick = target
+        return expired
+
+    def timeout(self, now: float) -> float | None:
+        """
+        Seconds until the next tick, or None if there are no timers at all.
+        """
+        if not self.due:
+            return None
+        return max(0.0, (self.tick + 1) * self.resolution - now)
+
+    def __len__(self) -> int:
+        return len(self.due)
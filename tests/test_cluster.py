@@ -0,0 +1,67 @@
+import socket as sckt
+import unittest
+
+from src.bench.workers import start_server
+from src.protocol import commands
+from src.protocol import events
+from src.protocol import handshake
+from src.protocol import shared
+from src.protocol.codec import BINARY
+
+PORT = 24700
+
+class ClusterLeaveTest(unittest.TestCase):
+    """
+    Members of a channel on other processes hear about every leave,
+    including the one that empties the channel on the leaver's process.
+    """
+
+    def setUp(self):
+        # Announce every change at once, so the leaves are individual events
+        self.server = start_server(PORT, ['--processes', '2', '--presence-window', '0'])
+        self.socks: list[sckt.socket] = []
+
+    def tearDown(self):
+        for sock in self.socks:
+            sock.close()
+        self.server.terminate()
+        _ = self.server.wait()
+
+    def connect(self) -> sckt.socket:
+        sock = sckt.create_connection(('127.0.0.1', PORT))
+        sock.settimeout(5)
+        _ = handshake.negotiate(sock, compressions=())
+        self.socks.append(sock)
+        return sock
+
+    def next_event(self, sock: sckt.socket, kind: type) -> events.EventObject:
+        while True:
+            event = shared.receive(sock, BINARY)
+            self.assertIsNotNone(event, "Connection closed")
+            if isinstance(event, kind):
+                return event
+
+    def test_leave_reaches_other_processes(self):
+        observer = self.connect()
+        shared.send(commands.CmdJoin('room'), observer, BINARY)
+        # Each process numbers its clients User 1, User 3, ... or User 2,
+        # User 4, ..., so the number shows which process a client is on
+        parity = int(self.next_event(observer, events.EventJoin).new_user_nick.split()[1]) % 2
+
+        members: list[sckt.socket] = []
+        remote = 0
+        while remote < 2 and len(members) < 40:
+            sock = self.connect()
+            shared.send(commands.CmdJoin('room'), sock, BINARY)
+            nick = self.next_event(observer, events.EventJoin).new_user_nick
+            remote += int(nick.split()[1]) % 2 != parity
+            members.append(sock)
+        self.assertEqual(remote, 2, "No clients were connected to the other process")
+
+        for sock in members:
+            shared.send(commands.CmdLeave('room'), sock, BINARY)
+        for _ in members:
+            _ = self.next_event(observer, events.EventLeave)
+
+if __name__ == '__main__':
+    unittest.main()